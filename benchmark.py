@@ -0,0 +1,529 @@
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import random
+import shutil
+import zipfile
+import argparse
+import platform
+import tempfile
+import contextlib
+from typing import Dict, List, Optional
+from xml.sax.saxutils import escape
+import numpy as np
+
+import summarygenerator
+import fileorganizer
+from documentstore import EmbeddingStore
+from filemover import FileMover, DEFAULT_MOVE_WORKERS
+from llmclient import LLMClient, StubBackend
+from metrics import peak_rss_bytes
+
+# Stages timed by the benchmark, in the order they run
+STAGES = ('scan', 'convert', 'excel', 'embed', 'summarize', 'write', 'plan', 'move')
+
+# Synthetic corpus: default size and mix of file types (weights per extension)
+DEFAULT_DOCUMENTS = 200
+DEFAULT_MIX = 'pdf=35,docx=20,xlsx=15,md=15,html=5,png=10'
+DEFAULT_SEED = 0
+
+# A regression is a stage whose throughput drops, or whose p95 latency or peak RSS grows, by more
+# than this fraction of the baseline
+DEFAULT_TOLERANCE = 0.10
+DEFAULT_RESULTS_FILE = 'benchmark_results.json'
+
+# Topics of the synthetic documents, so summaries, clusters and plans have realistic structure
+TOPICS = {
+    'invoices': ['invoice', 'payment', 'customer', 'amount', 'due', 'tax', 'order', 'account', 'balance', 'vendor'],
+    'research': ['experiment', 'sample', 'hypothesis', 'analysis', 'results', 'method', 'data', 'model', 'error',
+                 'study'],
+    'contracts': ['agreement', 'party', 'clause', 'term', 'liability', 'signature', 'obligation', 'notice',
+                  'renewal', 'license'],
+    'meetings': ['agenda', 'minutes', 'action', 'decision', 'attendee', 'project', 'deadline', 'review', 'budget',
+                 'team'],
+    'manuals': ['install', 'configure', 'device', 'step', 'warning', 'setting', 'maintenance', 'power', 'cable',
+                'manual'],
+    'reports': ['quarter', 'revenue', 'growth', 'forecast', 'market', 'region', 'sales', 'target', 'trend',
+                'summary'],
+}
+FILLER_WORDS = ['the', 'a', 'of', 'for', 'with', 'and', 'in', 'was', 'is', 'this', 'each', 'new', 'after', 'all']
+
+
+# --- Synthetic corpus ---
+
+def make_sentence(rng: random.Random, topic: str) -> str:
+    """Returns a random sentence of 8-20 words mixing topic terms and filler words."""
+    words = [rng.choice(TOPICS[topic]) if rng.random() < 0.4 else rng.choice(FILLER_WORDS)
+             for _ in range(rng.randint(8, 20))]
+    return " ".join(words).capitalize() + "."
+
+def make_paragraphs(rng: random.Random, topic: str, count: int) -> List[str]:
+    return [" ".join(make_sentence(rng, topic) for _ in range(rng.randint(3, 7))) for _ in range(count)]
+
+def write_markdown(path: str, rng: random.Random, topic: str, title: str) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"# {title}\n\n")
+        for i, paragraph in enumerate(make_paragraphs(rng, topic, rng.randint(4, 12))):
+            if i % 4 == 3:
+                f.write(f"## {topic.capitalize()} section {i // 4 + 1}\n\n")
+            f.write(paragraph + "\n\n")
+
+def write_html(path: str, rng: random.Random, topic: str, title: str) -> None:
+    body = "".join(f"<p>{escape(paragraph)}</p>" for paragraph in make_paragraphs(rng, topic, rng.randint(4, 12)))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"<html><head><title>{escape(title)}</title></head><body><h1>{escape(title)}</h1>{body}</body></html>")
+
+def write_docx(path: str, rng: random.Random, topic: str, title: str) -> None:
+    """Writes a minimal WordprocessingML package: a heading and plain paragraphs."""
+    def paragraph(text: str, style: Optional[str] = None) -> str:
+        properties = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ''
+        return f'<w:p>{properties}<w:r><w:t xml:space="preserve">{escape(text)}</w:t></w:r></w:p>'
+
+    body = paragraph(title, 'Heading1') + "".join(paragraph(text)
+                                                  for text in make_paragraphs(rng, topic, rng.randint(4, 12)))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as package:
+        package.writestr('[Content_Types].xml',
+                         '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                         '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                         '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                         '<Default Extension="xml" ContentType="application/xml"/>'
+                         '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-'
+                         'officedocument.wordprocessingml.document.main+xml"/></Types>')
+        package.writestr('_rels/.rels',
+                         '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                         '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                         '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+                         'relationships/officeDocument" Target="word/document.xml"/></Relationships>')
+        package.writestr('word/_rels/document.xml.rels',
+                         '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                         '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"/>')
+        package.writestr('word/document.xml',
+                         '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                         '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                         f'<w:body>{body}</w:body></w:document>')
+
+def write_pdf(path: str, rng: random.Random, topic: str, title: str) -> None:
+    """Writes a born-digital PDF (Helvetica text layer) of 1-6 pages."""
+    def pdf_text(text: str) -> str:
+        return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+    pages = []
+    for page_number in range(rng.randint(1, 6)):
+        lines = [title] if page_number == 0 else []
+        for paragraph in make_paragraphs(rng, topic, 4):
+            words, line = paragraph.split(), ""
+            for word in words:
+                if len(line) + len(word) > 90:
+                    lines.append(line)
+                    line = ""
+                line = f"{line} {word}".strip()
+            lines.extend([line, ""])
+        stream = "BT /F1 11 Tf 14 TL 56 800 Td " + " ".join(f"({pdf_text(line)}) '" for line in lines[:52]) + " ET"
+        pages.append(stream.encode('latin-1'))
+
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % (4 + 2 * i) for i in range(len(pages)))
+               + b"] /Count %d >>" % len(pages),
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for i, stream in enumerate(pages):
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >>"
+                       b" /Contents %d 0 R >>" % (5 + 2 * i))
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, 'wb') as f:
+        f.write(output)
+
+def write_xlsx(path: str, rng: random.Random, topic: str, title: str) -> None:
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    for sheet_number in range(rng.randint(1, 3)):
+        sheet = workbook.create_sheet(f"{topic.capitalize()} {sheet_number + 1}")
+        columns = rng.sample(TOPICS[topic], 5)
+        sheet.append(columns)
+        for _ in range(rng.randint(20, 400)):
+            sheet.append([rng.choice(TOPICS[topic]) if i == 0 else round(rng.uniform(0, 10000), 2)
+                          for i in range(len(columns))])
+    workbook.save(path)
+
+def write_png(path: str, rng: random.Random, topic: str, title: str) -> None:
+    """Writes a grayscale PNG with random bands (an image without text, as scanned clutter)."""
+    width, height = rng.choice([(320, 240), (640, 480), (800, 600)])
+    rows = bytearray()
+    shade = rng.randint(0, 255)
+    for y in range(height):
+        if y % 16 == 0:
+            shade = rng.randint(0, 255)
+        rows += b"\x00" + bytes([shade]) * width
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    with open(path, 'wb') as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+                + chunk(b'IDAT', zlib.compress(bytes(rows), 6)) + chunk(b'IEND', b''))
+
+WRITERS = {'.pdf': write_pdf, '.docx': write_docx, '.xlsx': write_xlsx, '.md': write_markdown, '.html': write_html,
+           '.png': write_png}
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """Parses "pdf=35,docx=20,..." into {extension: weight}."""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        ext = '.' + name.strip().lower().lstrip('.')
+        if ext not in WRITERS:
+            raise ValueError(f"Cannot generate '{ext}' files; choose from {', '.join(sorted(WRITERS))}.")
+        weights[ext] = float(weight or 1)
+    return weights
+
+def file_counts(documents: int, weights: Dict[str, float]) -> Dict[str, int]:
+    """Splits the number of documents over the extensions by weight (largest remainder)."""
+    total = sum(weights.values())
+    exact = {ext: documents * weight / total for ext, weight in weights.items()}
+    counts = {ext: int(value) for ext, value in exact.items()}
+    for ext in sorted(exact, key=lambda ext: exact[ext] - counts[ext], reverse=True)[:documents - sum(counts.values())]:
+        counts[ext] += 1
+    return counts
+
+def generate_corpus(directory: str, documents: int = DEFAULT_DOCUMENTS, mix: str = DEFAULT_MIX,
+                    seed: int = DEFAULT_SEED) -> List[str]:
+    """Writes a reproducible synthetic corpus: the same arguments always produce the same files.
+
+    Files are spread over topic folders (with some misplaced ones) and a few are saved twice, as
+    copies and attachments are in real shares.
+    """
+    rng = random.Random(seed)
+    paths = []
+    kinds = [ext for ext, count in sorted(file_counts(documents, parse_mix(mix)).items()) for _ in range(count)]
+    rng.shuffle(kinds)
+    for number, ext in enumerate(kinds):
+        topic = rng.choice(sorted(TOPICS))
+        folder = topic if rng.random() < 0.7 else rng.choice(['inbox', 'misc', 'old', 'scans'])
+        title = f"{topic.capitalize()} {rng.choice(TOPICS[topic])} {number:05d}"
+        path = os.path.join(directory, folder, f"{topic}_{number:05d}{ext}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if paths and rng.random() < 0.03:
+            # A copy of an earlier file of the same type, saved under a new name
+            earlier = [p for p in paths if p.endswith(ext)]
+            if earlier:
+                shutil.copyfile(rng.choice(earlier), path)
+                paths.append(path)
+                continue
+        WRITERS[ext](path, random.Random(rng.random()), topic, title)
+        paths.append(path)
+    return paths
+
+
+# --- Measurement ---
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process so far in MB, or None where it cannot be read."""
+    peak = peak_rss_bytes()
+    return peak / (1024 * 1024) if peak is not None else None
+
+
+class StageTimings:
+    """Latency samples of one stage; each sample is one `unit` (a file, a batch or the whole run)."""
+
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.seconds = 0.0
+        self.samples: List[float] = []
+        self.peak_rss_mb: Optional[float] = None
+
+    @contextlib.contextmanager
+    def measure(self, items: int = 1):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self.samples.append(elapsed)
+            self.seconds += elapsed
+            self.items += items
+
+    def finish(self) -> None:
+        self.peak_rss_mb = peak_rss_mb()
+
+    def report(self) -> Dict:
+        samples = np.array(self.samples) * 1000 if self.samples else None
+        return {
+            'items': self.items,
+            'seconds': round(self.seconds, 4),
+            'throughput_per_second': round(self.items / self.seconds, 3) if self.seconds else None,
+            'latency_unit': self.unit,
+            'samples': len(self.samples),
+            'p50_ms': round(float(np.percentile(samples, 50)), 3) if samples is not None else None,
+            'p95_ms': round(float(np.percentile(samples, 95)), 3) if samples is not None else None,
+            'peak_rss_mb': round(self.peak_rss_mb, 1) if self.peak_rss_mb is not None else None,
+        }
+
+@contextlib.contextmanager
+def quiet(verbose: bool):
+    """Hides the per-file progress output of the measured code unless verbose."""
+    if verbose:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+# --- Benchmark ---
+
+def run_benchmark(corpus_dir: str, workdir: str, embed_batch_size: int = summarygenerator.DEFAULT_EMBED_BATCH_SIZE,
+                  move_workers: int = DEFAULT_MOVE_WORKERS, options: Optional[Dict] = None,
+                  verbose: bool = False) -> Dict:
+    """Runs every stage once over the corpus and returns the results (see StageTimings.report).
+
+    Outputs go to workdir. The move stage moves the corpus into workdir and is rolled back afterwards,
+    so the corpus can be reused.
+    """
+    stages = {name: StageTimings(name, unit) for name, unit in (
+        ('scan', 'file'), ('convert', 'file'), ('excel', 'file'), ('embed', 'batch'), ('summarize', 'batch'),
+        ('write', 'run'), ('plan', 'run'), ('move', 'run'))}
+    setup: Dict[str, float] = {}
+
+    with quiet(verbose):
+        start_time = time.perf_counter()
+        summarygenerator.get_embed_model()
+        summarygenerator.ensure_nltk_data()
+        setup['model_load_seconds'] = round(time.perf_counter() - start_time, 4)
+        start_time = time.perf_counter()
+        summarygenerator.init_extraction_worker(options or {})
+        setup['converter_load_seconds'] = round(time.perf_counter() - start_time, 4)
+
+    # Scan: the time between files yielded by the directory walker
+    files: List[str] = []
+    with quiet(verbose):
+        walker = summarygenerator.iter_supported_files(corpus_dir, summarygenerator.DEFAULT_EXCLUDE_GLOBS)
+        while True:
+            with stages['scan'].measure():
+                file_path = next(walker, None)
+            if file_path is None:
+                stages['scan'].items -= 1
+                break
+            files.append(file_path)
+    stages['scan'].finish()
+
+    # Convert (docling) and Excel extraction, one file at a time
+    extracted = []
+    with quiet(verbose):
+        for file_path in files:
+            stage = stages['excel' if file_path.lower().endswith('.xlsx') else 'convert']
+            with stage.measure():
+                # Sentences are split right after extraction, as in the pipeline's extract stage
+                extracted.append(summarygenerator.attach_sentences(summarygenerator.extract_document(file_path)))
+    stages['convert'].finish()
+    stages['excel'].finish()
+    documents = [doc for doc in extracted if doc['error'] is None]
+
+    # Embedding and summarization, in the batches summarygenerator.py uses
+    flush_threshold = embed_batch_size * summarygenerator.EMBED_FLUSH_BATCHES
+    batches: List[List[Dict]] = [[]]
+    batch_sentences = 0
+    for doc in documents:
+        batches[-1].append(doc)
+        batch_sentences += len(doc['sentences'])
+        if batch_sentences >= flush_threshold:
+            batches.append([])
+            batch_sentences = 0
+    records = []
+    with quiet(verbose):
+        for batch in [batch for batch in batches if batch]:
+            with stages['embed'].measure(items=len(batch)):
+                sentence_embeddings = summarygenerator.embed_sentences(batch, embed_batch_size)
+            with stages['summarize'].measure(items=len(batch)):
+                embedded = summarygenerator.summarize_embedded(batch, sentence_embeddings)
+            records.extend(zip(batch, embedded))
+    stages['embed'].finish()
+    stages['summarize'].finish()
+
+    # Write processed_documents.json, llm_input.json and the embedding matrix, as a default run does
+    llm_records = []
+    vectors = {}
+    with stages['write'].measure(items=len(records)):
+        store = EmbeddingStore(os.path.join(workdir, 'embeddings.npy'),
+                               dim=summarygenerator.get_embed_model().get_sentence_embedding_dimension())
+        doc_records = []
+        for doc, (doc_embedding, summary) in records:
+            doc_dict, llm_dict = summarygenerator.build_document_records(doc, summary)
+            if doc_embedding is not None:
+                doc_dict['embedding_row'] = store.add(doc_dict['file_path'], doc_embedding)
+                vectors[doc_dict['file_path']] = doc_embedding
+            doc_records.append(doc_dict)
+            llm_records.append(llm_dict)
+        store.close()
+        for filename, data in (('processed_documents.json', doc_records), ('llm_input.json', llm_records)):
+            with open(os.path.join(workdir, filename), 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+    stages['write'].finish()
+
+    # Plan with the deterministic stub backend, clustering like fileorganizer.py does for large inputs
+    fileorganizer.client = LLMClient(StubBackend(fileorganizer.offline_response), requests_per_minute=1e9,
+                                     tokens_per_minute=1e12, max_prompt_tokens=None)
+    plan = None
+    with quiet(verbose), stages['plan'].measure(items=len(llm_records)):
+        fileorganizer.assign_document_ids(llm_records)
+        path_map = fileorganizer.create_file_path_map(llm_records)
+        if len(llm_records) > fileorganizer.DEFAULT_CLUSTER_SIZE:
+            clusters = fileorganizer.cluster_documents(llm_records, vectors, fileorganizer.DEFAULT_CLUSTER_SIZE)
+            analysis = fileorganizer.get_current_structure_analysis_from_ai(
+                fileorganizer.sample_documents_for_analysis(clusters))
+            plan, _, _ = fileorganizer.get_clustered_organization_plan(clusters, analysis, path_map)
+        elif llm_records:
+            analysis = fileorganizer.get_current_structure_analysis_from_ai(llm_records)
+            plan, _, _ = fileorganizer.get_organization_plan_from_ai(llm_records, analysis, path_map)
+    stages['plan'].finish()
+
+    # Move the planned files into workdir, then roll the moves back
+    if plan:
+        destination = os.path.join(workdir, 'organized')
+        directories = [os.path.join(destination, directory) for directory in plan]
+        moves = [(path_map[doc_id], os.path.join(destination, directory, os.path.basename(path_map[doc_id])))
+                 for directory, doc_ids in plan.items() for doc_id in doc_ids]
+        mover = FileMover(os.path.join(workdir, 'move_journal.jsonl'), move_workers)
+        with quiet(verbose), stages['move'].measure(items=len(moves)):
+            result = mover.run(directories, moves)
+        stages['move'].finish()
+        with quiet(verbose):
+            mover.rollback()
+        if result.failures:
+            print(f"Warning: {len(result.failures)} benchmark moves failed, e.g. {result.failures[0][2]}")
+
+    return {
+        'setup': setup,
+        'documents': len(files),
+        'errors': len(extracted) - len(documents),
+        'stages': {name: stage.report() for name, stage in stages.items() if stage.samples},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def compare_to_baseline(results: Dict, baseline: Dict, tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """Prints each stage next to the baseline and returns a description of every regression."""
+    regressions = []
+    print(f"\n{'Stage':<10} {'Throughput/s':>30} {'p95 ms':>30} {'Peak RSS MB':>30}")
+    for name in STAGES:
+        current, previous = results['stages'].get(name), baseline.get('stages', {}).get(name)
+        if current is None or previous is None:
+            continue
+        columns = []
+        for metric, higher_is_better in (('throughput_per_second', True), ('p95_ms', False), ('peak_rss_mb', False)):
+            new, old = current.get(metric), previous.get(metric)
+            if new is None or not old:
+                columns.append(f"{'-':>30}")
+                continue
+            change = (new - old) / old
+            columns.append(f"{old:>10.2f} -> {new:>10.2f} {change:>+6.0%}")
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{name}: {metric} {old:.2f} -> {new:.2f} ({change:+.0%})")
+        print(f"{name:<10} " + " ".join(columns))
+    return regressions
+
+def print_results(results: Dict) -> None:
+    print(f"\n=== Benchmark: {results['documents']} documents ({results['errors']} errors) ===")
+    print(f"Model load: {results['setup']['model_load_seconds']:.2f}s, "
+          f"converter load: {results['setup']['converter_load_seconds']:.2f}s")
+    print(f"{'Stage':<10} {'Items':>7} {'Seconds':>9} {'Items/s':>9} {'Unit':>6} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'Peak RSS MB':>12}")
+    for name in STAGES:
+        stage = results['stages'].get(name)
+        if stage is None:
+            continue
+
+        def number(value, width):
+            return f"{value:>{width}.2f}" if value is not None else f"{'-':>{width}}"
+        print(f"{name:<10} {stage['items']:>7} {stage['seconds']:>9.2f} {number(stage['throughput_per_second'], 9)} "
+              f"{stage['latency_unit']:>6} {number(stage['p50_ms'], 9)} {number(stage['p95_ms'], 9)} "
+              f"{number(stage['peak_rss_mb'], 12)}")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Time each pipeline stage on a reproducible synthetic corpus.")
+    parser.add_argument('--documents', type=int, default=DEFAULT_DOCUMENTS,
+                        help="Number of synthetic documents (default: %(default)s).")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help="Weights of the generated file types (default: %(default)s).")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help="Corpus seed (default: %(default)s).")
+    parser.add_argument('--corpus-dir', default=None,
+                        help="Generate the corpus here, or reuse it if the directory already exists.")
+    parser.add_argument('--workdir', default=None,
+                        help="Directory for the outputs of the measured stages (default: a temporary directory).")
+    parser.add_argument('--output', default=DEFAULT_RESULTS_FILE,
+                        help="Where to write the results as JSON (default: %(default)s).")
+    parser.add_argument('--baseline', default=None,
+                        help="Earlier results to compare against; exits with status 1 on a regression.")
+    parser.add_argument('--save-baseline', default=None, help="Also write the results to this baseline file.")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed relative slowdown before a stage counts as regressed (default: %(default)s).")
+    parser.add_argument('--embed-batch-size', type=int, default=summarygenerator.DEFAULT_EMBED_BATCH_SIZE,
+                        help="Sentences per embedding batch (default: %(default)s).")
+    parser.add_argument('--move-workers', type=int, default=DEFAULT_MOVE_WORKERS,
+                        help="Parallel file moves (default: %(default)s).")
+    parser.add_argument('--ocr', choices=['auto', 'always', 'never'], default='auto',
+                        help="OCR mode passed to the converter (default: %(default)s).")
+    parser.add_argument('--verbose', action='store_true', help="Show the progress output of the measured code.")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='docorg-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    corpus_dir = args.corpus_dir or os.path.join(workdir, 'corpus')
+    corpus = {'documents': args.documents, 'mix': args.mix, 'seed': args.seed}
+    try:
+        if os.path.isdir(corpus_dir) and os.listdir(corpus_dir):
+            print(f"Reusing the corpus in {corpus_dir}")
+        else:
+            start_time = time.perf_counter()
+            paths = generate_corpus(corpus_dir, args.documents, args.mix, args.seed)
+            print(f"Generated {len(paths)} documents ({sum(os.path.getsize(p) for p in paths) / 1e6:.1f} MB) "
+                  f"in {corpus_dir} in {time.perf_counter() - start_time:.2f}s")
+
+        options = {'ocr': args.ocr, 'excel_max_rows': summarygenerator.DEFAULT_EXCEL_MAX_ROWS,
+                   'excel_max_cells': summarygenerator.DEFAULT_EXCEL_MAX_CELLS,
+                   'max_pages': summarygenerator.DEFAULT_MAX_PAGES, 'max_chars': summarygenerator.DEFAULT_MAX_CHARS}
+        results = run_benchmark(corpus_dir, workdir, args.embed_batch_size, args.move_workers, options, args.verbose)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count(), 'embed_model': summarygenerator.EMBED_MODEL_NAME},
+        'corpus': corpus,
+        **results,
+    }
+    print_results(results)
+    for filepath in filter(None, (args.output, args.save_baseline)):
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+        print(f"Results saved to {filepath}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('corpus') != corpus:
+            print(f"Warning: the baseline was measured on a different corpus ({baseline.get('corpus')}).")
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo regressions beyond the tolerance.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+import os
+import json
+import struct
+from typing import Callable, Dict, Iterator, List, Optional, Set
+import numpy as np
+
+# Records are fsynced to disk after this many writes
+DEFAULT_CHECKPOINT_EVERY = 100
+
+# Embedding matrix (.npy) and its row index (one {"row", "file_path"} record per line)
+EMBEDDINGS_FILE = 'embeddings.npy'
+EMBEDDINGS_INDEX_FILE = 'embeddings_index.jsonl'
+
+# Fixed .npy header size, so the row count can be rewritten in place as rows are appended
+_NPY_HEADER_SIZE = 128
+
+
+class JsonlWriter:
+    """Appends one JSON record per line and fsyncs the file at periodic checkpoints."""
+
+    def __init__(self, filepath: str, append: bool = False, checkpoint_every: int = DEFAULT_CHECKPOINT_EVERY):
+        self.filepath = filepath
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.records_written = 0
+        self._since_checkpoint = 0
+        self._file = open(filepath, 'a' if append else 'w', encoding='utf-8')
+
+    def write(self, record: Dict) -> None:
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.records_written += 1
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._since_checkpoint = 0
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self.checkpoint()
+            self._file.close()
+
+
+def iter_jsonl(filepath: str) -> Iterator[Dict]:
+    """Lazily yields the records of a JSON-lines file, skipping a truncated last line."""
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                # Partial record left behind by an interrupted run
+                break
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def load_records(filepath: str) -> List[Dict]:
+    """Loads all records from a .json array file or a .jsonl stream."""
+    if filepath.endswith('.jsonl'):
+        return list(iter_jsonl(filepath))
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def prepare_resume(filepaths: List[str], is_complete: Optional[Callable[[Dict], bool]] = None) -> Dict[str, List[Dict]]:
+    """Makes streamed output files consistent for appending and returns the records they share.
+
+    Only documents present in every file (and accepted by is_complete) count as done; any other
+    record (e.g. written to one file just before a crash) or partial last line is dropped so the
+    document is processed again.
+    """
+    records: Dict[str, List[Dict]] = {}
+    for filepath in filepaths:
+        records[filepath] = list(iter_jsonl(filepath)) if os.path.exists(filepath) else []
+
+    completed: Optional[Set[str]] = None
+    for file_records in records.values():
+        paths = {record['file_path'] for record in file_records if is_complete is None or is_complete(record)}
+        completed = paths if completed is None else completed & paths
+
+    for filepath, file_records in records.items():
+        kept = [record for record in file_records if record['file_path'] in completed]
+        if not os.path.exists(filepath):
+            continue
+        with open(filepath, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size:
+                f.seek(-1, os.SEEK_END)
+            clean_end = size == 0 or f.read(1) == b'\n'
+        if len(kept) != len(file_records) or not clean_end:
+            tmp_file = f"{filepath}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                for record in kept:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            os.replace(tmp_file, filepath)
+        records[filepath] = kept
+    return records
+
+
+def rewrite_jsonl(filepath: str, transform: Callable[[Dict], Dict]) -> None:
+    """Rewrites a JSON-lines file record by record through transform, replacing it atomically."""
+    tmp_file = f"{filepath}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        for record in iter_jsonl(filepath):
+            f.write(json.dumps(transform(record), ensure_ascii=False) + '\n')
+    os.replace(tmp_file, filepath)
+
+
+def _write_npy_header(f, dtype: np.dtype, shape: tuple) -> None:
+    """Writes a fixed-size version 1.0 .npy header at the start of an open file."""
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+    header = header.ljust(_NPY_HEADER_SIZE - 11) + '\n'
+    f.seek(0)
+    f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+
+class EmbeddingStore:
+    """Appends embedding vectors as rows of a contiguous .npy matrix that can be memory-mapped.
+
+    Row i of the matrix belongs to line i of the index file, which links it back to its file_path.
+    The header row count is rewritten at every checkpoint, so a crashed run leaves a valid matrix.
+    """
+
+    def __init__(self, filepath: str = EMBEDDINGS_FILE, dim: int = 384, dtype: str = 'float32',
+                 index_filepath: Optional[str] = None, append: bool = False,
+                 checkpoint_every: int = DEFAULT_CHECKPOINT_EVERY):
+        self.filepath = filepath
+        self.index_filepath = index_filepath or os.path.splitext(filepath)[0] + '_index.jsonl'
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.rows = 0
+        self._since_checkpoint = 0
+
+        if append and os.path.exists(self.filepath):
+            self._open_existing()
+        else:
+            with open(self.filepath, 'wb') as f:
+                _write_npy_header(f, self.dtype, (0, self.dim))
+            open(self.index_filepath, 'w', encoding='utf-8').close()
+        self._file = open(self.filepath, 'r+b')
+        self._file.seek(0, os.SEEK_END)
+        self._index = JsonlWriter(self.index_filepath, append=True, checkpoint_every=2 ** 62)
+
+    def _open_existing(self) -> None:
+        with open(self.filepath, 'rb') as f:
+            np.lib.format.read_magic(f)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+            if f.tell() != _NPY_HEADER_SIZE or shape[1] != self.dim or dtype != self.dtype:
+                raise ValueError(f"Embedding store '{self.filepath}' has shape {shape} and dtype {dtype}, "
+                                 f"expected {self.dim} columns of {self.dtype}.")
+        row_bytes = self.dim * self.dtype.itemsize
+        rows_on_disk = (os.path.getsize(self.filepath) - _NPY_HEADER_SIZE) // row_bytes
+        index = [record['file_path'] for record in iter_jsonl(self.index_filepath)] \
+            if os.path.exists(self.index_filepath) else []
+
+        # Keep only rows that are both fully written and indexed
+        self.rows = min(rows_on_disk, len(index))
+        with open(self.filepath, 'r+b') as f:
+            f.truncate(_NPY_HEADER_SIZE + self.rows * row_bytes)
+            _write_npy_header(f, self.dtype, (self.rows, self.dim))
+        with open(self.index_filepath, 'w', encoding='utf-8') as f:
+            for row, file_path in enumerate(index[:self.rows]):
+                f.write(json.dumps({'row': row, 'file_path': file_path}, ensure_ascii=False) + '\n')
+
+    def add(self, file_path: str, vector) -> int:
+        """Appends one vector and returns its row id."""
+        vector = np.asarray(vector, dtype=self.dtype).reshape(-1)
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"Expected an embedding of size {self.dim}, got {vector.shape[0]}.")
+        row = self.rows
+        self._file.write(vector.tobytes())
+        self._index.write({'row': row, 'file_path': file_path})
+        self.rows += 1
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+        return row
+
+    def checkpoint(self) -> None:
+        _write_npy_header(self._file, self.dtype, (self.rows, self.dim))
+        self._file.seek(0, os.SEEK_END)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._index.checkpoint()
+        self._since_checkpoint = 0
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self.checkpoint()
+            self._file.close()
+            self._index.close()
+
+
+def load_embeddings(filepath: str = EMBEDDINGS_FILE) -> np.ndarray:
+    """Memory-maps the embedding matrix without copying or parsing it."""
+    return np.load(filepath, mmap_mode='r')
+
+
+def load_embedding_index(index_filepath: str = EMBEDDINGS_INDEX_FILE) -> List[str]:
+    """Returns the file_path of every embedding row, in row order."""
+    return [record['file_path'] for record in iter_jsonl(index_filepath)]
+
+
+def get_record_embedding(record: Dict, embeddings: Optional[np.ndarray]) -> Optional[np.ndarray]:
+    """Returns a record's embedding, from the matrix (embedding_row) or an inline 'embedding' list."""
+    if record.get('embedding_row') is not None and embeddings is not None:
+        return embeddings[record['embedding_row']]
+    if record.get('embedding'):
+        return np.asarray(record['embedding'], dtype=np.float32)
+    return None
@@ -0,0 +1,549 @@
+import os
+import sys
+import time
+import argparse
+import threading
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from dotenv import load_dotenv
+import summarygenerator
+import fileorganizer
+from filemover import FileMover, load_journal, unique_destination, DEFAULT_JOURNAL_FILE
+from llmclient import LLMClient
+from metrics import Metrics
+
+# Watch mode: new files under BASE_PATH are summarized, embedded and moved into the folder of the
+# organized tree under DESTINATION_ROOT whose documents they are most similar to. The AI is only
+# asked when no folder is similar enough.
+
+load_dotenv()
+
+DEFAULT_WATCH_CACHE_FILE = 'watch_cache.json'
+DEFAULT_WATCH_JOURNAL_FILE = 'watch_journal.jsonl'
+
+# A file is placed by similarity alone when its cosine similarity to a folder's centroid is at least this
+DEFAULT_MIN_SIMILARITY = 0.5
+# Folders offered to the AI when no folder is similar enough
+AI_CANDIDATE_FOLDERS = 10
+# Folder for files that fit nowhere when the AI is not available and the tree is empty
+FALLBACK_FOLDER = 'Unsorted'
+
+# A file is processed once its size and mtime have not changed for this long (e.g. while it is copied in)
+DEFAULT_SETTLE_SECONDS = 1.0
+DEFAULT_POLL_INTERVAL = 2.0
+# With filesystem notifications, both trees are still rescanned this often in case events were lost
+DEFAULT_RESCAN_INTERVAL = 300.0
+DEFAULT_WATCH_BATCH_SIZE = 16
+CACHE_SAVE_INTERVAL_SECONDS = 60.0
+IDLE_SLEEP_SECONDS = 0.2
+
+
+def is_within(path: str, root: str) -> bool:
+    """True if path is root or lies below it."""
+    try:
+        return os.path.commonpath([os.path.abspath(path), os.path.abspath(root)]) == os.path.abspath(root)
+    except ValueError:
+        # Paths on different drives
+        return False
+
+
+class FolderIndex:
+    """Centroids of the document embeddings in each folder of the organized tree.
+
+    Folders are kept as running sums of unit vectors, so files can be added and removed without
+    touching the rest of the index.
+    """
+
+    def __init__(self):
+        self.sums: Dict[str, np.ndarray] = {}
+        self.counts: Dict[str, int] = {}
+        self._matrix: Optional[Tuple[List[str], np.ndarray]] = None
+
+    @staticmethod
+    def _unit(embedding: np.ndarray) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else None
+
+    def add(self, directory: str, embedding: Optional[np.ndarray], sign: int = 1) -> None:
+        vector = self._unit(embedding) if embedding is not None else None
+        if vector is None or not directory:
+            return
+        self.sums[directory] = self.sums.get(directory, np.zeros_like(vector)) + sign * vector
+        self.counts[directory] = self.counts.get(directory, 0) + sign
+        if self.counts[directory] <= 0:
+            del self.sums[directory], self.counts[directory]
+        self._matrix = None
+
+    def remove(self, directory: str, embedding: Optional[np.ndarray]) -> None:
+        self.add(directory, embedding, sign=-1)
+
+    def nearest(self, embedding: Optional[np.ndarray], k: int) -> List[Tuple[str, float]]:
+        """The k folders whose centroids are most similar to the embedding, as (directory, cosine)."""
+        vector = self._unit(embedding) if embedding is not None else None
+        if vector is None or not self.sums:
+            return []
+        if self._matrix is None:
+            directories = sorted(self.sums)
+            centroids = np.stack([self.sums[directory] for directory in directories])
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            self._matrix = (directories, centroids / np.maximum(norms, 1e-12))
+        directories, centroids = self._matrix
+        similarities = centroids @ vector
+        order = np.argsort(-similarities)[:k]
+        return [(directories[i], float(similarities[i])) for i in order]
+
+
+class PendingFiles:
+    """Files that appeared or changed, held back until their size and mtime stop changing."""
+
+    def __init__(self, settle_seconds: float = DEFAULT_SETTLE_SECONDS):
+        self.settle_seconds = settle_seconds
+        self._pending: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def note(self, file_path: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._pending.setdefault(file_path, {'first_seen': now, 'fingerprint': None, 'stable_since': now})
+
+    def take_ready(self, limit: int) -> List[Tuple[str, float]]:
+        """Removes and returns up to `limit` settled files as (path, time first seen); files that
+        disappeared in the meantime are dropped."""
+        now = time.time()
+        with self._lock:
+            items = list(self._pending.items())
+        ready = []
+        for file_path, state in items:
+            try:
+                fingerprint = summarygenerator.file_fingerprint(file_path)
+            except OSError:
+                with self._lock:
+                    self._pending.pop(file_path, None)
+                continue
+            if fingerprint != state['fingerprint']:
+                state['fingerprint'], state['stable_since'] = fingerprint, now
+            elif now - state['stable_since'] >= self.settle_seconds and len(ready) < limit:
+                ready.append((file_path, state['first_seen']))
+                with self._lock:
+                    self._pending.pop(file_path, None)
+        return ready
+
+
+def start_notifications(roots: List[str], on_path) -> Optional[object]:
+    """Starts a watchdog observer calling on_path for every created, modified or moved-in file.
+
+    Returns the observer, or None if watchdog is not installed.
+    """
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        return None
+
+    class Handler(FileSystemEventHandler):
+        def on_created(self, event):
+            if not event.is_directory:
+                on_path(event.src_path)
+
+        def on_modified(self, event):
+            if not event.is_directory:
+                on_path(event.src_path)
+
+        def on_moved(self, event):
+            if not event.is_directory:
+                on_path(event.dest_path)
+
+    observer = Observer()
+    for root in roots:
+        observer.schedule(Handler(), root, recursive=True)
+    observer.daemon = True
+    observer.start()
+    return observer
+
+
+class DocumentWatcher:
+    """Keeps the organized tree under `destination_root` up to date with files dropped into `base_path`.
+
+    New or changed files under base_path are summarized and embedded (files already in a cache are
+    not), then moved into the most similar folder, or where the AI suggests when no folder is
+    similar enough. Files added to or changed in the organized tree itself are indexed but not moved.
+    Every move is appended to a journal, so `fileorganizer.py --rollback --journal` undoes them.
+    """
+
+    def __init__(self, base_path: str, destination_root: str, options: Dict, exclude_globs: List[str],
+                 cache_file: str = DEFAULT_WATCH_CACHE_FILE, summary_cache_file: Optional[str] = None,
+                 organizer_journal: Optional[str] = None, journal_path: str = DEFAULT_WATCH_JOURNAL_FILE,
+                 min_similarity: float = DEFAULT_MIN_SIMILARITY, use_ai: bool = False, dry_run: bool = False,
+                 batch_size: int = DEFAULT_WATCH_BATCH_SIZE, metrics: Optional[Metrics] = None):
+        self.base_path = os.path.abspath(base_path)
+        self.destination_root = os.path.abspath(destination_root)
+        self.options = options
+        self.options_hash = summarygenerator.options_hash(options)
+        self.exclude_globs = exclude_globs
+        self.cache_file = cache_file
+        self.min_similarity = min_similarity
+        self.use_ai = use_ai
+        self.dry_run = dry_run
+        self.batch_size = max(1, batch_size)
+        self.metrics = metrics or Metrics('docwatcher')
+        self.mover = FileMover(journal_path, metrics=self.metrics)
+        self.folders = FolderIndex()
+        self.pending = PendingFiles()
+        self.entries: Dict[str, Dict] = summarygenerator.load_cache(cache_file)
+        # Results of earlier batch runs, looked up (read-only) before summarizing a file again
+        self.summary_entries: Dict[str, Dict] = (summarygenerator.load_cache(summary_cache_file)
+                                                 if summary_cache_file else {})
+        # Files the batch organizer moved, by their new path, so their batch results can be found
+        self.moved_from: Dict[str, str] = {}
+        # Files in the folder index, with the embedding they were added with
+        self.indexed: Dict[str, np.ndarray] = {}
+        # Fingerprints of the files already handled (placed, indexed or failed), so they are not redone
+        self.handled: Dict[str, Dict] = {}
+        if organizer_journal and os.path.exists(organizer_journal):
+            _, moves, _ = load_journal(organizer_journal)
+            self.moved_from = {dst: src for (src, dst), state in moves.items() if state == 'done'}
+        self._cache_saved_at = time.time()
+        self._cache_dirty = False
+
+    def folder_of(self, file_path: str) -> str:
+        relative = os.path.relpath(os.path.dirname(file_path), self.destination_root)
+        return '' if relative == '.' else relative.replace(os.sep, '/')
+
+    def is_candidate(self, file_path: str) -> bool:
+        """True for supported, non-excluded files in either tree."""
+        if os.path.splitext(file_path)[1].lower() not in summarygenerator.supported_extensions:
+            return False
+        root = self.destination_root if is_within(file_path, self.destination_root) else self.base_path
+        if not is_within(file_path, root):
+            return False
+        relative = os.path.relpath(file_path, root)
+        return not any(summarygenerator.is_excluded(part, relative, self.exclude_globs)
+                       for part in relative.split(os.sep))
+
+    def note(self, file_path: str) -> None:
+        if self.is_candidate(file_path):
+            self.pending.note(os.path.abspath(file_path))
+
+    def cached(self, file_path: str, fingerprint: Dict) -> Optional[Dict]:
+        """The cached result for an unchanged file: this watcher's cache, then the batch results."""
+        entry = summarygenerator.lookup_cache(self.entries, file_path, fingerprint, False, self.options_hash)
+        if entry is None:
+            source = self.moved_from.get(file_path, file_path)
+            entry = summarygenerator.lookup_cache(self.summary_entries, source, fingerprint, False,
+                                                   self.options_hash)
+        return entry
+
+    def scan(self, skip_base: bool = False) -> None:
+        """Queues the new and changed files of both trees, and drops deleted files from the index.
+
+        With skip_base, the files now under the base path are marked as handled instead.
+        """
+        for file_path in [path for path in self.indexed if not os.path.exists(path)]:
+            self.folders.remove(self.folder_of(file_path), self.indexed.pop(file_path))
+            self.entries.pop(file_path, None)
+            self._cache_dirty = True
+        for root in (self.destination_root, self.base_path):
+            for file_path in summarygenerator.iter_supported_files(root, self.exclude_globs):
+                if root == self.base_path and is_within(file_path, self.destination_root):
+                    continue
+                try:
+                    fingerprint = summarygenerator.file_fingerprint(file_path)
+                except OSError:
+                    continue
+                if root == self.base_path and skip_base:
+                    self.handled[file_path] = fingerprint
+                elif self.handled.get(file_path) != fingerprint and not (
+                        root == self.destination_root and file_path in self.indexed
+                        and summarygenerator.lookup_cache(self.entries, file_path, fingerprint, False,
+                                                          self.options_hash)):
+                    self.note(file_path)
+
+    def index_destination(self) -> None:
+        """Builds the folder index from the organized tree, summarizing only files no cache knows."""
+        print(f"Indexing the organized tree under {self.destination_root}...")
+        to_summarize = []
+        for file_path in summarygenerator.iter_supported_files(self.destination_root, self.exclude_globs):
+            fingerprint = summarygenerator.file_fingerprint(file_path)
+            entry = self.cached(file_path, fingerprint)
+            if entry is None:
+                to_summarize.append(file_path)
+                continue
+            self.remember(file_path, fingerprint, entry['document'], entry.get('embedding'))
+            self.handled[file_path] = fingerprint
+        # Forget files that were removed from the organized tree while the watcher was not running
+        for file_path in [path for path in self.entries
+                          if is_within(path, self.destination_root) and path not in self.indexed]:
+            del self.entries[file_path]
+            self._cache_dirty = True
+        if to_summarize:
+            print(f"Summarizing {len(to_summarize)} files of the organized tree that no cache knows...")
+        for start in range(0, len(to_summarize), self.batch_size):
+            for record in self.summarize(to_summarize[start:start + self.batch_size]):
+                fingerprint = summarygenerator.file_fingerprint(record['file_path'])
+                self.handled[record['file_path']] = fingerprint
+                if record.get('error') is None:
+                    self.remember(record['file_path'], fingerprint, record, record['embedding'])
+        self.save_cache(force=True)
+        print(f"Indexed {sum(self.folders.counts.values())} documents in {len(self.folders.counts)} folders.")
+
+    def remember(self, file_path: str, fingerprint: Dict, document: Dict, embedding: Optional[np.ndarray]) -> None:
+        """Caches a file's result and, inside the organized tree, adds it to its folder (replacing
+        the file's previous embedding)."""
+        document = {key: value for key, value in document.items() if key != 'embedding'}
+        if is_within(file_path, self.destination_root):
+            directory = self.folder_of(file_path)
+            if file_path in self.indexed:
+                self.folders.remove(directory, self.indexed.pop(file_path))
+            if embedding is not None:
+                self.folders.add(directory, embedding)
+                self.indexed[file_path] = embedding
+        self.entries[file_path] = {'fingerprint': fingerprint, 'options_hash': self.options_hash,
+                                   'document': {**document, 'file_path': file_path}, 'embedding': embedding}
+        self._cache_dirty = True
+
+    def summarize(self, file_paths: List[str]) -> List[Dict]:
+        with self.metrics.span('summarize', items=len(file_paths)):
+            return summarygenerator.summarize_files(file_paths, self.options)
+
+    def choose_folder(self, document: Dict, embedding: Optional[np.ndarray]) -> Tuple[str, float, str]:
+        """Returns (directory, similarity, how it was chosen) for a new file."""
+        candidates = self.folders.nearest(embedding, AI_CANDIDATE_FOLDERS)
+        if candidates and candidates[0][1] >= self.min_similarity:
+            return candidates[0][0], candidates[0][1], 'similarity'
+        if self.use_ai:
+            try:
+                directory = fileorganizer.get_placement_from_ai(document, candidates)
+            except Exception as e:
+                print(f"  [ERROR] Could not ask the AI where to put '{document['file_path']}'. Error: {e}")
+                self.metrics.count('errors')
+                directory = None
+            if directory:
+                return directory, dict(candidates).get(directory, 0.0), 'ai'
+        if candidates:
+            return candidates[0][0], candidates[0][1], 'nearest'
+        return FALLBACK_FOLDER, 0.0, 'fallback'
+
+    def process(self, ready: List[Tuple[str, float]]) -> None:
+        """Summarizes the settled files that need it, then places or indexes each of them."""
+        documents: Dict[str, Tuple[Dict, Optional[np.ndarray], Dict]] = {}
+        to_summarize = []
+        for file_path, _ in ready:
+            try:
+                fingerprint = summarygenerator.file_fingerprint(file_path)
+            except OSError:
+                continue
+            if self.handled.get(file_path) == fingerprint:
+                continue
+            self.handled[file_path] = fingerprint
+            entry = self.cached(file_path, fingerprint)
+            if entry is None:
+                to_summarize.append(file_path)
+            elif file_path in self.indexed:
+                # Unchanged file of the organized tree (e.g. the event of one of our own moves)
+                continue
+            else:
+                documents[file_path] = (entry['document'], entry.get('embedding'), fingerprint)
+        if to_summarize:
+            for record in self.summarize(to_summarize):
+                if record.get('error') is not None:
+                    print(f"  [ERROR] Could not summarize '{record['file_path']}': {record['error']}")
+                    self.metrics.count('errors')
+                    continue
+                fingerprint = summarygenerator.file_fingerprint(record['file_path'])
+                documents[record['file_path']] = (record, record['embedding'], fingerprint)
+                if not is_within(record['file_path'], self.destination_root):
+                    # Kept until the file is placed, so a failed move or a dry run does not summarize it again
+                    self.remember(record['file_path'], fingerprint, record, record['embedding'])
+
+        for file_path, first_seen in ready:
+            if file_path not in documents:
+                continue
+            document, embedding, fingerprint = documents[file_path]
+            if is_within(file_path, self.destination_root):
+                self.remember(file_path, fingerprint, document, embedding)
+                self.metrics.count('files_indexed')
+                print(f"[INDEXED] {file_path} in {self.folder_of(file_path) or '.'}/")
+                continue
+            self.place(file_path, first_seen, document, embedding, fingerprint)
+        self.save_cache()
+
+    def place(self, file_path: str, first_seen: float, document: Dict, embedding: Optional[np.ndarray],
+              fingerprint: Dict) -> None:
+        """Moves one new file into the folder chosen for it and adds it to the index."""
+        with self.metrics.span('place', file_path, fingerprint['size']):
+            directory, similarity, chosen_by = self.choose_folder(document, embedding)
+        destination = unique_destination(os.path.join(self.destination_root, *directory.split('/'),
+                                                      os.path.basename(file_path)))
+        if self.dry_run:
+            print(f"[DRY RUN] {file_path} -> {destination} ({chosen_by}, similarity {similarity:.2f})")
+            return
+        result = self.mover.run([os.path.dirname(destination)], [(file_path, destination)], append=True)
+        if result.failures:
+            _, _, error = result.failures[0]
+            print(f"  [ERROR] Failed to move '{file_path}' to '{destination}'. Error: {error}")
+            self.metrics.count('errors')
+            return
+        # The name was taken between choosing it and the move
+        destination = result.renamed.get(file_path, destination)
+        self.entries.pop(file_path, None)
+        self.handled.pop(file_path, None)
+        self.remember(destination, summarygenerator.file_fingerprint(destination), document, embedding)
+        latency = time.time() - first_seen
+        self.metrics.count('files_placed')
+        self.metrics.count(f"placed_by_{chosen_by}")
+        self.metrics.observe('end_to_end', latency, file_path, fingerprint['size'], chosen_by=chosen_by)
+        print(f"[PLACED] {os.path.basename(file_path)} -> {directory}/ ({chosen_by}, similarity {similarity:.2f}, "
+              f"{latency:.1f}s)")
+
+    def save_cache(self, force: bool = False) -> None:
+        if self._cache_dirty and (force or time.time() - self._cache_saved_at >= CACHE_SAVE_INTERVAL_SECONDS):
+            summarygenerator.save_cache(self.cache_file, self.entries)
+            self._cache_saved_at = time.time()
+            self._cache_dirty = False
+
+    def run(self, poll: bool = False, poll_interval: float = DEFAULT_POLL_INTERVAL,
+            rescan_interval: float = DEFAULT_RESCAN_INTERVAL, once: bool = False, skip_existing: bool = False,
+            metrics_file: Optional[str] = None) -> None:
+        """Watches both trees until interrupted (or, with once, until the current files are handled)."""
+        observer = None if poll or once else start_notifications([self.base_path, self.destination_root], self.note)
+        if observer is None and not once:
+            print(f"Polling for changes every {poll_interval:.1f}s"
+                  f"{'' if poll else ' (install watchdog for filesystem notifications)'}.")
+            rescan_interval = poll_interval
+        elif observer is not None:
+            print("Watching for changes with filesystem notifications.")
+        self.scan(skip_base=skip_existing)
+        next_scan = time.time() + rescan_interval
+        print(f"Watching {self.base_path} (Ctrl+C to stop)..." if not once else
+              f"Placing the {len(self.pending)} files currently under {self.base_path}...")
+        try:
+            while True:
+                ready = self.pending.take_ready(self.batch_size)
+                if ready:
+                    self.process(ready)
+                    if metrics_file:
+                        self.metrics.write_prometheus(metrics_file)
+                    continue
+                if once and not len(self.pending):
+                    break
+                if not once and time.time() >= next_scan:
+                    self.scan()
+                    next_scan = time.time() + rescan_interval
+                self.save_cache()
+                time.sleep(IDLE_SLEEP_SECONDS)
+        except KeyboardInterrupt:
+            print("\nStopping.")
+        finally:
+            if observer is not None:
+                observer.stop()
+            self.save_cache(force=True)
+            if metrics_file:
+                self.metrics.write_prometheus(metrics_file)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Watch BASE_PATH and place new documents into the organized "
+                                                 "tree under DESTINATION_ROOT as they arrive.")
+    parser.add_argument('--base-path', default=os.getenv('BASE_PATH'),
+                        help="Directory new documents are dropped into (default: $BASE_PATH).")
+    parser.add_argument('--destination', default=os.getenv('DESTINATION_ROOT'),
+                        help="Root of the organized tree (default: $DESTINATION_ROOT).")
+    parser.add_argument('--min-similarity', type=float, default=DEFAULT_MIN_SIMILARITY,
+                        help="Cosine similarity to a folder at which a file is placed without asking the AI "
+                             "(default: %(default)s).")
+    parser.add_argument('--backend', choices=['gemini', 'stub', 'record', 'replay', 'none'], default='gemini',
+                        help="Model asked when no folder fits; 'none' uses the nearest folder (default: %(default)s).")
+    parser.add_argument('--model', default=fileorganizer.DEFAULT_MODEL_NAME,
+                        help="Gemini model name (default: %(default)s).")
+    parser.add_argument('--recordings', default=fileorganizer.DEFAULT_RECORDINGS_FILE,
+                        help="Recordings file of the record/replay backends (default: %(default)s).")
+    parser.add_argument('--poll', action='store_true',
+                        help="Poll for changes instead of using filesystem notifications.")
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help="Seconds between polls (default: %(default)s).")
+    parser.add_argument('--rescan-interval', type=float, default=DEFAULT_RESCAN_INTERVAL,
+                        help="Seconds between full rescans with notifications (default: %(default)s).")
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE_SECONDS,
+                        help="Seconds a file must stay unchanged before it is processed (default: %(default)s).")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_WATCH_BATCH_SIZE,
+                        help="Settled files summarized together (default: %(default)s).")
+    parser.add_argument('--once', action='store_true',
+                        help="Place the files currently under the base path, then exit.")
+    parser.add_argument('--skip-existing', action='store_true',
+                        help="Only handle files that appear after the watcher starts.")
+    parser.add_argument('--dry-run', action='store_true', help="Print where files would go without moving them.")
+    parser.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                        help="Skip files and directories whose name or relative path matches GLOB (repeatable).")
+    parser.add_argument('--ocr', choices=['auto', 'always', 'never'], default='auto',
+                        help="OCR mode for new files, as in summarygenerator.py (default: %(default)s).")
+    parser.add_argument('--cache-file', default=DEFAULT_WATCH_CACHE_FILE,
+                        help="Summaries and embeddings of the files the watcher has seen (default: %(default)s).")
+    parser.add_argument('--summary-cache', default=summarygenerator.DEFAULT_CACHE_FILE,
+                        help="Cache of summarygenerator.py, reused for files it already processed "
+                             "(default: %(default)s).")
+    parser.add_argument('--organizer-journal', default=DEFAULT_JOURNAL_FILE,
+                        help="Journal of fileorganizer.py, to find the batch results of files it moved "
+                             "(default: %(default)s).")
+    parser.add_argument('--journal', default=DEFAULT_WATCH_JOURNAL_FILE,
+                        help="Journal of the watcher's moves; undo them with fileorganizer.py --rollback "
+                             "--journal (default: %(default)s).")
+    parser.add_argument('--metrics-file', default=None, metavar='FILE',
+                        help="Export the metrics in the Prometheus text format to FILE after every batch.")
+    parser.add_argument('--trace', default=None, metavar='FILE',
+                        help="Write one JSON-lines record per summarized batch, placement and move.")
+    args = parser.parse_args(argv)
+
+    if not args.base_path or not args.destination:
+        print("Error: set BASE_PATH and DESTINATION_ROOT (or pass --base-path and --destination).")
+        sys.exit(1)
+    if is_within(args.base_path, args.destination):
+        print("Error: the base path must not be inside the organized tree.")
+        sys.exit(1)
+    os.makedirs(args.destination, exist_ok=True)
+
+    use_ai = False
+    if args.backend != 'none':
+        backend = fileorganizer.create_backend(args)
+        if backend is not None:
+            fileorganizer.client = LLMClient(backend)
+            use_ai = True
+        else:
+            print("Files that fit no folder will be placed in the nearest one.")
+
+    metrics = Metrics('docwatcher')
+    if args.trace:
+        metrics.open_trace(args.trace)
+    options = {'ocr': args.ocr, 'excel_max_rows': summarygenerator.DEFAULT_EXCEL_MAX_ROWS,
+               'excel_max_cells': summarygenerator.DEFAULT_EXCEL_MAX_CELLS,
+               'max_pages': summarygenerator.DEFAULT_MAX_PAGES, 'max_chars': summarygenerator.DEFAULT_MAX_CHARS}
+    # Load the models up front, so the first file is not slowed down by it
+    print("Loading models...")
+    summarygenerator.warn_missing_ocr_dependencies()
+    summarygenerator.get_embed_model()
+    summarygenerator.ensure_nltk_data()
+
+    watcher = DocumentWatcher(args.base_path, args.destination, options,
+                              summarygenerator.DEFAULT_EXCLUDE_GLOBS + args.exclude, args.cache_file,
+                              args.summary_cache, args.organizer_journal, args.journal, args.min_similarity,
+                              use_ai, args.dry_run, args.batch_size, metrics)
+    watcher.pending.settle_seconds = args.settle
+    watcher.index_destination()
+    watcher.run(args.poll, args.poll_interval, args.rescan_interval, args.once, args.skip_existing,
+                args.metrics_file)
+
+    placed = metrics.total('end_to_end')
+    print(f"\nPlaced {metrics.counter('files_placed'):.0f} files ({metrics.counter('placed_by_similarity'):.0f} by "
+          f"similarity, {metrics.counter('placed_by_ai'):.0f} by the AI), indexed "
+          f"{metrics.counter('files_indexed'):.0f}, {metrics.counter('errors'):.0f} errors.")
+    if placed.count:
+        print(f"End-to-end latency per file: p50 {placed.quantile(0.5):.1f}s, p95 {placed.quantile(0.95):.1f}s, "
+              f"max {placed.max_seconds:.1f}s")
+    metrics.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import os
+import threading
+from typing import Callable, Dict, List, Optional
+import numpy as np
+
+# Near-duplicate search: random-hyperplane LSH with BANDS bands of BITS_PER_BAND bits. Documents
+# that share a band signature are compared with neighbors in their bucket (at most MAX_NEIGHBORS),
+# and pairs above the cosine threshold end up in the same version group.
+DEFAULT_NEAR_DUPLICATE_THRESHOLD = 0.95
+BANDS = 16
+BITS_PER_BAND = 14
+MAX_NEIGHBORS = 32
+PAIR_CHUNK = 65536
+
+
+class DuplicateIndex:
+    """Finds byte-identical files as they are registered, hashing only files whose size was seen before.
+
+    `check(file_path)` returns the first registered file with the same content, or None.
+    """
+
+    def __init__(self, hash_func: Callable[[str], str]):
+        self.hash_func = hash_func
+        self._by_size: Dict[int, List[str]] = {}
+        self._hashes: Dict[str, str] = {}
+        self._by_hash: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _hash(self, file_path: str) -> Optional[str]:
+        if file_path not in self._hashes:
+            try:
+                self._hashes[file_path] = self.hash_func(file_path)
+            except OSError:
+                return None
+            self._by_hash.setdefault(self._hashes[file_path], file_path)
+        return self._hashes[file_path]
+
+    def check(self, file_path: str) -> Optional[str]:
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            return None
+        with self._lock:
+            same_size = self._by_size.setdefault(size, [])
+            same_size.append(file_path)
+            if len(same_size) == 1:
+                return None
+            for earlier in same_size[:-1]:
+                self._hash(earlier)
+            digest = self._hash(file_path)
+            original = self._by_hash.get(digest) if digest else None
+            return original if original != file_path else None
+
+
+def find_near_duplicates(vectors: np.ndarray, threshold: float = DEFAULT_NEAR_DUPLICATE_THRESHOLD,
+                         seed: int = 0) -> np.ndarray:
+    """Groups rows whose cosine similarity is at least threshold, without comparing all pairs.
+
+    Returns a group id per row: the index of the group's first row, or -1 for rows without a
+    near-duplicate.
+    """
+    n = len(vectors)
+    groups = np.full(n, -1, dtype=np.int64)
+    if n < 2:
+        return groups
+    x = np.asarray(vectors, dtype=np.float32)
+    x = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+    planes = np.random.default_rng(seed).standard_normal((x.shape[1], BANDS * BITS_PER_BAND)).astype(np.float32)
+    weights = (1 << np.arange(BITS_PER_BAND, dtype=np.int64))
+
+    parent = np.arange(n)
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for start in range(0, BANDS * BITS_PER_BAND, BITS_PER_BAND):
+        keys = ((x @ planes[:, start:start + BITS_PER_BAND]) > 0).astype(np.int64) @ weights
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        # Candidate pairs: rows up to MAX_NEIGHBORS apart in the sorted order with the same signature
+        for offset in range(1, min(MAX_NEIGHBORS, n - 1) + 1):
+            same = np.nonzero(sorted_keys[offset:] == sorted_keys[:-offset])[0]
+            if not len(same):
+                break
+            left, right = order[same], order[same + offset]
+            for chunk in range(0, len(left), PAIR_CHUNK):
+                a, b = left[chunk:chunk + PAIR_CHUNK], right[chunk:chunk + PAIR_CHUNK]
+                similar = np.einsum('ij,ij->i', x[a], x[b]) >= threshold
+                for i, j in zip(a[similar].tolist(), b[similar].tolist()):
+                    root_i, root_j = find(i), find(j)
+                    if root_i != root_j:
+                        parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    roots = np.array([find(i) for i in range(n)])
+    counts = np.bincount(roots, minlength=n)
+    grouped = counts[roots] > 1
+    groups[grouped] = roots[grouped]
+    return groups
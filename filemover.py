@@ -0,0 +1,248 @@
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+from documentstore import JsonlWriter, iter_jsonl
+from metrics import Metrics
+
+# Append-only record of every directory created and file moved, used to resume or roll back a run
+DEFAULT_JOURNAL_FILE = 'move_journal.jsonl'
+
+# Moves run on this many threads; copies between devices use large read/write buffers
+DEFAULT_MOVE_WORKERS = 8
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+JOURNAL_CHECKPOINT_EVERY = 64
+
+
+class MoveResult:
+    """Counts of one mover run; `failures` holds (source, destination, error) for every failed move."""
+
+    def __init__(self):
+        self.dirs_ready = 0
+        self.moved = 0
+        self.already_done = 0
+        self.failures: List[Tuple[str, str, str]] = []
+        # Planned destinations that were taken (by the plan or on disk), by source: the name used instead
+        self.renamed: Dict[str, str] = {}
+
+
+def unique_destination(path: str, taken: Optional[Set[str]] = None) -> str:
+    """Returns path, or "name (n).ext" next to it if a file of that name already exists or the
+    name is in `taken` (destinations already given to other files); the result is added to taken."""
+    stem, ext = os.path.splitext(path)
+    candidate, n = path, 1
+    while os.path.exists(candidate) or (taken is not None and os.path.normcase(candidate) in taken):
+        candidate = f"{stem} ({n}){ext}"
+        n += 1
+    if taken is not None:
+        taken.add(os.path.normcase(candidate))
+    return candidate
+
+
+def copy_then_remove(src: str, dst: str) -> None:
+    """Moves a file across devices: reserves dst exclusively, copies under a temporary name, renames
+    the copy over the reservation, then deletes src."""
+    partial = f"{dst}.partial"
+    created = []
+    with open(src, 'rb') as f_src:
+        try:
+            with open(partial, 'wb') as f_dst:
+                created.append(partial)
+                # O_EXCL fails if dst exists, so a file that appeared since the plan is never overwritten
+                os.close(os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+                created.append(dst)
+                shutil.copyfileobj(f_src, f_dst, COPY_BUFFER_SIZE)
+            shutil.copystat(src, partial)
+            os.replace(partial, dst)
+        except BaseException:
+            # Leave neither the partial copy nor the empty reservation behind (e.g. on a full disk)
+            for path in created:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            raise
+    os.remove(src)
+
+
+def move_file(src: str, dst: str) -> None:
+    """Moves one file without ever overwriting dst: a hard link then unlink on the same device (the
+    link fails if dst exists), a buffered copy otherwise."""
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        if os.path.samefile(src, dst):
+            # A move interrupted between link and unlink: finish it
+            os.unlink(src)
+            return
+        raise FileExistsError(f"Destination already exists: '{dst}'")
+    except OSError:
+        # Another device, or a filesystem without hard links; fall back to copying
+        copy_then_remove(src, dst)
+        return
+    os.unlink(src)
+
+
+def load_journal(journal_path: str) -> Tuple[List[str], Dict[Tuple[str, str], str], Dict[Tuple[str, str], str]]:
+    """Reads a journal into created directories, the latest state of every move and of every undo."""
+    created_dirs: List[str] = []
+    moves: Dict[Tuple[str, str], str] = {}
+    undos: Dict[Tuple[str, str], str] = {}
+    for record in iter_jsonl(journal_path):
+        op = record['op']
+        if op == 'mkdir':
+            created_dirs.append(record['path'])
+        elif op == 'move':
+            moves[(record['src'], record['dst'])] = record['state']
+        elif op == 'undo':
+            undos[(record['src'], record['dst'])] = record['state']
+    return created_dirs, moves, undos
+
+
+def is_complete(src: str, dst: str) -> bool:
+    """True when a move has already happened, even if the journal did not record it before a crash."""
+    return not os.path.exists(src) and os.path.exists(dst)
+
+
+class FileMover:
+    """Creates directories and moves files in parallel, journaling every step.
+
+    The journal first lists all planned moves, then records each one as done or failed, so an
+    interrupted run can be resumed (resume) or undone (rollback) from the journal alone.
+    """
+
+    def __init__(self, journal_path: str = DEFAULT_JOURNAL_FILE, workers: int = DEFAULT_MOVE_WORKERS,
+                 metrics: Optional[Metrics] = None):
+        self.journal_path = journal_path
+        self.workers = max(1, workers)
+        # When given, every move and undo is recorded as a span named after its journal op
+        self.metrics = metrics
+        self._journal: Optional[JsonlWriter] = None
+        self._lock = threading.Lock()
+
+    def unfinished_moves(self) -> int:
+        """Number of planned moves in the existing journal that are neither done nor failed."""
+        if not os.path.exists(self.journal_path):
+            return 0
+        _, moves, _ = load_journal(self.journal_path)
+        return sum(1 for state in moves.values() if state == 'planned')
+
+    def _log(self, record: Dict) -> None:
+        with self._lock:
+            self._journal.write(record)
+
+    def _create_directories(self, directories: List[str], result: MoveResult) -> None:
+        for directory in sorted(set(directories)):
+            try:
+                # Record every missing ancestor so a rollback can remove exactly what was created
+                missing = []
+                parent = os.path.abspath(directory)
+                while not os.path.isdir(parent):
+                    missing.append(parent)
+                    parent = os.path.dirname(parent)
+                os.makedirs(directory, exist_ok=True)
+                for path in reversed(missing):
+                    self._log({'op': 'mkdir', 'path': path})
+                result.dirs_ready += 1
+            except OSError as e:
+                print(f"[ERROR] Could not create directory '{directory}'. Error: {e}")
+
+    def _run_moves(self, moves: List[Tuple[str, str]], op: str, result: MoveResult) -> None:
+        def run(move):
+            src, dst = move
+            start_time = time.perf_counter()
+            size = os.path.getsize(src) if self.metrics is not None and os.path.isfile(src) else None
+            error = None
+            try:
+                move_file(src, dst)
+                self._log({'op': op, 'src': src, 'dst': dst, 'state': 'done'})
+            except Exception as e:
+                error = str(e)
+                self._log({'op': op, 'src': src, 'dst': dst, 'state': 'failed', 'error': error})
+            if self.metrics is not None:
+                self.metrics.observe(op, time.perf_counter() - start_time, src, size,
+                                     error='true' if error is not None else None)
+            return move, error
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for (src, dst), error in executor.map(run, moves):
+                if error is None:
+                    result.moved += 1
+                else:
+                    result.failures.append((src, dst, error))
+
+    def run(self, directories: List[str], moves: List[Tuple[str, str]], append: bool = False) -> MoveResult:
+        """Starts a new journal (or, with append, adds to the existing one), creates all directories
+        in one pass, then moves the files."""
+        result = MoveResult()
+        # Moves run in parallel, so every destination must be distinct before they start
+        taken: Set[str] = set()
+        unique_moves = []
+        for src, dst in moves:
+            unique = unique_destination(dst, taken)
+            if unique != dst:
+                result.renamed[src] = unique
+            unique_moves.append((src, unique))
+        moves = unique_moves
+        self._journal = JsonlWriter(self.journal_path, append=append, checkpoint_every=JOURNAL_CHECKPOINT_EVERY)
+        try:
+            self._create_directories(directories, result)
+            for src, dst in moves:
+                self._journal.write({'op': 'move', 'src': src, 'dst': dst, 'state': 'planned'})
+            self._journal.checkpoint()
+            self._run_moves(moves, 'move', result)
+        finally:
+            self._journal.close()
+        return result
+
+    def resume(self) -> MoveResult:
+        """Finishes the moves an interrupted run left in the journal."""
+        result = MoveResult()
+        _, moves, _ = load_journal(self.journal_path)
+        pending = []
+        for (src, dst), state in moves.items():
+            if state == 'done' or is_complete(src, dst):
+                result.already_done += 1
+            else:
+                pending.append((src, dst))
+        self._journal = JsonlWriter(self.journal_path, append=True, checkpoint_every=JOURNAL_CHECKPOINT_EVERY)
+        try:
+            for src, dst in pending:
+                if os.path.exists(f"{dst}.partial"):
+                    # An interrupted copy: drop the partial copy and the empty reservation of dst
+                    os.remove(f"{dst}.partial")
+                    if os.path.exists(dst) and os.path.getsize(dst) == 0:
+                        os.remove(dst)
+            self._create_directories([os.path.dirname(dst) for _, dst in pending], result)
+            self._run_moves(pending, 'move', result)
+        finally:
+            self._journal.close()
+        return result
+
+    def rollback(self) -> MoveResult:
+        """Moves every journaled file back to its source and removes the directories the run created."""
+        result = MoveResult()
+        created_dirs, moves, undos = load_journal(self.journal_path)
+        pending = []
+        for (src, dst), state in moves.items():
+            if undos.get((dst, src)) == 'done':
+                result.already_done += 1
+            elif state == 'done' or (state == 'planned' and is_complete(src, dst)):
+                # Only files this run moved; a failed move may have found someone else's file at dst
+                pending.append((dst, src))
+        self._journal = JsonlWriter(self.journal_path, append=True, checkpoint_every=JOURNAL_CHECKPOINT_EVERY)
+        try:
+            self._create_directories([os.path.dirname(src) for _, src in pending], result)
+            self._run_moves(pending, 'undo', result)
+            for path in sorted(set(created_dirs), key=len, reverse=True):
+                try:
+                    os.rmdir(path)
+                    self._log({'op': 'rmdir', 'path': path})
+                except OSError:
+                    # Not empty (other files were added) or already removed
+                    pass
+        finally:
+            self._journal.close()
+        return result
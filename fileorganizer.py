@@ -1,24 +1,31 @@
 import json
 import os
-import shutil
-import google.generativeai as genai
+import argparse
+import re
 import time
-from collections import defaultdict
+import hashlib
+from collections import Counter, defaultdict
 from dotenv import load_dotenv
 from pathlib import Path
+from documentstore import iter_jsonl, load_records, load_embeddings, get_record_embedding, EMBEDDINGS_FILE
+from localplanner import plan_local, DEFAULT_FOLDER_SIZE
+from filemover import FileMover, DEFAULT_JOURNAL_FILE, DEFAULT_MOVE_WORKERS
+from metrics import Metrics
+from planparser import PlanStreamParser, parse_plan_response
+from llmclient import (LLMClient, GeminiBackend, StubBackend, RecordReplayBackend, ResponseCache,
+                       PromptTooLargeError, UsageTracker, save_usage, DEFAULT_MAX_PROMPT_TOKENS, DEFAULT_USAGE_FILE,
+                       DEFAULT_CONCURRENCY, DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE,
+                       DEFAULT_TIMEOUT_SECONDS, DEFAULT_MAX_RETRIES, DEFAULT_MODEL_NAME, DEFAULT_CACHE_DIR,
+                       DEFAULT_CACHE_TTL_SECONDS, DEFAULT_CACHE_MAX_BYTES, DEFAULT_RECORDINGS_FILE)
 
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")  # No default, as API key is required
-DESTINATION_ROOT = Path(os.getenv("DESTINATION_ROOT"))
+DESTINATION_ROOT = Path(os.getenv("DESTINATION_ROOT")) if os.getenv("DESTINATION_ROOT") else None
 
 # --- Configuration ---
-api_key = os.getenv("GOOGLE_API_KEY")
-if not api_key:
-    print("Error: GOOGLE_API_KEY environment variable not set.")
-    exit()
-
-genai.configure(api_key=api_key)
-model = genai.GenerativeModel('gemini-2.5-flash')
+# All requests go through the client (model backend, response cache, rate limits and retries).
+# It is created from the command-line options in __main__; library callers assign their own.
+client = None
 
 #DESTINATION_ROOT = '#TheDirectyWhereYouWantToPerformAction#' #eg. C:\\Users\\Goku\\OrganizedDocuments
 #DESTINATION_ROOT = os.environ.get('DESTINATION_ROOT', 'C:\\Users\\support2\\OrganizedDocuments1')
@@ -26,58 +33,255 @@ model = genai.GenerativeModel('gemini-2.5-flash')
 #raw_dest = os.getenv('DESTINATION_ROOT', 'C:\\Users\\support2\\OrganizedDocuments1')
 #DESTINATION_ROOT = os.getenv('DESTINATION_ROOT', 'C:\\Users\\support2\\OrganizedDocuments1')  #raw_dest.replace('\\', '\\\\')
 
-# KPI tracking variables
+# Clustered planning: documents are grouped by embedding into clusters of at most this many files,
+# each cluster is planned by its own request and a final request merges the cluster plans
+DEFAULT_CLUSTER_SIZE = 150
+ANALYSIS_SAMPLES_PER_CLUSTER = 3
+
+# Prompt encoding: documents are listed under their directory (relative to the common root) with a
+# short ID, and each summary is trimmed to about this many tokens
+DEFAULT_SUMMARY_TOKENS = 60
+MIN_ID_LENGTH = 4
+
+# KPI tracking: counters, gauges and per-stage timing spans of this run
+DEFAULT_KPI_FILE = 'fileorganizerkpi.json'
 start_time = time.time()
-files_moved = 0
-total_files_in_plan = 0
-dirs_created = 0
-total_dirs_in_plan = 0
-valid_path_mappings = 0
-total_filenames_in_plan = 0
-errors_encountered = 0
-json_load_success = False
-ai_plan_valid = False
-api_response_time = 0.0
-tokens_used = 0
+metrics = Metrics('fileorganizer')
 
 # --- Main Functions ---
 
-def load_document_data(filepath='llm_input.json'):
-    """Loads the document metadata from the specified JSON file."""
-    global json_load_success, errors_encountered
+def load_document_data(filepath='llm_input.json', lazy=False):
+    """Loads the document metadata from the specified JSON or streamed JSON-lines (.jsonl) file.
+
+    With lazy=True a .jsonl file is returned as an iterator that reads one record at a time.
+    """
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            json_load_success = True
-            return json.load(f)
+        if lazy and filepath.endswith('.jsonl'):
+            if not os.path.exists(filepath):
+                raise FileNotFoundError(filepath)
+            records = iter_jsonl(filepath)
+        else:
+            records = load_records(filepath)
+        metrics.set('input_file_loaded', 1)
+        return records
     except FileNotFoundError:
         print(f"Error: Input file '{filepath}' not found.")
-        errors_encountered += 1
+        metrics.count('errors')
         return None
     except json.JSONDecodeError:
         print(f"Error: Could not decode JSON from '{filepath}'.")
-        errors_encountered += 1
+        metrics.count('errors')
         return None
 
+def assign_document_ids(document_data):
+    """Gives every document a short ID derived from its path, stored in doc['id'].
+
+    IDs are the shortest hash prefixes (at least MIN_ID_LENGTH characters) that are unique within
+    the documents, so they stay the same across runs over the same files.
+    """
+    hashes = {doc['file_path']: hashlib.sha1(doc['file_path'].encode('utf-8')).hexdigest() for doc in document_data}
+    length = MIN_ID_LENGTH
+    while len({digest[:length] for digest in hashes.values()}) < len(hashes):
+        length += 1
+    for doc in document_data:
+        doc['id'] = hashes[doc['file_path']][:length]
+    return document_data
+
 def create_file_path_map(document_data):
-    """Creates a simple mapping from filename to its full original path."""
-    path_map = {}
+    """Creates a mapping from each document's short ID to its full original path."""
+    if any('id' not in doc for doc in document_data):
+        assign_document_ids(document_data)
+    return {doc['id']: doc['file_path'] for doc in document_data}
+
+def trim_summary(summary, max_tokens=DEFAULT_SUMMARY_TOKENS):
+    """Shortens a summary to about max_tokens tokens (four characters each), ending at a word boundary."""
+    summary = " ".join((summary or "").split())
+    max_chars = max_tokens * 4
+    if len(summary) <= max_chars:
+        return summary
+    return summary[:max_chars].rsplit(' ', 1)[0] + "..."
+
+def encode_documents(document_data, summary_tokens=DEFAULT_SUMMARY_TOKENS, include_root=True):
+    """Lists documents compactly for a prompt: the common root once, then each directory once with
+    its files as "[id] name: summary" lines."""
+    if any('id' not in doc for doc in document_data):
+        assign_document_ids(document_data)
+    directories = defaultdict(list)
+    for doc in document_data:
+        directories[os.path.dirname(doc['file_path'])].append(doc)
+    try:
+        root = os.path.commonpath(list(directories)) if directories else ''
+    except ValueError:
+        # Paths on different drives
+        root = ''
+
+    lines = [f"Root: {root}"] if include_root and root else []
+    for directory in sorted(directories):
+        relative = os.path.relpath(directory, root) if root else directory
+        lines.append((relative.replace(os.sep, '/') if relative != '.' else '.') + '/')
+        for doc in sorted(directories[directory], key=lambda doc: doc['file_path']):
+            summary = trim_summary(doc.get('summary'), summary_tokens)
+            lines.append(f"  [{doc['id']}] {os.path.basename(doc['file_path'])}: {summary}")
+    return "\n".join(lines)
+
+def resolve_plan_ids(plan, path_map, report=True):
+    """Keeps the IDs of a plan that belong to known documents, each only once; unknown IDs are reported
+    unless report=False."""
+    resolved, seen = {}, set()
+    for directory, ids in plan.items():
+        if not isinstance(ids, list):
+            continue
+        kept = []
+        for doc_id in ids:
+            doc_id = str(doc_id).strip().strip('[]')
+            if doc_id not in path_map:
+                if report:
+                    print(f"  [WARN] The plan refers to unknown document ID '{doc_id}'. Skipping.")
+                    metrics.count('errors')
+            elif doc_id not in seen:
+                seen.add(doc_id)
+                kept.append(doc_id)
+        if kept:
+            resolved[directory.strip('/')] = kept
+    return resolved
+
+def version_representatives(document_data):
+    """Keeps the first document of every version group (copies and versions tagged by summarygenerator.py),
+    so the AI plans each group once; colocate_version_groups places the other members."""
+    seen = set()
+    representatives = []
+    for doc in document_data:
+        group = doc.get('version_group')
+        if group is None or group not in seen:
+            seen.add(group)
+            representatives.append(doc)
+    return representatives
+
+def colocate_version_groups(plan, document_data):
+    """Puts all members of a version group in the plan folder that holds most of them.
+
+    Members the plan left out are added to that folder. Copies usually share their file name, so the
+    folder's files are named with destination_names, which numbers the repeated names. Returns the new
+    plan and the number of documents that were moved or added.
+    """
+    groups = defaultdict(list)
     for doc in document_data:
-        filename = os.path.basename(doc['file_path'])
-        path_map[filename] = doc['file_path']
-    return path_map
+        if doc.get('version_group') is not None:
+            groups[doc['version_group']].append(doc['id'])
+    location = {doc_id: directory for directory, ids in plan.items() for doc_id in ids}
+    changed = 0
+    for members in groups.values():
+        placed = Counter(location[doc_id] for doc_id in members if doc_id in location)
+        if not placed:
+            continue
+        target = placed.most_common(1)[0][0]
+        for doc_id in members:
+            if location.get(doc_id) != target:
+                location[doc_id] = target
+                changed += 1
+    if not changed:
+        return plan, 0
+
+    colocated = {directory: [] for directory in plan}
+    for ids in plan.values():
+        for doc_id in ids:
+            colocated[location.pop(doc_id)].append(doc_id)
+    # Whatever is left in location are the members the plan did not include
+    for doc_id, directory in location.items():
+        colocated[directory].append(doc_id)
+    return {directory: ids for directory, ids in colocated.items() if ids}, changed
+
+def default_documents_file():
+    """Returns processed_documents.json, or the streamed processed_documents.jsonl if only that one exists."""
+    if not os.path.exists('processed_documents.json') and os.path.exists('processed_documents.jsonl'):
+        return 'processed_documents.jsonl'
+    return 'processed_documents.json'
+
+def load_document_embeddings(document_data, documents_file, embeddings_file=EMBEDDINGS_FILE):
+    """Returns {file_path: embedding} for the documents, read from summarygenerator.py's output.
+
+    Embeddings come from the .npy matrix (embedding_row) or inline 'embedding' lists; documents
+    without one are simply missing from the result.
+    """
+    if not os.path.exists(documents_file):
+        print(f"Warning: '{documents_file}' not found, clustering documents without embeddings.")
+        return {}
+    wanted = {doc['file_path'] for doc in document_data}
+    embeddings = load_embeddings(embeddings_file) if os.path.exists(embeddings_file) else None
+    records = iter_jsonl(documents_file) if documents_file.endswith('.jsonl') else load_document_data(documents_file)
+    vectors = {}
+    for record in records or []:
+        if record['file_path'] not in wanted:
+            continue
+        if embeddings is not None and record.get('embedding_row') is not None \
+                and record['embedding_row'] >= len(embeddings):
+            continue
+        vector = get_record_embedding(record, embeddings)
+        if vector is not None:
+            vectors[record['file_path']] = vector
+    return vectors
+
+def split_cluster(vectors, indices, max_cluster_size, seed=0):
+    """Recursively splits rows of vectors with k-means until no cluster has more than max_cluster_size."""
+    from sklearn.cluster import MiniBatchKMeans
+    if len(indices) <= max_cluster_size:
+        return [indices]
+    n_clusters = min(32, -(-len(indices) // max_cluster_size))
+    labels = MiniBatchKMeans(n_clusters=n_clusters, random_state=seed, n_init=3,
+                             batch_size=1024).fit_predict(vectors[indices])
+    groups = [indices[labels == label] for label in range(n_clusters)]
+    groups = [group for group in groups if len(group)]
+    if len(groups) == 1:
+        # Identical vectors cannot be separated; fall back to fixed-size chunks
+        return [indices[i:i + max_cluster_size] for i in range(0, len(indices), max_cluster_size)]
+    clusters = []
+    for group in groups:
+        clusters.extend(split_cluster(vectors, group, max_cluster_size, seed))
+    return clusters
+
+def cluster_documents(document_data, document_vectors, max_cluster_size=DEFAULT_CLUSTER_SIZE):
+    """Groups documents into clusters of similar content, each with at most max_cluster_size documents.
+
+    Documents without an embedding are kept in input order and chunked into their own clusters.
+    """
+    embedded = [doc for doc in document_data if doc['file_path'] in document_vectors]
+    missing = [doc for doc in document_data if doc['file_path'] not in document_vectors]
+    clusters = []
+    if embedded:
+        import numpy as np
+        vectors = np.stack([np.asarray(document_vectors[doc['file_path']], dtype=np.float32) for doc in embedded])
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        for indices in split_cluster(vectors, np.arange(len(embedded)), max_cluster_size):
+            clusters.append([embedded[i] for i in indices])
+    for i in range(0, len(missing), max_cluster_size):
+        clusters.append(missing[i:i + max_cluster_size])
+    return clusters
+
+def sample_documents_for_analysis(clusters, per_cluster=ANALYSIS_SAMPLES_PER_CLUSTER):
+    """Picks a few documents from every cluster, so the structure analysis prompt stays small."""
+    return [doc for cluster in clusters for doc in cluster[:per_cluster]]
+
+def call_model(prompt, phase, on_text=None):
+    """Sends one prompt to the AI, tracking response time, and returns the text.
+
+    Safe to call from several threads; rate limits, retries, the prompt budget and token usage
+    (recorded under `phase`) are handled by the client. With on_text the response is streamed to it.
+    """
+    with metrics.span('api_call', phase=phase):
+        return client.generate(prompt, phase, on_text).strip()
+
+def parse_json_response(response_text):
+    """Parses a JSON object from an AI response, ignoring markdown code fences."""
+    return json.loads(response_text.replace('```json', '').replace('```', '').strip())
 
 def get_current_structure_analysis_from_ai(document_data):
     """Sends document info to the AI and requests an analysis of the current file structure."""
-    global errors_encountered, api_response_time, tokens_used
-    documents_str = "\n".join([
-        f"- File Path: {doc['file_path']}\n  Type: {doc.get('type', 'N/A')}\n  Summary: {doc['summary']}\n"
-        for doc in document_data
-    ])
+    documents_str = encode_documents(document_data)
 
     prompt = f"""
-    You are an expert file organization assistant. Your task is to analyze the current file structure based on the provided file paths, types, and summaries, explain why the existing placement and structure may not be the best optimized, and convince the user that a new organization would be beneficial.
+    You are an expert file organization assistant. Your task is to analyze the current file structure based on the provided directories, file names, and summaries, explain why the existing placement and structure may not be the best optimized, and convince the user that a new organization would be beneficial.
 
-    **File Information:**
+    **File Information (files listed under their directory, relative to the root; summaries may be shortened):**
     {documents_str}
 
     **Instructions:**
@@ -92,170 +296,649 @@ def get_current_structure_analysis_from_ai(document_data):
 
     print("Asking the AI to analyze the current file structure... (This may take a moment)")
     try:
-        start_api_time = time.time()
-        response = model.generate_content(prompt)
-        api_response_time += time.time() - start_api_time
-        response_text = response.text.strip()
-
-        # Estimate tokens
-        input_tokens = len(prompt) // 4
-        output_tokens = len(response_text) // 4
-        tokens_used += input_tokens + output_tokens
-        return response_text
+        return call_model(prompt, 'analysis')
+    except PromptTooLargeError as e:
+        if len(document_data) < 2:
+            print(f"Error: {e}")
+            metrics.count('errors')
+            return None
+        # The analysis only needs a representative sample; retry with every other document
+        print(f"{e} Analyzing a sample of {len(document_data[::2])} documents instead.")
+        return get_current_structure_analysis_from_ai(document_data[::2])
     except Exception as e:
         print(f"\n--- Error ---")
         print(f"Failed to get a valid response from the AI. Error: {e}")
-        print("AI's raw response was:")
-        print(response.text if 'response' in locals() else "No response")
-        errors_encountered += 1
+        metrics.count('errors')
         return None
 
-def get_organization_plan_from_ai(document_data, current_analysis):
-    """Sends document info and previous analysis to the AI and requests a file organization plan with a file tree."""
-    global ai_plan_valid, errors_encountered, api_response_time, tokens_used
-    documents_str = "\n".join([
-        f"- File: {os.path.basename(doc['file_path'])}\n  Summary: {doc['summary']}\n"
-        for doc in document_data
-    ])
+def stream_plan_response(prompt, phase):
+    """Streams a plan response, showing each directory as soon as its file list is complete, then
+    the reasoning as it arrives. Returns the PlanParseResult.
+
+    The file tree is shown once by review_and_apply_plan, after missing files are placed and
+    version groups are co-located.
+    """
+    parser = PlanStreamParser()
+    shown = {'reasoning': False}
+
+    def show(text):
+        for directory, doc_ids in parser.feed(text):
+            print(f"  [PLAN] {directory} ({len(doc_ids)} files)", flush=True)
+        reasoning = parser.reasoning_delta()
+        if reasoning:
+            if not shown['reasoning']:
+                shown['reasoning'] = True
+                print("\nReasoning for Organization Plan:")
+            print(reasoning, end='', flush=True)
+
+    call_model(prompt, phase, show)
+    print()
+    result = parser.finish()
+    if not shown['reasoning']:
+        print("\nReasoning for Organization Plan:")
+        print(result.reasoning or "The AI did not explain this plan.")
+    return result
+
+def get_missing_placements_from_ai(missing_docs, plan, current_analysis):
+    """Asks the AI where to put files a plan left out, preferring the plan's directories.
+
+    Only the missing files and the directory names are sent. Returns {directory: [file IDs]}.
+    """
+    documents_str = encode_documents(missing_docs)
+    directories_str = "\n".join(f"- {directory}" for directory in plan)
 
     prompt = f"""
-    You are an expert file organization assistant. Based on the following analysis of the current file structure, your task is to organize the files listed below into a logical folder structure and provide a JSON plan, an ASCII file tree representation, and a reasoning section explaining the organization.
+    You are an expert file organization assistant. A folder structure was proposed for a collection of files, but the files below were left out of it. Place each of them.
+
+    **Analysis of the Current Structure:**
+    {current_analysis}
+
+    **Existing Directories:**
+    {directories_str}
+
+    **File Information (each file is "[ID] name: summary", listed under its current directory):**
+    {documents_str}
+
+    **Instructions:**
+    Respond ONLY with a JSON object where each key is a directory path (prefer the existing directories above; use forward slashes) and each value is the list of file IDs (e.g. ["3f2a", "b71c"]) to move into it. Use the IDs exactly as given and include every file exactly once. Do not include any other text.
+    """
+
+    print(f"Asking the AI to place {len(missing_docs)} files the plan left out...")
+    return parse_plan_response(call_model(prompt, 'missing')).plan
+
+def complete_plan(plan, document_data, path_map, current_analysis):
+    """Re-requests placements for the documents a (possibly cut off) plan does not contain."""
+    planned = {doc_id for doc_ids in plan.values() for doc_id in doc_ids}
+    missing_docs = [doc for doc in document_data if doc['id'] not in planned]
+    if not missing_docs:
+        return plan
+    try:
+        placements = resolve_plan_ids(get_missing_placements_from_ai(missing_docs, plan, current_analysis),
+                                      {doc['id']: path_map[doc['id']] for doc in missing_docs})
+    except Exception as e:
+        print(f"  [ERROR] Failed to place the {len(missing_docs)} missing files, they stay where they are. "
+              f"Error: {e}")
+        metrics.count('errors')
+        return plan
+    plan = {directory: list(doc_ids) for directory, doc_ids in plan.items()}
+    for directory, doc_ids in placements.items():
+        plan.setdefault(directory, []).extend(doc_ids)
+    metrics.count('missing_files_placed', sum(len(doc_ids) for doc_ids in placements.values()))
+    return plan
+
+def get_organization_plan_from_ai(document_data, current_analysis, path_map=None, stream=False):
+    """Sends document info and previous analysis to the AI and requests a file organization plan.
+
+    The AI answers with document IDs, which are checked against path_map; the file tree is drawn
+    locally from the plan, so the AI does not spend output tokens on it. The response is parsed
+    tolerantly: a plan that was cut off keeps its complete entries, and the files missing from it
+    are placed with a second, smaller request. With stream=True the plan is shown as it arrives.
+    """
+    path_map = path_map or create_file_path_map(document_data)
+    documents_str = encode_documents(document_data)
+
+    prompt = f"""
+    You are an expert file organization assistant. Based on the following analysis of the current file structure, your task is to organize the files listed below into a logical folder structure and provide a JSON plan and a reasoning section explaining the organization.
 
     **Previous Analysis of Current Structure:**
     {current_analysis}
 
-    **File Information:**
+    **File Information (each file is "[ID] name: summary", listed under its current directory):**
     {documents_str}
 
     **Instructions:**
-    Respond ONLY with a single output containing three sections, separated clearly. Do not include any additional text, explanations, or markdown formatting outside the specified structure.DONOT CHANGE THE NAME OF FILES KEEP THEM AS IT IS
+    Respond ONLY with a single output containing two sections, separated clearly. Do not include any additional text, explanations, or markdown formatting outside the specified structure.
 
     1. **JSON Plan**:
        - A JSON object where each key is the proposed new directory path (e.g., "Case_Studies/2020_Grimmen_Vegetation").
-       - Each value is a list of filenames (e.g., ["Case Study_Cutting Vegetation_2020.docx", "Fassade nach Cutting.png"]) to be moved into that directory.
+       - Each value is the list of file IDs (e.g., ["3f2a", "b71c"]) to be moved into that directory. Use the IDs exactly as given, not file names.
        - Use forward slashes (/) for directory paths.
        - Ensure the plan addresses issues identified in the previous analysis.
 
-    2. **ASCII File Tree**:
+    2. **Reasoning**:
        - After the JSON, include a line with exactly "-----" to separate sections.
-       - Provide an ASCII file tree representation of the same structure, listing all directories and files.
-       - Use ├── for branches, └── for the last item in a directory, and │   for vertical alignment.
-       - Indent subdirectories and files appropriately (e.g., two spaces per level).
-
-    3. **Reasoning**:
-       - After the file tree, include another line with exactly "-----" to separate sections.
        - Provide a concise explanation (100-200 words) of why this organization plan was chosen, how it addresses the issues in the previous analysis, and why it is logical based on the file summaries. Focus on the grouping criteria (e.g., project, year, topic).
 
     **Output Format**:
     ```json
     {{
-      "Case_Studies/2018_Cadolzburg": [
-        "Case Study_Cadolzburg_v1.docx",
-        "ZAE_Modulliste.pdf"
-      ],
+      "Case_Studies/2018_Cadolzburg": ["3f2a", "b71c"],
       ...
     }}
     -----
-    Case_Studies/
-      ├── 2018_Cadolzburg/
-      │   ├── Case Study_Cadolzburg_v1.docx
-      │   └── ZAE_Modulliste.pdf
-      ...
-    -----
     The files are organized by project and year to address the scattered structure identified in the analysis. ...
     ```
 
-    Ensure all files from the input are included in both the JSON and the file tree, with consistent directory structures, and that the reasoning aligns with the chosen organization and the previous analysis.
+    Ensure every file ID from the input appears exactly once in the JSON plan.
     """
 
-    print("Asking the AI to generate an organization plan, file tree, and reasoning... (This may take a moment)")
+    print("Asking the AI to generate an organization plan and reasoning... (This may take a moment)")
+    response_text = None
     try:
-        start_api_time = time.time()
-        response = model.generate_content(prompt)
-        api_response_time += time.time() - start_api_time
-        response_text = response.text.strip().replace('```json', '').replace('```', '')
-
-        # Split the response into JSON, file tree, and reasoning
-        parts = response_text.split('-----', 2)
-        if len(parts) != 3:
-            raise ValueError("Invalid response format: Expected three sections separated by '-----'.")
-        json_part, file_tree, reasoning = [part.strip() for part in parts]
-
-        # Parse the JSON plan
-        plan = json.loads(json_part)
-        ai_plan_valid = True
-        # Estimate tokens
-        input_tokens = len(prompt) // 4
-        output_tokens = len(response_text) // 4
-        tokens_used += input_tokens + output_tokens
+        if stream:
+            result = stream_plan_response(prompt, 'plan')
+        else:
+            response_text = call_model(prompt, 'plan')
+            result = parse_plan_response(response_text)
+        if not result.plan:
+            raise ValueError("The response contains no plan entries.")
+        if not result.complete:
+            print(f"  [WARN] The plan was cut off after {len(result.plan)} directories; keeping the complete entries.")
+        if result.repairs:
+            metrics.count('plan_repairs', result.repairs)
+
+        # Map the IDs back to documents and place the files the plan left out
+        plan = complete_plan(resolve_plan_ids(result.plan, path_map), document_data, path_map, current_analysis)
+        metrics.set('ai_plan_valid', int(bool(plan)))
+        reasoning = result.reasoning or "The AI did not explain this plan."
+        return plan, render_file_tree(plan, path_map), reasoning
+    except PromptTooLargeError as e:
+        # Too many documents for one request: plan them in clusters instead
+        print(f"{e} Planning the documents in clusters instead.")
+        clusters = cluster_documents(document_data, {}, max(1, len(document_data) // 2))
+        plan, file_tree, reasoning = get_clustered_organization_plan(clusters, current_analysis, path_map)
+        if stream and reasoning:
+            # In streaming mode the caller expects the reasoning to be shown already
+            print("\nReasoning for Organization Plan:")
+            print(reasoning)
         return plan, file_tree, reasoning
     except (json.JSONDecodeError, Exception) as e:
         print(f"\n--- Error ---")
         print(f"Failed to get a valid response from the AI. Error: {e}")
         print("AI's raw response was:")
-        print(response.text)
-        errors_encountered += 1
+        print(response_text if response_text is not None else "No response")
+        metrics.count('errors')
         return None, None, None
 
-def execute_file_organization(plan, path_map, destination_root):
-    """Creates directories and moves files based on the provided plan."""
-    global files_moved, total_files_in_plan, dirs_created, total_dirs_in_plan
-    global valid_path_mappings, total_filenames_in_plan, errors_encountered
+def get_cluster_plan_from_ai(cluster_docs, current_analysis):
+    """Asks the AI to organize one cluster of related documents; returns {directory: [file IDs]} or None."""
+    documents_str = encode_documents(cluster_docs)
+
+    prompt = f"""
+    You are an expert file organization assistant. The files below are one group of related documents taken from a larger collection. Organize them into a logical folder structure.
+
+    **Analysis of the Current Structure of the Whole Collection:**
+    {current_analysis}
+
+    **File Information (each file is "[ID] name: summary", listed under its current directory):**
+    {documents_str}
+
+    **Instructions:**
+    Respond ONLY with a JSON object where each key is a proposed directory path (use forward slashes, e.g. "Case_Studies/2020_Grimmen_Vegetation") and each value is the list of file IDs (e.g. ["3f2a", "b71c"]) to move into it. Use the IDs exactly as given and include every file exactly once. Do not include any other text.
+    """
+
+    try:
+        plan = parse_plan_response(call_model(prompt, 'cluster_plan')).plan
+        if not plan:
+            raise ValueError("Expected a JSON object of directories.")
+        return plan
+    except PromptTooLargeError as e:
+        if len(cluster_docs) < 2:
+            print(f"  [ERROR] {e}")
+            metrics.count('errors')
+            return None
+        # Split the cluster in half and combine the two plans
+        half = len(cluster_docs) // 2
+        plan = defaultdict(list)
+        for part in (cluster_docs[:half], cluster_docs[half:]):
+            for directory, doc_ids in (get_cluster_plan_from_ai(part, current_analysis) or {}).items():
+                if isinstance(doc_ids, list):
+                    plan[directory].extend(doc_ids)
+        return dict(plan) or None
+    except Exception as e:
+        print(f"  [ERROR] Failed to get a plan for a cluster of {len(cluster_docs)} files. Error: {e}")
+        metrics.count('errors')
+        return None
+
+def merge_cluster_plans_from_ai(cluster_plans, current_analysis):
+    """Asks the AI to merge per-cluster directories into one tree.
+
+    Only directory names and file counts are sent, so the request stays small for any corpus size.
+    Returns the merged plan and the reasoning; if the merge fails the cluster plans are combined as-is.
+    """
+    directories = {}
+    for cluster_id, plan in enumerate(cluster_plans):
+        for directory, doc_ids in plan.items():
+            directories[f"c{cluster_id}:{directory}"] = (directory, doc_ids)
+    directories_str = "\n".join(f"- {key} ({len(doc_ids)} files)" for key, (_, doc_ids) in directories.items())
+
+    prompt = f"""
+    You are an expert file organization assistant. A large collection of files was split into groups of related documents and each group was organized separately. Merge the proposed directories below into one consistent folder structure: combine directories with the same purpose, use consistent naming, and nest them under shared top-level folders where it makes sense.
+
+    **Analysis of the Current Structure:**
+    {current_analysis}
+
+    **Proposed Directories (group id:directory path, file count):**
+    {directories_str}
+
+    **Instructions:**
+    Respond ONLY with two sections separated by a line with exactly "-----":
+    1. A JSON object mapping every key above (e.g. "c0:Invoices/2021") to its final directory path, using forward slashes.
+    2. A concise explanation (100-200 words) of the final organization and its grouping criteria.
+    """
+
+    mapping, reasoning = {}, ""
+    print(f"Asking the AI to merge {len(directories)} directories from {len(cluster_plans)} clusters...")
+    try:
+        parts = call_model(prompt, 'merge').split('-----', 1)
+        mapping = parse_json_response(parts[0])
+        reasoning = parts[1].strip() if len(parts) > 1 else ""
+    except Exception as e:
+        print(f"  [ERROR] Failed to merge the cluster plans, keeping them as proposed. Error: {e}")
+        metrics.count('errors')
+        reasoning = "The cluster plans could not be merged, so each group's directories are kept as proposed."
+
+    plan = defaultdict(list)
+    for key, (directory, doc_ids) in directories.items():
+        target = mapping.get(key) if isinstance(mapping, dict) else None
+        plan[(target or directory).strip('/')].extend(doc_ids)
+    return dict(plan), reasoning
+
+def get_placement_from_ai(document, candidates):
+    """Asks the AI which folder of an already organized tree a new file belongs in.
+
+    candidates are (directory, similarity) pairs, most similar first. Returns a directory path,
+    which may be a new folder, or None if the answer is unusable.
+    """
+    candidates_str = "\n".join(f"- {directory} (similarity {similarity:.2f})" for directory, similarity in candidates)
+    prompt = f"""
+    You are an expert file organization assistant. A new file was added to a collection that is already organized into folders, and no folder is a clear match by content. Decide where it belongs.
+
+    **Candidate Folders (most similar first):**
+    {candidates_str or "- (no folders yet)"}
+
+    **New File:**
+    {os.path.basename(document['file_path'])}: {trim_summary(document.get('summary'))}
+
+    **Instructions:**
+    Respond ONLY with a JSON object {{"directory": "folder/path"}} using forward slashes. Use a candidate folder if the file fits it; otherwise propose a new folder path, nested under an existing top-level folder where that makes sense.
+    """
+
+    response = parse_json_response(call_model(prompt, 'placement'))
+    directory = response.get('directory') if isinstance(response, dict) else None
+    parts = [part for part in str(directory or '').replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    return '/'.join(parts) or None
+
+def destination_names(plan, path_map, destination_root=None):
+    """Returns {file ID: file name} for the files of a plan, as they will be named in their folder.
+
+    A file keeps its name unless another file of the plan folder (or, with destination_root, a file
+    already on disk there) has it; then it becomes "name (n).ext", as FileMover names it.
+    """
+    names, taken = {}, set()
+    for directory, doc_ids in plan.items():
+        for doc_id in doc_ids:
+            if doc_id not in path_map:
+                continue
+            stem, ext = os.path.splitext(os.path.basename(path_map[doc_id]))
+            name, n = stem + ext, 1
+            while os.path.normcase(os.path.join(directory, name)) in taken or (
+                    destination_root is not None and os.path.exists(os.path.join(destination_root, directory, name))):
+                name = f"{stem} ({n}){ext}"
+                n += 1
+            taken.add(os.path.normcase(os.path.join(directory, name)))
+            names[doc_id] = name
+    return names
+
+def render_file_tree(plan, path_map=None):
+    """Builds an ASCII file tree of a {directory: [file IDs]} plan, showing the file names the files
+    will have in DESTINATION_ROOT.
+
+    Without a path_map the plan entries are shown as they are.
+    """
+    names = destination_names(plan, path_map, DESTINATION_ROOT) if path_map else {}
+    tree = {}
+    for directory, entries in plan.items():
+        node = tree
+        for part in [p for p in directory.split('/') if p]:
+            node = node.setdefault(part + '/', {})
+        for entry in entries:
+            node[names.get(entry, entry)] = None
+
+    lines = []
+
+    def walk(node, prefix):
+        entries = sorted(node.items(), key=lambda item: (item[1] is None, item[0]))
+        for i, (name, child) in enumerate(entries):
+            last = i == len(entries) - 1
+            lines.append(f"{prefix}{'└── ' if last else '├── '}{name}")
+            if child is not None:
+                walk(child, prefix + ('    ' if last else '│   '))
+
+    walk(tree, "")
+    return "\n".join(lines)
+
+def get_clustered_organization_plan(clusters, current_analysis, path_map=None):
+    """Plans every cluster with its own request, then merges the results with one small request.
+
+    Cluster requests run concurrently through the client. Files missing from the merged plan are
+    placed with complete_plan, as in the single-request path. Returns the plan, file tree and reasoning,
+    like get_organization_plan_from_ai.
+    """
+    print(f"Asking the AI to organize {len(clusters)} clusters ({client.concurrency} requests at a time)...")
+    results = client.map(lambda cluster_docs: get_cluster_plan_from_ai(cluster_docs, current_analysis), clusters)
+    cluster_plans = [plan for plan in results if plan]
+    if not cluster_plans:
+        return None, None, None
+
+    path_map = path_map or create_file_path_map([doc for cluster in clusters for doc in cluster])
+    plan, reasoning = merge_cluster_plans_from_ai(cluster_plans, current_analysis)
+    # Place the files the cluster or merge plans left out, including those of clusters whose request failed
+    plan = complete_plan(resolve_plan_ids(plan, path_map), [doc for cluster in clusters for doc in cluster],
+                         path_map, current_analysis)
+    metrics.set('ai_plan_valid', int(bool(plan)))
+    return plan, render_file_tree(plan, path_map), reasoning
+
+def execute_file_organization(plan, path_map, destination_root, journal_path=DEFAULT_JOURNAL_FILE,
+                              workers=DEFAULT_MOVE_WORKERS):
+    """Creates all directories and moves the files of the provided plan in parallel.
+
+    Every step is written to the move journal, so an interrupted organization can be resumed or
+    rolled back (see resume_file_organization and rollback_file_organization).
+    """
     print("\nStarting file organization process...")
     
     if not plan:
         print("Cannot proceed with an empty or invalid plan.")
-        errors_encountered += 1
+        metrics.count('errors')
         return
 
-    total_dirs_in_plan = len(plan)
-    for directory, filenames in plan.items():
+    mover = FileMover(journal_path, workers, metrics)
+    unfinished = mover.unfinished_moves()
+    if unfinished:
+        print(f"Error: '{journal_path}' has {unfinished} unfinished moves from an earlier run. "
+              f"Run with --resume-moves or --rollback first.")
+        metrics.count('errors')
+        return
+
+    metrics.count('dirs_in_plan', len(plan))
+    # Files with the same name planned into one folder get unique names, the ones shown in the preview
+    names = destination_names(plan, path_map, destination_root)
+    directories = []
+    moves = []
+    for directory, doc_ids in plan.items():
         new_dir_path = os.path.join(destination_root, directory)
-        total_filenames_in_plan += len(filenames)
-        
-        try:
-            os.makedirs(new_dir_path, exist_ok=True)
-            print(f"\n[OK] Ensured directory exists: '{new_dir_path}'")
-            dirs_created += 1
-        except OSError as e:
-            print(f"[ERROR] Could not create directory '{new_dir_path}'. Skipping. Error: {e}")
-            errors_encountered += 1
-            continue
+        directories.append(new_dir_path)
+        metrics.count('filenames_in_plan', len(doc_ids))
 
-        for filename in filenames:
-            original_path = path_map.get(filename)
+        for doc_id in doc_ids:
+            original_path = path_map.get(doc_id)
             
             if not original_path:
-                print(f"  [WARN] Could not find original path for '{filename}'. Skipping.")
-                errors_encountered += 1
+                print(f"  [WARN] Could not find original path for '{doc_id}'. Skipping.")
+                metrics.count('errors')
                 continue
 
             if not os.path.exists(original_path):
                 print(f"  [WARN] Source file does not exist at '{original_path}'. Skipping.")
-                errors_encountered += 1
+                metrics.count('errors')
                 continue
 
-            valid_path_mappings += 1
-            destination_path = os.path.join(new_dir_path, filename)
+            metrics.count('valid_path_mappings')
+            moves.append((original_path, os.path.join(new_dir_path, names[doc_id])))
+
+    print(f"Creating {len(set(directories))} directories and moving {len(moves)} files "
+          f"(journal: '{journal_path}')...")
+    result = mover.run(directories, moves)
+    report_move_result(result)
+    metrics.count('dirs_created', result.dirs_ready)
+    metrics.count('files_in_plan', sum(len(files) for files in plan.values()))
 
-            try:
-                shutil.move(original_path, destination_path)
-                print(f"  -> Moved '{filename}' to '{new_dir_path}'")
-                files_moved += 1
-            except Exception as e:
-                print(f"  [ERROR] Failed to move '{filename}'. Error: {e}")
-                errors_encountered += 1
+def report_move_result(result):
+    """Prints the outcome of a mover run and adds it to the KPI counters."""
+    for src, dst, error in result.failures:
+        print(f"  [ERROR] Failed to move '{src}' to '{dst}'. Error: {error}")
+    metrics.count('files_moved', result.moved)
+    metrics.count('errors', len(result.failures))
+    print(f"[OK] Moved {result.moved} files ({result.already_done} already done, {len(result.failures)} failed).")
 
-    total_files_in_plan += sum(len(files) for files in plan.values())
+def resume_file_organization(journal_path=DEFAULT_JOURNAL_FILE, workers=DEFAULT_MOVE_WORKERS):
+    """Finishes the moves of an interrupted organization recorded in the journal."""
+    if not os.path.exists(journal_path):
+        print(f"Error: Move journal '{journal_path}' not found.")
+        return
+    result = FileMover(journal_path, workers, metrics).resume()
+    metrics.count('files_in_plan', result.moved + result.already_done + len(result.failures))
+    report_move_result(result)
+
+def rollback_file_organization(journal_path=DEFAULT_JOURNAL_FILE, workers=DEFAULT_MOVE_WORKERS):
+    """Moves every file recorded in the journal back and removes the directories it created."""
+    if not os.path.exists(journal_path):
+        print(f"Error: Move journal '{journal_path}' not found.")
+        return
+    report_move_result(FileMover(journal_path, workers, metrics).rollback())
+
+def offline_response(prompt):
+    """Deterministic answers to this module's prompts, used by the stub backend for offline runs.
+
+    Files are grouped into one directory per file extension and merged directories are kept as is.
+    """
+    if '**Candidate Folders' in prompt:
+        filename = re.search(r'\*\*New File:\*\*\s*(.+?): ', prompt).group(1)
+        extension = os.path.splitext(filename)[1].lstrip('.').upper() or 'Other'
+        return json.dumps({'directory': f"{extension}_Files"})
+    if '**Proposed Directories' in prompt:
+        keys = re.findall(r'^\s*- (c\d+:.+?) \(\d+ files\)$', prompt, re.MULTILINE)
+        mapping = {key: key.split(':', 1)[1] for key in keys}
+        return json.dumps(mapping, indent=2) + "\n-----\nDirectories are kept as proposed for each group."
+    files = re.findall(r'^\s*\[(\w+)\] (.+?): ', prompt, re.MULTILINE)
+    if '**JSON Plan' not in prompt and 'list of file IDs' not in prompt:
+        return "Offline analysis: the files are grouped by type to give a predictable, reproducible structure."
+    plan = defaultdict(list)
+    for doc_id, filename in files:
+        extension = os.path.splitext(filename)[1].lstrip('.').upper() or 'Other'
+        plan[f"{extension}_Files"].append(doc_id)
+    if '**JSON Plan' not in prompt:
+        return json.dumps(plan, indent=2)
+    return json.dumps(plan, indent=2) + "\n-----\nFiles are grouped by type, as produced by the offline stub backend."
+
+def create_backend(args):
+    """Creates the model backend selected on the command line, or None if it cannot be configured."""
+    if args.backend == 'stub':
+        return StubBackend(offline_response)
+    if args.backend == 'replay':
+        return RecordReplayBackend(args.recordings)
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if not api_key:
+        print("Error: GOOGLE_API_KEY environment variable not set.")
+        return None
+    backend = GeminiBackend(args.model, api_key=api_key)
+    return RecordReplayBackend(args.recordings, backend) if args.backend == 'record' else backend
+
+def review_and_apply_plan(organization_plan, file_tree, reasoning, all_docs, journal_path=DEFAULT_JOURNAL_FILE,
+                          workers=DEFAULT_MOVE_WORKERS, reasoning_shown=False):
+    """Shows the plan, file tree and reasoning, and applies the plan if the user confirms.
+
+    With reasoning_shown (the reasoning was streamed while planning) the reasoning is not repeated.
+    """
+    # 6. Create a map of document IDs to their original paths
+    file_path_map = create_file_path_map(all_docs)
+
+    # Keep copies and versions of the same document together
+    organization_plan, colocated = colocate_version_groups(organization_plan, all_docs)
+    if colocated:
+        print(f"\nPlaced {colocated} copies and versions in the same folder as the rest of their version group.")
+        file_tree = render_file_tree(organization_plan, file_path_map)
+
+    # 7. Display the plan and file move information
+    names = destination_names(organization_plan, file_path_map, DESTINATION_ROOT)
+    print("\n--- Proposed Organization Plan ---")
+    for directory, doc_ids in organization_plan.items():
+        print(f"\nFolder: {directory}")
+        for doc_id in doc_ids:
+            original_path = file_path_map.get(doc_id, "Not found")
+            filename = names.get(doc_id, os.path.basename(original_path))
+            destination_path = os.path.join(DESTINATION_ROOT or '<DESTINATION_ROOT>', directory, filename)
+            print(f"  File: {filename} [{doc_id}]")
+            print(f"    From: {original_path}")
+            print(f"    To: {destination_path}")
+    print("\n------------------------------------")
+
+    # 8. Display the file tree and reasoning
+    print("\nVisible File Tree:")
+    print(file_tree)
+    if not reasoning_shown:
+        print("\nReasoning for Organization Plan:")
+        print(reasoning)
+    print("\n------------------------------------")
+
+    # 9. Ask for confirmation to apply the plan
+    confirm_plan = input("Do you want to apply this organization? (yes/no): ").lower().strip()
+
+    if confirm_plan == 'yes' and DESTINATION_ROOT is None:
+        print("Error: DESTINATION_ROOT environment variable not set.")
+    elif confirm_plan == 'yes':
+        # 10. Execute the plan
+        execute_file_organization(organization_plan, file_path_map, DESTINATION_ROOT, journal_path, workers)
+    else:
+        print("Organization application cancelled by user.")
+
+def get_local_organization_plan(all_docs, documents_file, folder_size):
+    """Plans the organization locally from the stored embeddings; returns the plan, file tree and reasoning."""
+    path_map = create_file_path_map(all_docs)
+    document_vectors = load_document_embeddings(all_docs, documents_file)
+    print(f"Planning locally from {len(document_vectors)} embeddings...")
+    plan, reasoning = plan_local(all_docs, document_vectors, max(1, folder_size))
+    metrics.set('ai_plan_valid', int(bool(plan)))
+    return plan, render_file_tree(plan, path_map), reasoning
+
+def default_input_file():
+    """Returns llm_input.json, or the streamed llm_input.jsonl if only that one exists."""
+    if not os.path.exists('llm_input.json') and os.path.exists('llm_input.jsonl'):
+        return 'llm_input.jsonl'
+    return 'llm_input.json'
 
 # --- Main Execution ---
 if __name__ == "__main__":
-    # 1. Load data from llm_input.json
-    all_docs = load_document_data()
+    parser = argparse.ArgumentParser(description="Propose and apply an AI-generated folder structure.")
+    parser.add_argument('--input', default=None,
+                        help="Document summaries written by summarygenerator.py (.json or .jsonl).")
+    parser.add_argument('--engine', choices=['ai', 'local'], default='ai',
+                        help="'local' plans from the stored embeddings without any AI requests or network access.")
+    parser.add_argument('--folder-size', type=int, default=DEFAULT_FOLDER_SIZE,
+                        help="Target number of files per folder for --engine local (default: %(default)s).")
+    parser.add_argument('--planning', choices=['auto', 'single', 'clustered'], default='auto',
+                        help="'single' sends every document in one request, 'clustered' plans clusters of similar "
+                             "documents separately and merges them; 'auto' clusters above --cluster-size documents.")
+    parser.add_argument('--cluster-size', type=int, default=DEFAULT_CLUSTER_SIZE,
+                        help="Maximum number of documents per clustered planning request (default: %(default)s).")
+    parser.add_argument('--documents', default=None,
+                        help="processed_documents file holding the embeddings used for clustering.")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="Maximum number of AI requests in flight (default: %(default)s).")
+    parser.add_argument('--rpm', type=float, default=DEFAULT_REQUESTS_PER_MINUTE,
+                        help="Request rate limit per minute (default: %(default)s).")
+    parser.add_argument('--tpm', type=float, default=DEFAULT_TOKENS_PER_MINUTE,
+                        help="Estimated token rate limit per minute (default: %(default)s).")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT_SECONDS,
+                        help="Timeout per AI request in seconds (default: %(default)s).")
+    parser.add_argument('--retries', type=int, default=DEFAULT_MAX_RETRIES,
+                        help="Retries for rate-limited or failed AI requests (default: %(default)s).")
+    parser.add_argument('--backend', choices=['gemini', 'stub', 'record', 'replay'], default='gemini',
+                        help="'stub' answers locally without network access, 'record' calls Gemini and saves the "
+                             "responses to --recordings, 'replay' answers from --recordings.")
+    parser.add_argument('--model', default=DEFAULT_MODEL_NAME, help="Gemini model name (default: %(default)s).")
+    parser.add_argument('--recordings', default=DEFAULT_RECORDINGS_FILE,
+                        help="Response recordings for the record/replay backends (default: %(default)s).")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help="Directory of the AI response cache (default: %(default)s).")
+    parser.add_argument('--no-cache', action='store_true', help="Do not read or write the AI response cache.")
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_CACHE_TTL_SECONDS / 3600,
+                        help="Hours before a cached AI response expires (default: %(default)s).")
+    parser.add_argument('--cache-max-mb', type=float, default=DEFAULT_CACHE_MAX_BYTES / (1024 * 1024),
+                        help="Size limit of the AI response cache in MB (default: %(default)s).")
+    parser.add_argument('--max-prompt-tokens', type=int, default=DEFAULT_MAX_PROMPT_TOKENS,
+                        help="Prompts above this many tokens are split or shortened (default: %(default)s, 0 = no limit).")
+    parser.add_argument('--usage-file', default=DEFAULT_USAGE_FILE,
+                        help="File that per-run token usage is appended to (default: %(default)s).")
+    parser.add_argument('--journal', default=DEFAULT_JOURNAL_FILE,
+                        help="Journal of directories created and files moved (default: %(default)s).")
+    parser.add_argument('--move-workers', type=int, default=DEFAULT_MOVE_WORKERS,
+                        help="Parallel file moves/copies (default: %(default)s).")
+    parser.add_argument('--resume-moves', action='store_true',
+                        help="Finish the moves of an interrupted organization from the journal, then exit.")
+    parser.add_argument('--rollback', action='store_true',
+                        help="Move all journaled files back to where they were, then exit.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Stream the plan response: show each directory as it arrives, then the file tree "
+                             "and the reasoning.")
+    parser.add_argument('--kpi-file', default=DEFAULT_KPI_FILE,
+                        help="Where to save the KPI report with the per-stage metrics (default: %(default)s).")
+    parser.add_argument('--trace', default=None, metavar='FILE',
+                        help="Write one JSON-lines record per API call and file move to FILE.")
+    parser.add_argument('--metrics-file', default=None, metavar='FILE',
+                        help="Export the metrics in the Prometheus text format to FILE "
+                             "(e.g. for the node_exporter textfile collector).")
+    args = parser.parse_args()
+    if args.trace:
+        metrics.open_trace(args.trace)
+
+    if args.resume_moves or args.rollback:
+        args.engine = None
+
+    if args.engine == 'ai':
+        backend = create_backend(args)
+        if backend is None:
+            exit()
+        cache = None if args.no_cache else ResponseCache(args.cache_dir, args.cache_ttl * 3600,
+                                                         int(args.cache_max_mb * 1024 * 1024))
+        client = LLMClient(backend, cache=cache, concurrency=args.concurrency, requests_per_minute=args.rpm,
+                           tokens_per_minute=args.tpm, timeout=args.timeout, max_retries=args.retries,
+                           max_prompt_tokens=args.max_prompt_tokens)
 
+    # 1. Load data from llm_input.json (or the streamed llm_input.jsonl)
+    all_docs = load_document_data(args.input or default_input_file()) if args.engine else None
     if all_docs:
+        assign_document_ids(all_docs)
+
+    if args.rollback:
+        rollback_file_organization(args.journal, args.move_workers)
+    elif args.resume_moves:
+        resume_file_organization(args.journal, args.move_workers)
+    elif all_docs and args.engine == 'local':
+        # 2-5. Plan from the embeddings, without analysis or AI requests
+        organization_plan, file_tree, reasoning = get_local_organization_plan(
+            all_docs, args.documents or default_documents_file(), args.folder_size)
+        if organization_plan:
+            review_and_apply_plan(organization_plan, file_tree, reasoning, all_docs, args.journal,
+                                  args.move_workers)
+    elif all_docs:
+        # 1a. Copies and versions of a document are planned once and follow their representative
+        planning_docs = version_representatives(all_docs)
+        if len(planning_docs) < len(all_docs):
+            print(f"Planning {len(planning_docs)} documents; {len(all_docs) - len(planning_docs)} copies and "
+                  f"versions will be placed with their version group.")
+
+        # 1b. For large inputs, cluster the documents by embedding and analyze a sample of each cluster
+        clusters = None
+        if args.planning == 'clustered' or (args.planning == 'auto' and len(planning_docs) > args.cluster_size):
+            document_vectors = load_document_embeddings(planning_docs, args.documents or default_documents_file())
+            clusters = cluster_documents(planning_docs, document_vectors, max(1, args.cluster_size))
+            print(f"Grouped {len(planning_docs)} documents into {len(clusters)} clusters for planning.")
+
         # 2. Get the analysis of the current structure from the AI
-        current_analysis = get_current_structure_analysis_from_ai(all_docs)
+        current_analysis = get_current_structure_analysis_from_ai(
+            sample_documents_for_analysis(clusters) if clusters else planning_docs)
 
         if current_analysis:
             # 3. Display the analysis
@@ -268,64 +951,64 @@ if __name__ == "__main__":
 
             if confirm_analysis == 'yes':
                 # 5. Get the organization plan, file tree, and reasoning from the AI
-                organization_plan, file_tree, reasoning = get_organization_plan_from_ai(all_docs, current_analysis)
+                if clusters:
+                    organization_plan, file_tree, reasoning = get_clustered_organization_plan(clusters, current_analysis)
+                else:
+                    organization_plan, file_tree, reasoning = get_organization_plan_from_ai(
+                        planning_docs, current_analysis, stream=args.stream)
 
                 if organization_plan and file_tree and reasoning:
-                    # 6. Create a map of filenames to their original paths
-                    file_path_map = create_file_path_map(all_docs)
-
-                    # 7. Display the plan and file move information
-                    print("\n--- Proposed Organization Plan ---")
-                    for directory, files in organization_plan.items():
-                        print(f"\nFolder: {directory}")
-                        for f in files:
-                            original_path = file_path_map.get(f, "Not found")
-                            destination_path = os.path.join(DESTINATION_ROOT, directory, f)
-                            print(f"  File: {f}")
-                            print(f"    From: {original_path}")
-                            print(f"    To: {destination_path}")
-                    print("\n------------------------------------")
-
-                    # 8. Display the LLM-generated file tree and reasoning
-                    print("\nVisible File Tree:")
-                    print(file_tree)
-                    print("\nReasoning for Organization Plan:")
-                    print(reasoning)
-                    print("\n------------------------------------")
-
-                    # 9. Ask for confirmation to apply the plan
-                    confirm_plan = input("Do you want to apply this organization? (yes/no): ").lower().strip()
-
-                    if confirm_plan == 'yes':
-                        # 10. Execute the plan
-                        execute_file_organization(organization_plan, file_path_map, DESTINATION_ROOT)
-                    else:
-                        print("Organization application cancelled by user.")
+                    review_and_apply_plan(organization_plan, file_tree, reasoning, all_docs, args.journal,
+                                          args.move_workers, reasoning_shown=args.stream and not clusters)
             else:
                 print("Reorganization cancelled by user.")
 
     # Calculate KPIs
     total_processing_time = time.time() - start_time
+    usage_totals = client.usage.totals() if client else UsageTracker().totals()
+    files_in_plan, dirs_in_plan = metrics.counter('files_in_plan'), metrics.counter('dirs_in_plan')
+    filenames_in_plan = metrics.counter('filenames_in_plan')
     kpi_report = {
-        "file_organization_success_rate": (files_moved / total_files_in_plan * 100) if total_files_in_plan else 0.0,
+        "file_organization_success_rate": (metrics.counter('files_moved') / files_in_plan * 100) if files_in_plan else 0.0,
         "processing_time_seconds": total_processing_time,
-        "ai_plan_validity_rate": 100.0 if ai_plan_valid else 0.0,
-        "directory_creation_success_rate": (dirs_created / total_dirs_in_plan * 100) if total_dirs_in_plan else 0.0,
-        "file_path_mapping_accuracy": (valid_path_mappings / total_filenames_in_plan * 100) if total_filenames_in_plan else 0.0,
-        "error_rate": (errors_encountered / (total_filenames_in_plan + total_dirs_in_plan) * 100) if (total_filenames_in_plan + total_dirs_in_plan) else 0.0,
-        "input_file_load_success_rate": 100.0 if json_load_success else 0.0,
-        "api_response_time_seconds": api_response_time,
-        "tokens_used": tokens_used
+        "ai_plan_validity_rate": 100.0 if metrics.gauge('ai_plan_valid') else 0.0,
+        "directory_creation_success_rate": (metrics.counter('dirs_created') / dirs_in_plan * 100) if dirs_in_plan else 0.0,
+        "file_path_mapping_accuracy": (metrics.counter('valid_path_mappings') / filenames_in_plan * 100) if filenames_in_plan else 0.0,
+        "error_rate": (metrics.counter('errors') / (filenames_in_plan + dirs_in_plan) * 100) if (filenames_in_plan + dirs_in_plan) else 0.0,
+        "input_file_load_success_rate": 100.0 if metrics.gauge('input_file_loaded') else 0.0,
+        "api_response_time_seconds": metrics.total('api_call').total_seconds,
+        "tokens_used": usage_totals['total_tokens'],
+        "prompt_tokens": usage_totals['prompt_tokens'],
+        "candidates_tokens": usage_totals['candidates_tokens'],
+        "api_requests": client.requests_sent if client else 0,
+        "api_cache_hits": client.cache_hits if client else 0,
+        "api_retries": client.retries if client else 0,
+        "rate_limit_wait_seconds": client.rate_limit_wait if client else 0.0,
+        "api_interrupted_streams": client.interrupted_streams if client else 0,
+        "plan_repairs": metrics.counter('plan_repairs'),
+        "missing_files_placed": metrics.counter('missing_files_placed')
     }
 
-    # Save KPI report
-    # kpi_output_file = 'fileorganizerkpi.json'
-    # try:
-    #     with open(kpi_output_file, 'w', encoding='utf-8') as f:
-    #         json.dump(kpi_report, f, ensure_ascii=False, indent=4)
-    #     print(f"\nKPI report saved to {kpi_output_file}")
-    # except Exception as e:
-    #     print(f"Error saving {kpi_output_file}: {str(e)}")
+    # Save KPI report, with the per-stage breakdown (API calls by phase, moves by file type and size)
+    try:
+        with open(args.kpi_file, 'w', encoding='utf-8') as f:
+            json.dump({**kpi_report, 'metrics': metrics.to_dict()}, f, ensure_ascii=False, indent=4)
+        print(f"\nKPI report saved to {args.kpi_file}")
+    except Exception as e:
+        print(f"Error saving {args.kpi_file}: {str(e)}")
+
+    # Export the metrics for monitoring
+    if args.metrics_file:
+        for name, value in kpi_report.items():
+            metrics.set(f"kpi_{name}", value)
+        try:
+            metrics.write_prometheus(args.metrics_file)
+            print(f"Metrics saved to {args.metrics_file}")
+        except Exception as e:
+            print(f"Error saving {args.metrics_file}: {str(e)}")
+    metrics.close()
+    if args.trace:
+        print(f"Trace saved to {args.trace}")
 
     # Print KPI report
     print("\n=== KPI Report ===")
@@ -337,9 +1020,44 @@ if __name__ == "__main__":
     print(f"Error Rate: {kpi_report['error_rate']:.2f}%")
     print(f"Input File Load Success Rate: {kpi_report['input_file_load_success_rate']:.2f}%")
     print(f"API Response Time: {kpi_report['api_response_time_seconds']:.2f} seconds")
-    print(f"Tokens Used: {kpi_report['tokens_used']}")
+    print(f"Tokens Used: {kpi_report['tokens_used']} ({kpi_report['prompt_tokens']} prompt, "
+          f"{kpi_report['candidates_tokens']} response)")
+    if client:
+        for phase, phase_usage in client.usage.by_phase().items():
+            print(f"  {phase}: {phase_usage['calls']} calls ({phase_usage['cached_calls']} cached), "
+                  f"{phase_usage['total_tokens']} tokens, {phase_usage['latency_seconds']:.2f} seconds")
+    print(f"API Requests: {kpi_report['api_requests']} ({kpi_report['api_cache_hits']} answered from cache, "
+          f"{kpi_report['api_retries']} retries, {kpi_report['rate_limit_wait_seconds']:.2f} seconds waiting "
+          f"for rate limits)")
+    if kpi_report['plan_repairs'] or kpi_report['missing_files_placed'] or kpi_report['api_interrupted_streams']:
+        print(f"Plan Repairs: {kpi_report['plan_repairs']:.0f} repairs, {kpi_report['missing_files_placed']:.0f} "
+              f"missing files placed, {kpi_report['api_interrupted_streams']} interrupted streams")
+    for phase, stats in sorted(metrics.stage_stats('api_call', 'phase').items()):
+        print(f"  {phase} latency: p50 {stats.quantile(0.5):.2f}s, p95 {stats.quantile(0.95):.2f}s, "
+              f"max {stats.max_seconds:.2f}s")
+    metrics.print_stage_report()
     print("=================\n")
 
+    # Persist this run's token usage and latency
+    if client and client.usage.calls:
+        documents_count = len(all_docs) if all_docs else 0
+        per_thousand = 1000.0 / documents_count if documents_count else 0.0
+        try:
+            save_usage({
+                "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                "model": client.backend.name,
+                "documents": documents_count,
+                "processing_time_seconds": total_processing_time,
+                "totals": usage_totals,
+                "phases": client.usage.by_phase(),
+                "tokens_per_1000_documents": usage_totals['total_tokens'] * per_thousand,
+                "api_seconds_per_1000_documents": usage_totals['latency_seconds'] * per_thousand,
+                "calls": client.usage.calls
+            }, args.usage_file)
+            print(f"Token usage saved to {args.usage_file}")
+        except Exception as e:
+            print(f"Error saving {args.usage_file}: {str(e)}")
+
     print("Processing complete.")
 
 
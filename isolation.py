@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import multiprocessing
+from typing import Callable, Dict, Optional, Tuple
+
+# Per-file budgets for document conversion. Conversion runs in supervised child processes; a file
+# that runs past its time limit, grows the child past its memory limit or crashes it is killed and
+# quarantined, and the quarantine list makes later runs skip it until the file changes.
+
+DEFAULT_FILE_TIMEOUT_SECONDS = 300
+DEFAULT_FILE_MEMORY_LIMIT_MB = 4096
+DEFAULT_QUARANTINE_FILE = 'quarantine.json'
+
+# How often the supervisor checks a busy child's memory
+MONITOR_INTERVAL_SECONDS = 0.2
+# An idle child above this fraction of the memory limit is restarted before its next file, so memory
+# kept from earlier files does not count against the next one
+RECYCLE_MEMORY_FRACTION = 0.75
+
+
+def process_rss_bytes(pid: int) -> Optional[int]:
+    """Current resident set size of a process, or None where it cannot be read."""
+    try:
+        with open(f'/proc/{pid}/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except Exception:
+        return None
+
+
+class BudgetExceeded(Exception):
+    """A file's conversion was stopped: kind is 'timeout', 'memory' or 'crash'."""
+
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+def _child_loop(connection, target: Callable, initializer: Optional[Callable], initargs: Tuple) -> None:
+    """Runs in the child: initializes once, then answers each item with (True, result) or (False, error)."""
+    if initializer is not None:
+        initializer(*initargs)
+    connection.send('ready')
+    while True:
+        try:
+            item = connection.recv()
+        except EOFError:
+            break
+        if item is None:
+            break
+        try:
+            connection.send((True, target(item)))
+        except Exception as e:
+            connection.send((False, str(e)))
+
+
+class SupervisedWorker:
+    """A child process that runs target(item) for one item at a time under a time and memory limit.
+
+    The child is started on first use and kept for later items, so models loaded by the initializer
+    are reused; after it was killed, a new one is started for the next item.
+    """
+
+    def __init__(self, target: Callable, initializer: Optional[Callable] = None, initargs: Tuple = (),
+                 timeout: Optional[float] = DEFAULT_FILE_TIMEOUT_SECONDS,
+                 memory_limit_bytes: Optional[int] = DEFAULT_FILE_MEMORY_LIMIT_MB * 1024 ** 2):
+        self.target = target
+        self.initializer = initializer
+        self.initargs = initargs
+        self.timeout = timeout
+        self.memory_limit_bytes = memory_limit_bytes
+        self.restarts = 0
+        # Spawned rather than forked: the parent runs threads (and possibly torch), which are not fork-safe
+        self._context = multiprocessing.get_context('spawn')
+        self._process = None
+        self._connection = None
+
+    def _start(self) -> None:
+        parent_connection, child_connection = self._context.Pipe()
+        self._process = self._context.Process(target=_child_loop, name='conversion-worker', daemon=True,
+                                              args=(child_connection, self.target, self.initializer, self.initargs))
+        self._process.start()
+        child_connection.close()
+        self._connection = parent_connection
+        # Start-up (imports, model loading) does not count against the first file's budget
+        while not self._connection.poll(MONITOR_INTERVAL_SECONDS):
+            if not self._process.is_alive():
+                raise RuntimeError(f"The conversion worker exited during start-up "
+                                   f"(exit code {self._process.exitcode})")
+        self._connection.recv()
+
+    def _stop(self) -> None:
+        if self._process is not None:
+            if self._process.is_alive():
+                self._process.kill()
+            self._process.join()
+            self._connection.close()
+        self._process = None
+        self._connection = None
+
+    def _rss(self) -> Optional[int]:
+        return process_rss_bytes(self._process.pid)
+
+    def run(self, item):
+        """Returns target(item) from the child; raises BudgetExceeded after killing the child if the
+        item runs out of time or memory or crashes the child."""
+        if self._process is not None and self.memory_limit_bytes:
+            rss = self._rss()
+            if rss is not None and rss > RECYCLE_MEMORY_FRACTION * self.memory_limit_bytes:
+                self._stop()
+        if self._process is None or not self._process.is_alive():
+            self._stop()
+            self._start()
+        self._connection.send(item)
+        start_time = time.monotonic()
+        while True:
+            try:
+                if self._connection.poll(MONITOR_INTERVAL_SECONDS):
+                    ok, value = self._connection.recv()
+                    if not ok:
+                        raise RuntimeError(value)
+                    return value
+            except (EOFError, OSError):
+                # The child closed its end: wait for it to exit
+                self._process.join(timeout=1)
+            if not self._process.is_alive():
+                self._process.join()
+                exit_code = self._process.exitcode
+                self._stop()
+                self.restarts += 1
+                raise BudgetExceeded('crash', f"conversion crashed the worker process (exit code {exit_code})")
+            rss = self._rss() if self.memory_limit_bytes else None
+            if rss is not None and rss > self.memory_limit_bytes:
+                self._stop()
+                self.restarts += 1
+                raise BudgetExceeded('memory', f"conversion used more than {self.memory_limit_bytes / 1024 ** 2:.0f} "
+                                               f"MB of memory ({rss / 1024 ** 2:.0f} MB)")
+            elapsed = time.monotonic() - start_time
+            if self.timeout and elapsed > self.timeout:
+                self._stop()
+                self.restarts += 1
+                raise BudgetExceeded('timeout', f"conversion took longer than {self.timeout:.0f} seconds")
+
+    def close(self) -> None:
+        if self._process is not None and self._process.is_alive():
+            try:
+                self._connection.send(None)
+                self._process.join(timeout=5)
+            except (OSError, ValueError):
+                pass
+        self._stop()
+
+
+class SupervisorPool:
+    """A fixed number of SupervisedWorkers shared by threads; run() uses whichever worker is free."""
+
+    def __init__(self, size: int, target: Callable, **worker_options):
+        self.size = max(1, size)
+        self.workers = [SupervisedWorker(target, **worker_options) for _ in range(self.size)]
+        self._free: queue.Queue = queue.Queue()
+        for worker in self.workers:
+            self._free.put(worker)
+
+    def run(self, item):
+        worker = self._free.get()
+        try:
+            return worker.run(item)
+        finally:
+            self._free.put(worker)
+
+    @property
+    def restarts(self) -> int:
+        return sum(worker.restarts for worker in self.workers)
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.close()
+
+
+class QuarantineList:
+    """Files whose conversion was stopped, with the reason, saved as JSON.
+
+    An entry is keyed by file path and remembers the file's size and modification time, so a file
+    that is replaced or edited is tried again. Every change is saved right away. Thread-safe.
+    """
+
+    def __init__(self, filepath: str = DEFAULT_QUARANTINE_FILE, save_filepath: Optional[str] = None):
+        self.filepath = filepath
+        self.save_filepath = save_filepath or filepath
+        self.entries: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self.merge_file(filepath)
+
+    def merge_file(self, filepath: str) -> None:
+        """Adds the entries of a quarantine file (e.g. one written by a shard worker)."""
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read quarantine list '{filepath}': {str(e)}", file=sys.stderr)
+            return
+        with self._lock:
+            for file_path, entry in entries.items():
+                self.entries.setdefault(file_path, entry)
+
+    def get(self, file_path: str, fingerprint: Dict) -> Optional[Dict]:
+        """The quarantine entry of a file, unless the file changed since it was quarantined."""
+        entry = self.entries.get(file_path)
+        if entry is None or entry.get('size') != fingerprint.get('size') \
+                or entry.get('mtime_ns') != fingerprint.get('mtime_ns'):
+            return None
+        return entry
+
+    def add(self, file_path: str, kind: str, reason: str) -> None:
+        try:
+            stat = os.stat(file_path)
+            fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        except OSError:
+            fingerprint = {}
+        with self._lock:
+            self.entries[file_path] = {**fingerprint, 'kind': kind, 'reason': reason,
+                                       'quarantined_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+            self._save()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries = {}
+
+    def save(self) -> None:
+        with self._lock:
+            self._save()
+
+    def _save(self) -> None:
+        tmp_file = f"{self.save_filepath}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.save_filepath)
@@ -0,0 +1,562 @@
+import os
+import json
+import random
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+
+# Defaults for the request layer; all of them can be overridden from the fileorganizer.py command line
+DEFAULT_CONCURRENCY = 4
+DEFAULT_REQUESTS_PER_MINUTE = 60
+DEFAULT_TOKENS_PER_MINUTE = 1000000
+DEFAULT_TIMEOUT_SECONDS = 120.0
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+DEFAULT_MODEL_NAME = 'gemini-2.5-flash'
+
+# Response cache: entries expire after the TTL and the oldest are evicted above the size limit
+DEFAULT_CACHE_DIR = '.llm_cache'
+DEFAULT_CACHE_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_RECORDINGS_FILE = 'llm_recordings.jsonl'
+
+# Prompt budget: prompts above the limit are refused (PromptTooLargeError) so callers can split them.
+# Prompts whose estimate is below this fraction of the limit are not counted exactly.
+DEFAULT_MAX_PROMPT_TOKENS = 200000
+EXACT_COUNT_THRESHOLD = 0.5
+
+# Per-run token usage and latency, one JSON record per run
+DEFAULT_USAGE_FILE = 'llm_usage.jsonl'
+
+# Chunk size (characters) in which backends without native streaming deliver a streamed response
+STREAM_CHUNK_CHARS = 64
+
+# HTTP status codes worth retrying: rate limited, or a transient server-side failure
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count used for rate limiting (about four characters per token)."""
+    return len(text) // 4
+
+
+class TokenBucket:
+    """Allows `rate_per_minute` units per minute with bursts up to one minute's worth.
+
+    Consumers may overdraw the bucket (e.g. when a response turns out longer than expected);
+    later acquires then wait until the debt is refilled.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Blocks until `amount` units are available, takes them and returns the time spent waiting."""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def charge(self, amount: float) -> None:
+        """Takes units without waiting, possibly leaving the bucket in debt."""
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+
+
+def is_retryable(error: Exception) -> bool:
+    """Returns True for rate limits, timeouts and transient server errors."""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, 'code', None)
+    code = getattr(code, 'value', code)
+    if isinstance(code, int) and code in RETRYABLE_STATUS_CODES:
+        return True
+    return type(error).__name__ in {'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable',
+                                    'InternalServerError', 'DeadlineExceeded', 'GatewayTimeout'}
+
+
+class PromptTooLargeError(ValueError):
+    """Raised before sending a prompt whose token count exceeds the client's budget."""
+
+    def __init__(self, tokens: int, limit: int):
+        super().__init__(f"Prompt has {tokens} tokens, the limit is {limit}.")
+        self.tokens = tokens
+        self.limit = limit
+
+
+class ModelResponse:
+    """Response text with the token counts reported by the model (estimated where it reports none)."""
+
+    def __init__(self, text: str, prompt_tokens: int = 0, candidates_tokens: int = 0,
+                 total_tokens: Optional[int] = None):
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+        self.candidates_tokens = candidates_tokens
+        self.total_tokens = prompt_tokens + candidates_tokens if total_tokens is None else total_tokens
+
+    def usage(self) -> Dict:
+        return {'prompt_tokens': self.prompt_tokens, 'candidates_tokens': self.candidates_tokens,
+                'total_tokens': self.total_tokens}
+
+    @classmethod
+    def estimated(cls, prompt: str, text: str) -> 'ModelResponse':
+        return cls(text, estimate_tokens(prompt), estimate_tokens(text))
+
+
+class ModelBackend:
+    """Interface for the model behind LLMClient.
+
+    A backend turns a prompt into a ModelResponse. `name` and `params` identify the model and its
+    generation settings, and together with the prompt form the response cache key.
+    """
+
+    name = 'backend'
+    params: Dict = {}
+
+    def generate(self, prompt: str, timeout: Optional[float] = None) -> ModelResponse:
+        raise NotImplementedError
+
+    def stream(self, prompt: str, on_text: Callable[[str], None], timeout: Optional[float] = None) -> ModelResponse:
+        """Like generate, but passes the response text to on_text in chunks as it arrives.
+
+        Backends without native streaming deliver the full response in STREAM_CHUNK_CHARS chunks.
+        """
+        response = self.generate(prompt, timeout)
+        for start in range(0, len(response.text), STREAM_CHUNK_CHARS):
+            on_text(response.text[start:start + STREAM_CHUNK_CHARS])
+        return response
+
+    def count_tokens(self, prompt: str) -> int:
+        """Tokens the prompt will use; backends without a tokenizer estimate."""
+        return estimate_tokens(prompt)
+
+
+class GeminiBackend(ModelBackend):
+    """Google Gemini through google.generativeai (imported on first use)."""
+
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME, api_key: Optional[str] = None,
+                 generation_config: Optional[Dict] = None):
+        import google.generativeai as genai
+        if api_key:
+            genai.configure(api_key=api_key)
+        self.name = model_name
+        self.params = dict(generation_config or {})
+        self.model = genai.GenerativeModel(model_name, generation_config=self.params or None)
+
+    def generate(self, prompt: str, timeout: Optional[float] = None) -> ModelResponse:
+        request_options = {'timeout': timeout} if timeout else None
+        response = self.model.generate_content(prompt, request_options=request_options)
+        return self._model_response(prompt, response.text, response)
+
+    def stream(self, prompt: str, on_text: Callable[[str], None], timeout: Optional[float] = None) -> ModelResponse:
+        request_options = {'timeout': timeout} if timeout else None
+        response = self.model.generate_content(prompt, stream=True, request_options=request_options)
+        parts = []
+        for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                # A chunk without text parts (e.g. only the finish reason)
+                continue
+            parts.append(text)
+            on_text(text)
+        return self._model_response(prompt, ''.join(parts), response)
+
+    @staticmethod
+    def _model_response(prompt: str, text: str, response) -> ModelResponse:
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is None:
+            return ModelResponse.estimated(prompt, text)
+        return ModelResponse(text, getattr(usage, 'prompt_token_count', 0) or 0,
+                             getattr(usage, 'candidates_token_count', 0) or 0,
+                             getattr(usage, 'total_token_count', None))
+
+    def count_tokens(self, prompt: str) -> int:
+        return self.model.count_tokens(prompt).total_tokens
+
+
+class StubBackend(ModelBackend):
+    """Deterministic local backend for offline runs and CI.
+
+    `respond(prompt)` produces the response text. For exercising the request layer, every
+    `fail_every`-th call raises a retryable error with status `fail_code`, each call takes
+    `latency` seconds (raising TimeoutError if that exceeds the timeout), and with `cut_stream_after`
+    a streamed response breaks off with a ConnectionError after that many characters.
+    """
+
+    def __init__(self, respond: Optional[Callable[[str], str]] = None, name: str = 'stub',
+                 latency: float = 0.0, fail_every: int = 0, fail_code: int = 429, cut_stream_after: int = 0):
+        self.respond = respond or (lambda prompt: "{}")
+        self.name = name
+        self.params = {}
+        self.latency = latency
+        self.fail_every = fail_every
+        self.fail_code = fail_code
+        self.cut_stream_after = cut_stream_after
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate(self, prompt: str, timeout: Optional[float] = None) -> ModelResponse:
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+        if self.latency:
+            time.sleep(min(self.latency, timeout) if timeout else self.latency)
+            if timeout and self.latency > timeout:
+                raise TimeoutError(f"Request timed out after {timeout}s")
+        if self.fail_every and call % self.fail_every == 0:
+            error = RuntimeError(f"Simulated error {self.fail_code}")
+            error.code = self.fail_code
+            raise error
+        return ModelResponse.estimated(prompt, self.respond(prompt))
+
+    def stream(self, prompt: str, on_text: Callable[[str], None], timeout: Optional[float] = None) -> ModelResponse:
+        response = self.generate(prompt, timeout)
+        text = response.text[:self.cut_stream_after] if self.cut_stream_after else response.text
+        for start in range(0, len(text), STREAM_CHUNK_CHARS):
+            on_text(text[start:start + STREAM_CHUNK_CHARS])
+        if len(text) < len(response.text):
+            raise ConnectionError(f"Simulated stream break after {len(text)} characters")
+        return response
+
+
+def prompt_key(name: str, params: Dict, prompt: str) -> str:
+    """Content address of a request: model name, generation parameters and prompt hash."""
+    prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    key = json.dumps({'model': name, 'params': params, 'prompt': prompt_hash}, sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class RecordReplayBackend(ModelBackend):
+    """Records another backend's responses to a JSON-lines file, or replays them without it.
+
+    Recordings are keyed by prompt hash. In replay mode (no backend given) an unrecorded prompt
+    raises KeyError.
+    """
+
+    def __init__(self, filepath: str = DEFAULT_RECORDINGS_FILE, backend: Optional[ModelBackend] = None):
+        self.filepath = filepath
+        self.backend = backend
+        self.recordings: Dict[str, ModelResponse] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(filepath):
+            with open(filepath, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.endswith('\n') and line.strip():
+                        record = json.loads(line)
+                        self.recordings[record['prompt_sha256']] = ModelResponse(record['response'],
+                                                                                 **record.get('usage', {}))
+        self.name = backend.name if backend is not None else 'replay'
+        self.params = backend.params if backend is not None else {}
+
+    def generate(self, prompt: str, timeout: Optional[float] = None) -> ModelResponse:
+        if self.backend is None:
+            return self._replay(prompt)
+        return self._record(prompt, self.backend.generate(prompt, timeout))
+
+    def stream(self, prompt: str, on_text: Callable[[str], None], timeout: Optional[float] = None) -> ModelResponse:
+        if self.backend is None:
+            return super().stream(prompt, on_text, timeout)
+        return self._record(prompt, self.backend.stream(prompt, on_text, timeout))
+
+    def _replay(self, prompt: str) -> ModelResponse:
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        if prompt_hash not in self.recordings:
+            raise KeyError(f"No recorded response for prompt {prompt_hash[:12]} in '{self.filepath}'.")
+        return self.recordings[prompt_hash]
+
+    def _record(self, prompt: str, response: ModelResponse) -> ModelResponse:
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        with self._lock:
+            self.recordings[prompt_hash] = response
+            with open(self.filepath, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'prompt_sha256': prompt_hash, 'model': self.name, 'response': response.text,
+                                    'usage': response.usage()}, ensure_ascii=False) + '\n')
+        return response
+
+    def count_tokens(self, prompt: str) -> int:
+        return self.backend.count_tokens(prompt) if self.backend is not None else estimate_tokens(prompt)
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of model responses, one JSON file per request.
+
+    Entries older than `ttl_seconds` are ignored and removed. When the directory grows beyond
+    `max_bytes` the least recently used entries (by file mtime, refreshed on every hit) are evicted.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, ttl_seconds: float = DEFAULT_CACHE_TTL_SECONDS,
+                 max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith('.json'))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[ModelResponse]:
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.ttl_seconds and time.time() - entry.get('created', 0) > self.ttl_seconds:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return ModelResponse(entry['response'], **entry.get('usage', {})) if 'response' in entry else None
+
+    def put(self, key: str, model_name: str, response: ModelResponse) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'model': model_name, 'created': time.time(), 'response': response.text,
+                       'usage': response.usage()}, f, ensure_ascii=False)
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self.size += os.path.getsize(path) - old_size
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _remove(self, path: str) -> None:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self.size -= size
+
+    def _evict(self) -> None:
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.name.endswith('.json')),
+                         key=lambda entry: entry.stat().st_mtime)
+        target = self.max_bytes * 0.9
+        for entry in entries:
+            if self.size <= target:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.size -= size
+            except OSError:
+                continue
+
+
+class UsageTracker:
+    """Collects the token counts and latency of every call, grouped by the phase that made it.
+
+    Responses served from the cache are counted as cached calls and add no billed tokens.
+    """
+
+    FIELDS = ('prompt_tokens', 'candidates_tokens', 'total_tokens')
+
+    def __init__(self):
+        self.calls: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def record(self, phase: str, response: ModelResponse, latency: float, cached: bool = False) -> None:
+        with self._lock:
+            self.calls.append({'phase': phase, 'cached': cached, 'latency_seconds': round(latency, 4),
+                               **response.usage()})
+
+    def by_phase(self) -> Dict[str, Dict]:
+        phases: Dict[str, Dict] = {}
+        with self._lock:
+            calls = list(self.calls)
+        for call in calls:
+            phase = phases.setdefault(call['phase'], {'calls': 0, 'cached_calls': 0, 'latency_seconds': 0.0,
+                                                      **{field: 0 for field in self.FIELDS}})
+            phase['latency_seconds'] += call['latency_seconds']
+            if call['cached']:
+                phase['cached_calls'] += 1
+                continue
+            phase['calls'] += 1
+            for field in self.FIELDS:
+                phase[field] += call[field]
+        return phases
+
+    def totals(self) -> Dict:
+        totals = {'calls': 0, 'cached_calls': 0, 'latency_seconds': 0.0, **{field: 0 for field in self.FIELDS}}
+        for phase in self.by_phase().values():
+            for field in totals:
+                totals[field] += phase[field]
+        return totals
+
+
+def save_usage(record: Dict, filepath: str = DEFAULT_USAGE_FILE) -> None:
+    """Appends one run's usage record to the usage history."""
+    with open(filepath, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+class LLMClient:
+    """Sends prompts to a model backend with a concurrency limit, rate limits, retries and a cache.
+
+    Cached responses are returned without touching the rate limits or the backend.
+    """
+
+    def __init__(self, backend: ModelBackend, cache: Optional[ResponseCache] = None,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: float = DEFAULT_TOKENS_PER_MINUTE,
+                 timeout: float = DEFAULT_TIMEOUT_SECONDS, max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff_base: float = BACKOFF_BASE_SECONDS, backoff_max: float = BACKOFF_MAX_SECONDS,
+                 max_prompt_tokens: Optional[int] = DEFAULT_MAX_PROMPT_TOKENS):
+        self.backend = backend
+        self.cache = cache
+        self.concurrency = max(1, concurrency)
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.timeout = timeout
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+        self._stats_lock = threading.Lock()
+        self.requests_sent = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.rate_limit_wait = 0.0
+        self.interrupted_streams = 0
+        self.max_prompt_tokens = max_prompt_tokens
+        self.usage = UsageTracker()
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter for the given retry attempt (starting at 0)."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def check_budget(self, prompt: str) -> int:
+        """Returns the prompt's token count, raising PromptTooLargeError if it exceeds the budget.
+
+        Prompts whose estimate is well below the budget are not sent to the model's token counter.
+        """
+        tokens = estimate_tokens(prompt)
+        if not self.max_prompt_tokens or tokens < self.max_prompt_tokens * EXACT_COUNT_THRESHOLD:
+            return tokens
+        tokens = self.count_tokens(prompt, tokens)
+        if tokens > self.max_prompt_tokens:
+            raise PromptTooLargeError(tokens, self.max_prompt_tokens)
+        return tokens
+
+    def count_tokens(self, prompt: str, estimate: int) -> int:
+        """The backend's token count of the prompt, retrying transient failures like generate();
+        returns the estimate if the count cannot be had."""
+        attempt = 0
+        while True:
+            try:
+                return self.backend.count_tokens(prompt)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    print(f"  [WARN] Could not count the prompt tokens ({type(e).__name__}: {e}); "
+                          f"using the estimate of {estimate}.")
+                    return estimate
+                error = e
+            delay = self.backoff_delay(attempt)
+            attempt += 1
+            with self._stats_lock:
+                self.retries += 1
+            print(f"  [RETRY] Token count failed ({type(error).__name__}: {error}), "
+                  f"retry {attempt}/{self.max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+    def generate(self, prompt: str, phase: str = 'default', on_text: Optional[Callable[[str], None]] = None) -> str:
+        """Sends one prompt and returns the response text, retrying transient failures.
+
+        Token usage is recorded under `phase`. Raises PromptTooLargeError for prompts over budget.
+        With on_text the response is streamed: on_text receives the text in chunks as it arrives.
+        A stream that fails after delivering text is not retried (the text would be delivered
+        twice); the partial text is returned instead and the caller is expected to repair it.
+        """
+        start = time.time()
+        key = prompt_key(self.backend.name, self.backend.params, prompt) if self.cache else None
+        if key:
+            cached = self.cache.get(key)
+            if cached is not None:
+                with self._stats_lock:
+                    self.cache_hits += 1
+                self.usage.record(phase, cached, time.time() - start, cached=True)
+                if on_text is not None:
+                    on_text(cached.text)
+                return cached.text
+
+        prompt_tokens = self.check_budget(prompt)
+        attempt = 0
+        while True:
+            with self._slots:
+                waited = self.request_bucket.acquire()
+                waited += self.token_bucket.acquire(prompt_tokens)
+                with self._stats_lock:
+                    self.requests_sent += 1
+                    self.rate_limit_wait += waited
+                delivered = []
+                try:
+                    if on_text is None:
+                        response = self.backend.generate(prompt, self.timeout)
+                    else:
+                        response = self.backend.stream(prompt, lambda text: (delivered.append(text), on_text(text)),
+                                                       self.timeout)
+                    self.token_bucket.charge(response.total_tokens - prompt_tokens)
+                    self.usage.record(phase, response, time.time() - start)
+                    if key:
+                        self.cache.put(key, self.backend.name, response)
+                    return response.text
+                except Exception as e:
+                    if delivered:
+                        partial = ModelResponse.estimated(prompt, ''.join(delivered))
+                        self.token_bucket.charge(partial.total_tokens - prompt_tokens)
+                        self.usage.record(phase, partial, time.time() - start)
+                        with self._stats_lock:
+                            self.interrupted_streams += 1
+                        print(f"\n  [WARN] The response stream broke off after {len(partial.text)} characters "
+                              f"({type(e).__name__}: {e}); keeping the partial response.")
+                        return partial.text
+                    if attempt >= self.max_retries or not is_retryable(e):
+                        raise
+                    error = e
+            delay = self.backoff_delay(attempt)
+            attempt += 1
+            with self._stats_lock:
+                self.retries += 1
+            print(f"  [RETRY] Request failed ({type(error).__name__}: {error}), "
+                  f"retry {attempt}/{self.max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+    def map(self, fn: Callable, items: Iterable) -> List:
+        """Runs fn over items on up to `concurrency` threads and returns the results in input order.
+
+        fn is expected to call generate() and handle its own errors.
+        """
+        items = list(items)
+        if self.concurrency == 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(fn, items))
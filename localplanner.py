@@ -0,0 +1,114 @@
+import os
+import re
+from collections import defaultdict
+from typing import Dict, List, Tuple
+import numpy as np
+
+# Target number of documents per leaf folder and the maximum number of subfolders per level
+DEFAULT_FOLDER_SIZE = 50
+MAX_BRANCHES = 20
+
+# Keywords used in a folder label, and the fallback folder for documents without an embedding
+LABEL_KEYWORDS = 2
+UNSORTED_FOLDER = 'Unsorted'
+
+
+def document_text(doc: Dict) -> str:
+    """Text used for folder labels: the file name (without extension), title and summary."""
+    stem = os.path.splitext(os.path.basename(doc['file_path']))[0]
+    return " ".join([re.sub(r'[_\-.]+', ' ', stem), doc.get('title') or '', doc.get('summary') or ''])
+
+
+def kmeans_labels(vectors: np.ndarray, n_clusters: int, seed: int = 0) -> np.ndarray:
+    """Assigns each row to one of n_clusters with mini-batch k-means."""
+    from sklearn.cluster import MiniBatchKMeans
+    n_clusters = min(n_clusters, len(vectors))
+    if n_clusters <= 1:
+        return np.zeros(len(vectors), dtype=int)
+    return MiniBatchKMeans(n_clusters=n_clusters, random_state=seed, n_init=1,
+                           batch_size=min(2048, len(vectors))).fit_predict(vectors)
+
+
+def branch_count(n_docs: int, folder_size: int, levels_left: int) -> int:
+    """Number of subfolders for n_docs so that `levels_left` levels end near folder_size documents."""
+    if n_docs <= folder_size:
+        return 1
+    return int(min(MAX_BRANCHES, np.ceil((n_docs / folder_size) ** (1.0 / levels_left))))
+
+
+def label_cluster(scores: np.ndarray, terms: np.ndarray, used: set) -> str:
+    """Builds a folder name from the highest-scoring terms, unique among its siblings."""
+    top = [terms[i] for i in np.argsort(-scores)[:LABEL_KEYWORDS * 3] if scores[i] > 0]
+    words = top[:LABEL_KEYWORDS] or ['Group']
+    name = "_".join(word.capitalize() for word in words)
+    candidate, suffix = name, 2
+    while candidate in used:
+        candidate = f"{name}_{suffix}"
+        suffix += 1
+    used.add(candidate)
+    return candidate
+
+
+def cluster_scores(tfidf, indices: np.ndarray) -> np.ndarray:
+    """Mean TF-IDF weight of every term over the given documents."""
+    return np.asarray(tfidf[indices].mean(axis=0)).ravel()
+
+
+def plan_local(document_data: List[Dict], document_vectors: Dict[str, np.ndarray],
+               folder_size: int = DEFAULT_FOLDER_SIZE, seed: int = 0) -> Tuple[Dict[str, List[str]], str]:
+    """Builds a two-level {directory: [document IDs]} plan from document embeddings, without any API calls.
+
+    Documents are clustered into top-level folders and each folder into subfolders with k-means;
+    every folder is named after the TF-IDF keywords of its documents' names, titles and summaries
+    that set it apart from its parent. Returns the plan and a short description of how it was made.
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    embedded = [doc for doc in document_data if doc['file_path'] in document_vectors]
+    plan: Dict[str, List[str]] = defaultdict(list)
+    for doc in document_data:
+        if doc['file_path'] not in document_vectors:
+            plan[UNSORTED_FOLDER].append(doc['id'])
+    if not embedded:
+        return dict(plan), "No embeddings were found, so all files were left in one folder."
+
+    vectors = np.stack([np.asarray(document_vectors[doc['file_path']], dtype=np.float32) for doc in embedded])
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    vectorizer = TfidfVectorizer(stop_words='english', max_features=50000, sublinear_tf=True,
+                                 token_pattern=r'(?u)\b[^\W\d_]{3,}\b', dtype=np.float32)
+    try:
+        tfidf = vectorizer.fit_transform([document_text(doc) for doc in embedded]).tocsr()
+        terms = vectorizer.get_feature_names_out()
+    except ValueError:
+        # Empty vocabulary (e.g. no summaries); folders get generic names
+        tfidf, terms = None, np.array([])
+
+    def label(indices: np.ndarray, parent_scores, used: set) -> str:
+        if tfidf is None:
+            return label_cluster(np.zeros(0), terms, used)
+        scores = cluster_scores(tfidf, indices)
+        return label_cluster(scores - parent_scores, terms, used)
+
+    all_indices = np.arange(len(embedded))
+    root_scores = cluster_scores(tfidf, all_indices) if tfidf is not None else None
+    top_labels = kmeans_labels(vectors, branch_count(len(embedded), folder_size, 2), seed)
+    used_top: set = set()
+    folders = 0
+    for top in np.unique(top_labels):
+        top_indices = all_indices[top_labels == top]
+        top_name = label(top_indices, root_scores, used_top)
+        top_scores = cluster_scores(tfidf, top_indices) if tfidf is not None else None
+        sub_labels = kmeans_labels(vectors[top_indices], branch_count(len(top_indices), folder_size, 1), seed)
+        used_sub: set = set()
+        subclusters = np.unique(sub_labels)
+        for sub in subclusters:
+            sub_indices = top_indices[sub_labels == sub]
+            directory = top_name if len(subclusters) == 1 else f"{top_name}/{label(sub_indices, top_scores, used_sub)}"
+            plan[directory].extend(embedded[i]['id'] for i in sub_indices)
+            folders += 1
+
+    reasoning = (f"Local plan: {len(embedded)} documents were grouped by content into {folders} folders with "
+                 f"k-means over their embeddings (about {folder_size} files per folder, at most two levels). "
+                 f"Folder names are the keywords from file names, titles and summaries that best distinguish "
+                 f"each group from its parent folder. No AI requests were made.")
+    return dict(plan), reasoning
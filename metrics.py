@@ -0,0 +1,301 @@
+import os
+import sys
+import time
+import threading
+import contextlib
+from typing import Dict, List, Optional, Tuple
+from documentstore import JsonlWriter
+
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket is unbounded
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+                   float('inf'))
+
+# File size buckets used as a label, as (upper bound in bytes, label)
+SIZE_BUCKETS = ((100 * 1024, '<100KB'), (1024 ** 2, '100KB-1MB'), (10 * 1024 ** 2, '1MB-10MB'),
+                (100 * 1024 ** 2, '10MB-100MB'), (float('inf'), '>=100MB'))
+
+# Prefix of every exported Prometheus metric
+METRIC_PREFIX = 'docorg'
+
+# Trace records are fsynced after this many spans
+TRACE_CHECKPOINT_EVERY = 1000
+
+
+def size_bucket(size: Optional[int]) -> Optional[str]:
+    """Returns the size bucket label of a file size in bytes."""
+    if size is None:
+        return None
+    return next(label for bound, label in SIZE_BUCKETS if size < bound)
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """Peak resident set size of this process so far, or None where it cannot be read."""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            info = psutil.Process().memory_info()
+            return getattr(info, 'peak_wset', info.rss)
+        except ImportError:
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class SpanStats:
+    """Aggregated spans of one series (a stage with one set of labels): a latency histogram,
+    totals and the highest peak RSS seen when a span ended."""
+
+    def __init__(self):
+        self.count = 0
+        self.items = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.peak_rss_bytes: Optional[int] = None
+
+    def add(self, seconds: float, items: int, rss: Optional[int]) -> None:
+        self.count += 1
+        self.items += items
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bucket_counts[next(i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound)] += 1
+        if rss is not None:
+            self.peak_rss_bytes = max(self.peak_rss_bytes or 0, rss)
+
+    def merge(self, other: 'SpanStats') -> None:
+        self.count += other.count
+        self.items += other.items
+        self.total_seconds += other.total_seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+        self.bucket_counts = [a + b for a, b in zip(self.bucket_counts, other.bucket_counts)]
+        if other.peak_rss_bytes is not None:
+            self.peak_rss_bytes = max(self.peak_rss_bytes or 0, other.peak_rss_bytes)
+
+    def state(self) -> Dict:
+        """The raw aggregates, from which from_state rebuilds these stats (e.g. in another process)."""
+        return {'count': self.count, 'items': self.items, 'total_seconds': self.total_seconds,
+                'max_seconds': self.max_seconds, 'bucket_counts': list(self.bucket_counts),
+                'peak_rss_bytes': self.peak_rss_bytes}
+
+    @classmethod
+    def from_state(cls, state: Dict) -> 'SpanStats':
+        stats = cls()
+        stats.count, stats.items = state['count'], state['items']
+        stats.total_seconds, stats.max_seconds = state['total_seconds'], state['max_seconds']
+        stats.bucket_counts = list(state['bucket_counts'])
+        stats.peak_rss_bytes = state.get('peak_rss_bytes')
+        return stats
+
+    def quantile(self, q: float) -> float:
+        """Estimates a latency quantile by interpolating inside its histogram bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.bucket_counts):
+            if count and seen + count >= rank:
+                lower = LATENCY_BUCKETS[i - 1] if i else 0.0
+                upper = min(LATENCY_BUCKETS[i], self.max_seconds)
+                return lower + (upper - lower) * max(0.0, rank - seen) / count
+            seen += count
+        return self.max_seconds
+
+    def to_dict(self) -> Dict:
+        return {'count': self.count, 'items': self.items, 'total_seconds': round(self.total_seconds, 4),
+                'mean_seconds': round(self.total_seconds / self.count, 4) if self.count else 0.0,
+                'p50_seconds': round(self.quantile(0.5), 4), 'p95_seconds': round(self.quantile(0.95), 4),
+                'max_seconds': round(self.max_seconds, 4), 'peak_rss_bytes': self.peak_rss_bytes}
+
+
+class Metrics:
+    """Counters, gauges, value averages and timing spans of one script run.
+
+    Every span is aggregated per stage and label set (e.g. file_type and size_bucket) and, once
+    open_trace is called, also written as one record to a JSON-lines trace. Thread-safe.
+    """
+
+    def __init__(self, script: str):
+        self.script = script
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.values: Dict[str, List[float]] = {}
+        self.spans: Dict[Tuple[str, Tuple], SpanStats] = {}
+        self._trace: Optional[JsonlWriter] = None
+        self._lock = threading.Lock()
+
+    def open_trace(self, filepath: str) -> None:
+        self._trace = JsonlWriter(filepath, checkpoint_every=TRACE_CHECKPOINT_EVERY)
+
+    def count(self, name: str, amount: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def counter(self, name: str) -> float:
+        return self.counters.get(name, 0)
+
+    def set(self, name: str, value: float) -> None:
+        with self._lock:
+            self.gauges[name] = value
+
+    def gauge(self, name: str, default: float = 0) -> float:
+        return self.gauges.get(name, default)
+
+    def record(self, name: str, value: float, count: int = 1) -> None:
+        """Adds `count` values summing to `value` to a running average (e.g. summary length),
+        without keeping the values."""
+        with self._lock:
+            total = self.values.setdefault(name, [0.0, 0])
+            total[0] += value
+            total[1] += count
+
+    def average(self, name: str) -> float:
+        total, count = self.values.get(name, (0.0, 0))
+        return total / count if count else 0.0
+
+    def observe(self, stage: str, seconds: float, file_path: Optional[str] = None, size: Optional[int] = None,
+                items: int = 1, rss: Optional[int] = None, **labels) -> None:
+        """Records one finished span. file_path sets the file_type label (its extension) and size
+        the size_bucket label; rss defaults to this process's peak RSS."""
+        if file_path is not None:
+            labels.setdefault('file_type', os.path.splitext(file_path)[1].lower() or 'none')
+        if size is not None:
+            labels['size_bucket'] = size_bucket(size)
+        labels = {key: str(value) for key, value in labels.items() if value is not None}
+        rss = peak_rss_bytes() if rss is None else rss
+        key = (stage, tuple(sorted(labels.items())))
+        with self._lock:
+            self.spans.setdefault(key, SpanStats()).add(seconds, items, rss)
+            if self._trace is not None:
+                self._trace.write({'ts': round(time.time(), 3), 'script': self.script, 'stage': stage,
+                                   'seconds': round(seconds, 6), 'items': items, 'file_path': file_path,
+                                   'size_bytes': size, 'peak_rss_bytes': rss, **labels})
+
+    @contextlib.contextmanager
+    def span(self, stage: str, file_path: Optional[str] = None, size: Optional[int] = None, items: int = 1,
+             **labels):
+        """Times the enclosed block as one span of `stage`; a span that raises gets error="true"."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            labels['error'] = 'true'
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start_time, file_path, size, items, **labels)
+
+    def stage_stats(self, stage: str, by: Optional[str] = None) -> Dict[str, SpanStats]:
+        """Merges the series of a stage, per value of the `by` label (all under '' without one)."""
+        merged: Dict[str, SpanStats] = {}
+        with self._lock:
+            series = [(dict(labels), stats) for (name, labels), stats in self.spans.items() if name == stage]
+        for labels, stats in series:
+            merged.setdefault(labels.get(by, '') if by else '', SpanStats()).merge(stats)
+        return merged
+
+    def total(self, stage: str) -> SpanStats:
+        """All spans of a stage merged (empty if the stage never ran)."""
+        return self.stage_stats(stage).get('', SpanStats())
+
+    def stages(self) -> List[str]:
+        return sorted({stage for stage, _ in self.spans})
+
+    def to_dict(self) -> Dict:
+        """Everything collected so far, with per-stage totals broken down by file type and size bucket."""
+        stages = {}
+        for stage in self.stages():
+            stages[stage] = {
+                'total': self.total(stage).to_dict(),
+                'by_file_type': {key: stats.to_dict() for key, stats in self.stage_stats(stage, 'file_type').items()
+                                 if key},
+                'by_size_bucket': {key: stats.to_dict()
+                                   for key, stats in self.stage_stats(stage, 'size_bucket').items() if key},
+            }
+        with self._lock:
+            series = [{'stage': stage, 'labels': dict(labels), **stats.state()}
+                      for (stage, labels), stats in sorted(self.spans.items())]
+            value_totals = {name: list(total) for name, total in self.values.items()}
+        return {'script': self.script, 'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                'averages': {name: self.average(name) for name in self.values}, 'stages': stages,
+                'peak_rss_bytes': peak_rss_bytes(), 'series': series, 'value_totals': value_totals}
+
+    def merge(self, data: Dict) -> None:
+        """Adds the metrics of another run, as saved by to_dict (e.g. the shards of a sharded run):
+        counters, averages and spans are combined, and gauges are overwritten."""
+        with self._lock:
+            for name, value in data.get('counters', {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            self.gauges.update(data.get('gauges', {}))
+            for name, (value, count) in data.get('value_totals', {}).items():
+                total = self.values.setdefault(name, [0.0, 0])
+                total[0] += value
+                total[1] += count
+            for series in data.get('series', []):
+                key = (series['stage'], tuple(sorted(series['labels'].items())))
+                self.spans.setdefault(key, SpanStats()).merge(SpanStats.from_state(series))
+
+    def write_prometheus(self, filepath: str) -> None:
+        """Writes the metrics in the Prometheus text format, replacing the file atomically so a
+        node_exporter textfile collector never reads a partial file."""
+        def label_text(labels: Dict) -> str:
+            escaped = {key: str(value).replace('\\', '\\\\').replace('"', '\\"') for key, value in labels.items()}
+            return '{' + ','.join(f'{key}="{value}"' for key, value in escaped.items()) + '}'
+
+        script = {'script': self.script}
+        lines = [f"# TYPE {METRIC_PREFIX}_stage_duration_seconds histogram"]
+        with self._lock:
+            spans = sorted(self.spans.items())
+            counters, gauges = dict(self.counters), dict(self.gauges)
+        for (stage, labels), stats in spans:
+            series = {**script, 'stage': stage, **dict(labels)}
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats.bucket_counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{METRIC_PREFIX}_stage_duration_seconds_bucket{label_text({**series, 'le': le})} "
+                             f"{cumulative}")
+            lines.append(f"{METRIC_PREFIX}_stage_duration_seconds_sum{label_text(series)} {stats.total_seconds}")
+            lines.append(f"{METRIC_PREFIX}_stage_duration_seconds_count{label_text(series)} {stats.count}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_stage_items_total counter")
+        for (stage, labels), stats in spans:
+            lines.append(f"{METRIC_PREFIX}_stage_items_total"
+                         f"{label_text({**script, 'stage': stage, **dict(labels)})} {stats.items}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_stage_peak_rss_bytes gauge")
+        for stage in self.stages():
+            peak = self.total(stage).peak_rss_bytes
+            if peak is not None:
+                lines.append(f"{METRIC_PREFIX}_stage_peak_rss_bytes{label_text({**script, 'stage': stage})} {peak}")
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name}_total counter")
+            lines.append(f"{METRIC_PREFIX}_{name}_total{label_text(script)} {value}")
+        for name, value in sorted(gauges.items()):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+            lines.append(f"{METRIC_PREFIX}_{name}{label_text(script)} {value}")
+        peak = peak_rss_bytes()
+        if peak is not None:
+            lines.append(f"# TYPE {METRIC_PREFIX}_peak_rss_bytes gauge")
+            lines.append(f"{METRIC_PREFIX}_peak_rss_bytes{label_text(script)} {peak}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_last_run_timestamp_seconds gauge")
+        lines.append(f"{METRIC_PREFIX}_last_run_timestamp_seconds{label_text(script)} {time.time():.0f}")
+
+        tmp_file = f"{filepath}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, filepath)
+
+    def print_stage_report(self, by: str = 'file_type') -> None:
+        """Prints each stage's latency, and per `by` label value, slowest mean first."""
+        for stage in self.stages():
+            total = self.total(stage)
+            print(f"Stage '{stage}': {total.count} spans, {total.total_seconds:.2f}s, "
+                  f"p50 {total.quantile(0.5):.3f}s, p95 {total.quantile(0.95):.3f}s, max {total.max_seconds:.3f}s")
+            groups = {key: stats for key, stats in self.stage_stats(stage, by).items() if key}
+            for key, stats in sorted(groups.items(), key=lambda item: -item[1].total_seconds / item[1].count):
+                print(f"  {key}: {stats.count} spans, mean {stats.total_seconds / stats.count:.3f}s, "
+                      f"p95 {stats.quantile(0.95):.3f}s")
+
+    def close(self) -> None:
+        if self._trace is not None:
+            self._trace.close()
@@ -0,0 +1,246 @@
+import re
+import json
+from typing import Dict, List, Optional, Tuple
+
+# Line separating the JSON plan from the reasoning in plan responses
+SECTION_SEPARATOR = '-----'
+
+# Loose tokens of a list whose JSON is malformed: double- or single-quoted strings, or bare words
+LOOSE_LIST_ITEM = re.compile(r'"((?:[^"\\]|\\.)*)"|\'([^\']*)\'|([^\s,"\'\[\]]+)')
+QUOTED_STRING = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+
+class PlanParseResult:
+    """A parsed plan response: {directory: [file IDs]}, the reasoning text, and whether the JSON
+    object was complete (False for a response that was cut off and repaired)."""
+
+    def __init__(self, plan: Dict[str, List[str]], reasoning: str, complete: bool, repairs: int):
+        self.plan = plan
+        self.reasoning = reasoning
+        self.complete = complete
+        self.repairs = repairs
+
+
+def find_string_end(text: str, start: int) -> int:
+    """Index just past the string literal opening at `start`, or -1 if it is not closed yet."""
+    quote = text[start]
+    i = start + 1
+    while i < len(text):
+        if text[i] == '\\':
+            i += 2
+            continue
+        if text[i] == quote:
+            return i + 1
+        i += 1
+    return -1
+
+
+def decode_string(literal: str) -> str:
+    """Decodes a double- or single-quoted string literal, keeping its content if the escapes are broken."""
+    if literal.startswith("'"):
+        literal = '"' + literal[1:-1].replace('"', '\\"') + '"'
+    try:
+        return json.loads(literal)
+    except json.JSONDecodeError:
+        return literal[1:-1]
+
+
+def parse_loose_list(body: str) -> Tuple[List[str], bool]:
+    """Parses the items of a JSON list body (without brackets), tolerating malformed JSON.
+
+    Returns the items and whether the body was valid JSON.
+    """
+    try:
+        items = json.loads(f"[{body}]")
+        return [str(item) for item in items if not isinstance(item, (list, dict))], True
+    except json.JSONDecodeError:
+        return [next(group for group in match.groups() if group is not None)
+                for match in LOOSE_LIST_ITEM.finditer(body)], False
+
+
+class PlanStreamParser:
+    """Incremental parser for plan responses: a JSON object of {directory: [file IDs]}, a line with
+    "-----", then the reasoning.
+
+    Text is fed as it arrives; feed() returns every directory whose file list was completed by the
+    new text, and reasoning_delta() the reasoning received since the last call. The parser is
+    tolerant: code fences and text around the object are skipped, nested objects are flattened into
+    "parent/child" paths, and malformed lists (single quotes, bare IDs, trailing commas) are read
+    item by item. finish() repairs a response that was cut off by keeping every completed entry and
+    the complete IDs of a truncated last list.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.pos = 0
+        self.state = 'start'
+        self.prefix: List[str] = []
+        self.key: Optional[str] = None
+        self.plan: Dict[str, List[str]] = {}
+        self.repairs = 0
+        self._reasoning: List[str] = []
+        self._reasoning_sent = 0
+
+    @property
+    def plan_complete(self) -> bool:
+        return self.state in ('after', 'reasoning')
+
+    def feed(self, text: str) -> List[Tuple[str, List[str]]]:
+        self.buffer += text
+        completed = []
+        while True:
+            entry = self._step()
+            if entry is None:
+                break
+            if entry is not True:
+                completed.append(entry)
+        # Drop the consumed text
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        return completed
+
+    def _add(self, key: str, doc_ids: List[str]) -> Tuple[str, List[str]]:
+        directory = '/'.join(part.strip('/') for part in self.prefix + [key] if part.strip('/'))
+        self.plan.setdefault(directory, []).extend(doc_ids)
+        return directory, doc_ids
+
+    def _skip_space(self) -> None:
+        while self.pos < len(self.buffer) and (self.buffer[self.pos].isspace() or self.buffer[self.pos] == ','):
+            self.pos += 1
+
+    def _step(self):
+        """Consumes one token; returns a completed (directory, IDs) entry, True to continue, or None
+        when more text is needed."""
+        buffer = self.buffer
+        if self.state == 'start':
+            start = buffer.find('{', self.pos)
+            if start < 0:
+                self.pos = len(buffer)
+                return None
+            self.pos = start + 1
+            self.state = 'key'
+            return True
+
+        if self.state == 'key':
+            self._skip_space()
+            if self.pos >= len(buffer):
+                return None
+            char = buffer[self.pos]
+            if char == '}':
+                self.pos += 1
+                if self.prefix:
+                    self.prefix.pop()
+                else:
+                    self.state = 'after'
+                return True
+            if char not in '"\'':
+                # Stray character (e.g. a comment or a missing quote); skip it
+                self.pos += 1
+                self.repairs += 1
+                return True
+            end = find_string_end(buffer, self.pos)
+            colon = buffer.find(':', end) if end >= 0 else -1
+            if colon < 0:
+                return None
+            self.key = decode_string(buffer[self.pos:end])
+            self.pos = colon + 1
+            self.state = 'value'
+            return True
+
+        if self.state == 'value':
+            while self.pos < len(buffer) and buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos >= len(buffer):
+                return None
+            char = buffer[self.pos]
+            if char == '{':
+                self.prefix.append(self.key)
+                self.pos += 1
+                self.state = 'key'
+                return True
+            if char in '"\'':
+                # A single ID instead of a list
+                end = find_string_end(buffer, self.pos)
+                if end < 0:
+                    return None
+                entry = self._add(self.key, [decode_string(buffer[self.pos:end])])
+                self.pos = end
+                self.state = 'key'
+                return entry
+            if char != '[':
+                self.repairs += 1
+                self.state = 'key'
+                return True
+            end = self._list_end(self.pos)
+            if end < 0:
+                return None
+            doc_ids, well_formed = parse_loose_list(buffer[self.pos + 1:end - 1])
+            if not well_formed:
+                self.repairs += 1
+            entry = self._add(self.key, doc_ids)
+            self.pos = end
+            self.state = 'key'
+            return entry
+
+        if self.state == 'after':
+            separator = buffer.find(SECTION_SEPARATOR, self.pos)
+            if separator < 0:
+                # Keep enough text to recognise a separator split across chunks
+                self.pos = max(self.pos, len(buffer) - len(SECTION_SEPARATOR))
+                return None
+            self.pos = separator + len(SECTION_SEPARATOR)
+            self.state = 'reasoning'
+            return True
+
+        # Reasoning: pass text through, holding back backticks that may start a code fence
+        text = buffer[self.pos:]
+        held = len(text) - len(text.rstrip('`'))
+        self._reasoning.append(text[:len(text) - held])
+        self.pos = len(buffer) - held
+        return None
+
+    def _list_end(self, start: int) -> int:
+        """Index just past the ']' closing the list at `start`, skipping brackets inside strings."""
+        i = start + 1
+        while i < len(self.buffer):
+            char = self.buffer[i]
+            if char in '"\'':
+                end = find_string_end(self.buffer, i)
+                if end < 0:
+                    return -1
+                i = end
+                continue
+            if char == ']':
+                return i + 1
+            i += 1
+        return -1
+
+    def reasoning_delta(self) -> str:
+        """Reasoning text received since the last call, without code fences."""
+        text = ''.join(self._reasoning)[self._reasoning_sent:]
+        self._reasoning_sent += len(text)
+        return text.replace('```json', '').replace('```', '')
+
+    def finish(self) -> PlanParseResult:
+        """Ends the response and returns the (repaired, if cut off) plan and the reasoning."""
+        complete = self.plan_complete
+        if self.state == 'value' and self.key is not None and self.buffer[self.pos:].lstrip().startswith('['):
+            # The response ended inside a list: keep the IDs that arrived in full
+            doc_ids = [decode_string(f'"{match.group(1)}"')
+                       for match in QUOTED_STRING.finditer(self.buffer, self.buffer.index('[', self.pos))]
+            if doc_ids:
+                self._add(self.key, doc_ids)
+        if not complete:
+            self.repairs += 1
+        if self.state == 'reasoning':
+            self._reasoning.append(self.buffer[self.pos:])
+            self.pos = len(self.buffer)
+        reasoning = ''.join(self._reasoning).replace('```json', '').replace('```', '').strip()
+        return PlanParseResult(self.plan, reasoning, complete, self.repairs)
+
+
+def parse_plan_response(text: str) -> PlanParseResult:
+    """Parses a complete plan response with the same tolerance and repairs as PlanStreamParser."""
+    parser = PlanStreamParser()
+    parser.feed(text)
+    return parser.finish()
@@ -0,0 +1,481 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+from documentstore import EmbeddingStore, iter_jsonl, load_embeddings, get_record_embedding, EMBEDDINGS_FILE
+
+# Semantic search over the documents summarygenerator.py processed. The index is a directory:
+#   index.json              settings and counts
+#   documents.jsonl         one record (file_path, file_type, summary, title, signature) per document id
+#   document_offsets.npy    byte offset of each record, so results are read without loading the file
+#   vectors.npy, ids.npy    unit embeddings grouped by inverted list, and the document id of each row
+#   centroids.npy, list_offsets.npy   the inverted-file (IVF) partition: a centroid per list and
+#                           where each list starts in vectors.npy
+#   delta.npy, delta_index.jsonl      documents inserted since the last build, searched exhaustively
+#   deleted.json            ids of documents removed or replaced since the last build, skipped by searches
+# A query is compared with the centroids, and only the `nprobe` closest lists (plus the delta) are scored.
+
+DEFAULT_INDEX_DIR = 'search_index'
+INDEX_VERSION = 1
+DEFAULT_TOP_K = 10
+DEFAULT_NPROBE = 16
+
+# Corpora up to this size are searched exhaustively (one list); larger ones get about
+# IVF_LISTS_PER_SQRT * sqrt(n) lists
+BRUTE_FORCE_MAX_DOCUMENTS = 50000
+IVF_LISTS_PER_SQRT = 2
+KMEANS_SAMPLE_PER_LIST = 32
+KMEANS_MAX_SAMPLE = 100000
+KMEANS_ITERATIONS = 8
+# Rows scored per matrix product when assigning or scanning exhaustively
+SCORE_CHUNK_ROWS = 65536
+# The index is rebuilt when the delta and the deleted documents grow beyond this fraction of the built documents
+REBUILD_DELTA_FRACTION = 0.2
+# Summary characters kept per document in the index
+SUMMARY_CHARS = 500
+
+
+def unit_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def default_documents_file() -> str:
+    """processed_documents.json, or the streamed processed_documents.jsonl when only that exists."""
+    return 'processed_documents.json' if os.path.exists('processed_documents.json') else 'processed_documents.jsonl'
+
+
+def iter_processed_documents(documents_file: str,
+                             embeddings_file: str = EMBEDDINGS_FILE) -> Iterator[Tuple[Dict, np.ndarray]]:
+    """Yields (record, embedding) for every document of a summarygenerator.py output that has one."""
+    embeddings = load_embeddings(embeddings_file) if os.path.exists(embeddings_file) else None
+    if documents_file.endswith('.jsonl'):
+        records: Iterable[Dict] = iter_jsonl(documents_file)
+    else:
+        with open(documents_file, 'r', encoding='utf-8') as f:
+            records = json.load(f)
+    for record in records:
+        embedding = get_record_embedding(record, embeddings)
+        if embedding is not None and len(embedding):
+            yield record, embedding
+
+
+def document_signature(record: Dict, embedding: np.ndarray) -> str:
+    """A hash of a processed document's summary, title and embedding, which change when the file is
+    processed again after it changed."""
+    digest = hashlib.sha1(json.dumps([record.get('file_type'), record.get('summary'), record.get('title')],
+                                     ensure_ascii=False).encode('utf-8'))
+    digest.update(np.asarray(embedding, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+def document_entry(record: Dict, embedding: np.ndarray) -> Dict:
+    """The fields of a processed document that are kept in the index and shown with results. An indexed
+    record (when rebuilding) keeps its signature."""
+    entry = {'file_path': record['file_path'], 'file_type': record.get('file_type'),
+             'summary': (record.get('summary') or '')[:SUMMARY_CHARS]}
+    if record.get('title'):
+        entry['title'] = record['title']
+    entry['signature'] = record.get('signature') or document_signature(record, embedding)
+    return entry
+
+
+def spherical_kmeans(sample: np.ndarray, n_lists: int, seed: int = 0) -> np.ndarray:
+    """Unit centroids of n_lists clusters of unit vectors (cosine k-means)."""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        labels = assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        empty = np.bincount(labels, minlength=n_lists) == 0
+        # Restart empty lists from random sample rows
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = unit_rows(sums)
+    return centroids
+
+
+def assign_lists(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the most similar centroid for every row, computed in chunks."""
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), SCORE_CHUNK_ROWS):
+        chunk = np.asarray(vectors[start:start + SCORE_CHUNK_ROWS], dtype=np.float32)
+        labels[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k highest scores, best first."""
+    if len(scores) > k:
+        candidates = np.argpartition(-scores, k)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def build_index(index_dir: str, documents: Iterable[Tuple[Dict, np.ndarray]], n_lists: Optional[int] = None,
+                dtype: str = 'float32', seed: int = 0) -> 'SearchIndex':
+    """Builds a new index from (record, embedding) pairs and replaces index_dir with it.
+
+    Vectors are streamed to disk first, so memory stays bounded for large corpora; the IVF lists
+    are trained on a sample.
+    """
+    tmp_dir = f"{index_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    offsets: List[int] = []
+    staging: Optional[EmbeddingStore] = None
+    with open(os.path.join(tmp_dir, 'documents.jsonl'), 'wb') as f:
+        for record, embedding in documents:
+            vector = unit_rows(embedding)
+            if staging is None:
+                staging = EmbeddingStore(os.path.join(tmp_dir, 'staging.npy'), dim=len(vector),
+                                         checkpoint_every=SCORE_CHUNK_ROWS)
+            offsets.append(f.tell())
+            f.write((json.dumps(document_entry(record, embedding), ensure_ascii=False) + '\n').encode('utf-8'))
+            staging.add(record['file_path'], vector)
+        documents_bytes = f.tell()
+    if staging is None:
+        shutil.rmtree(tmp_dir)
+        raise ValueError("No documents with embeddings to index.")
+    staging.close()
+    np.save(os.path.join(tmp_dir, 'document_offsets.npy'), np.asarray(offsets, dtype=np.int64))
+
+    vectors = load_embeddings(staging.filepath)
+    count, dim = vectors.shape
+    if n_lists is None:
+        n_lists = 1 if count <= BRUTE_FORCE_MAX_DOCUMENTS else int(IVF_LISTS_PER_SQRT * np.sqrt(count))
+    n_lists = max(1, min(n_lists, count))
+    if n_lists == 1:
+        centroids = unit_rows(np.asarray(vectors[:SCORE_CHUNK_ROWS]).sum(axis=0, keepdims=True))
+        labels = np.zeros(count, dtype=np.int32)
+    else:
+        rng = np.random.default_rng(seed)
+        sample_size = min(count, max(n_lists, min(KMEANS_MAX_SAMPLE, n_lists * KMEANS_SAMPLE_PER_LIST)))
+        sample = np.asarray(vectors[np.sort(rng.choice(count, sample_size, replace=False))], dtype=np.float32)
+        centroids = spherical_kmeans(sample, n_lists, seed)
+        labels = assign_lists(vectors, centroids)
+
+    # Write the vectors grouped by list, so each list is one contiguous slice of the memory map
+    order = np.argsort(labels, kind='stable')
+    list_offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))]).astype(np.int64)
+    grouped = np.lib.format.open_memmap(os.path.join(tmp_dir, 'vectors.npy'), mode='w+', dtype=np.dtype(dtype),
+                                        shape=(count, dim))
+    for start in range(0, count, SCORE_CHUNK_ROWS):
+        rows = order[start:start + SCORE_CHUNK_ROWS]
+        grouped[start:start + len(rows)] = vectors[np.sort(rows)][np.argsort(np.argsort(rows))]
+    grouped.flush()
+    del grouped, vectors
+    os.remove(staging.filepath)
+    os.remove(staging.index_filepath)
+    np.save(os.path.join(tmp_dir, 'ids.npy'), order.astype(np.int64))
+    np.save(os.path.join(tmp_dir, 'centroids.npy'), centroids.astype(np.float32))
+    np.save(os.path.join(tmp_dir, 'list_offsets.npy'), list_offsets)
+    with open(os.path.join(tmp_dir, 'index.json'), 'w', encoding='utf-8') as f:
+        json.dump({'version': INDEX_VERSION, 'embed_model': embed_model_name(), 'dim': int(dim), 'count': int(count),
+                   'lists': int(n_lists), 'dtype': dtype, 'documents_bytes': documents_bytes,
+                   'built_at': time.strftime('%Y-%m-%dT%H:%M:%S')}, f, indent=2)
+
+    old_dir = f"{index_dir}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(index_dir):
+        os.replace(index_dir, old_dir)
+    os.replace(tmp_dir, index_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return SearchIndex(index_dir)
+
+
+def embed_model_name() -> str:
+    from summarygenerator import EMBED_MODEL_NAME
+    return EMBED_MODEL_NAME
+
+
+def encode_query(text: str) -> np.ndarray:
+    """Embeds a query with the model the documents were embedded with."""
+    from summarygenerator import get_embed_model
+    return unit_rows(get_embed_model().encode([text], show_progress_bar=False)[0])
+
+
+class SearchIndex:
+    """A built search index opened for queries and inserts; the vectors stay memory-mapped."""
+
+    def __init__(self, index_dir: str = DEFAULT_INDEX_DIR):
+        self.index_dir = index_dir
+        with open(self._path('index.json'), 'r', encoding='utf-8') as f:
+            self.info = json.load(f)
+        if self.info.get('version') != INDEX_VERSION:
+            raise ValueError(f"Search index '{index_dir}' has an unsupported version; rebuild it with --build.")
+        self.count = self.info['count']
+        self.vectors = np.load(self._path('vectors.npy'), mmap_mode='r')
+        self.ids = np.load(self._path('ids.npy'), mmap_mode='r')
+        self.centroids = np.load(self._path('centroids.npy'))
+        self.list_offsets = np.load(self._path('list_offsets.npy'))
+        self.document_offsets = np.load(self._path('document_offsets.npy'), mmap_mode='r')
+        self._load_delta()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
+
+    def _load_delta(self) -> None:
+        """Maps the inserted documents (their vectors and where their records start) and reads the
+        deleted document ids."""
+        self.deleted = np.zeros(0, dtype=np.int64)
+        if os.path.exists(self._path('deleted.json')):
+            with open(self._path('deleted.json'), 'r', encoding='utf-8') as f:
+                self.deleted = np.asarray(sorted(json.load(f)), dtype=np.int64)
+        self.delta_offsets: List[int] = []
+        self.delta = np.zeros((0, self.info['dim']), dtype=np.float32)
+        if not os.path.exists(self._path('delta.npy')):
+            return
+        self.delta = load_embeddings(self._path('delta.npy'))
+        with open(self._path('documents.jsonl'), 'rb') as f:
+            f.seek(self.info['documents_bytes'])
+            while len(self.delta_offsets) < len(self.delta):
+                offset = f.tell()
+                if not f.readline():
+                    break
+                self.delta_offsets.append(offset)
+        # Rows of an interrupted insert that have no record are ignored
+        self.delta = self.delta[:len(self.delta_offsets)]
+
+    def __len__(self) -> int:
+        return self.count + len(self.delta) - len(self.deleted)
+
+    def document(self, doc_id: int) -> Dict:
+        offset = self.document_offsets[doc_id] if doc_id < self.count else self.delta_offsets[doc_id - self.count]
+        with open(self._path('documents.jsonl'), 'rb') as f:
+            f.seek(int(offset))
+            return json.loads(f.readline())
+
+    def signatures(self) -> Tuple[Dict[str, Tuple[int, Optional[str]]], List[int]]:
+        """{file_path: (document id, signature)} of the indexed documents, and the ids of older entries
+        of the same file_path (left by an interrupted update)."""
+        deleted = set(self.deleted.tolist())
+        latest: Dict[str, Tuple[int, Optional[str]]] = {}
+        superseded = []
+        for doc_id, record in enumerate(iter_jsonl(self._path('documents.jsonl'))):
+            if doc_id >= self.count + len(self.delta):
+                break
+            if doc_id in deleted:
+                continue
+            if record['file_path'] in latest:
+                superseded.append(latest[record['file_path']][0])
+            latest[record['file_path']] = (doc_id, record.get('signature'))
+        return latest, superseded
+
+    def remove(self, doc_ids: Iterable[int]) -> int:
+        """Marks documents deleted, so searches skip them until the next build drops them. Returns the count."""
+        deleted = set(self.deleted.tolist())
+        added = set(doc_ids) - deleted
+        if added:
+            tmp_file = self._path('deleted.json.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(sorted(deleted | added), f)
+            os.replace(tmp_file, self._path('deleted.json'))
+            self._load_delta()
+        return len(added)
+
+    def insert(self, documents: Iterable[Tuple[Dict, np.ndarray]]) -> int:
+        """Appends documents to the delta, where they are searchable right away. Returns the count."""
+        store = EmbeddingStore(self._path('delta.npy'), dim=self.info['dim'],
+                               index_filepath=self._path('delta_index.jsonl'), append=True)
+        inserted = 0
+        try:
+            with open(self._path('documents.jsonl'), 'ab') as f:
+                # Drop a record left by an interrupted insert, so record and vector rows stay aligned
+                f.truncate(self.info['documents_bytes'] + self._delta_bytes(store.rows))
+                for record, embedding in documents:
+                    f.write((json.dumps(document_entry(record, embedding), ensure_ascii=False) + '\n').encode('utf-8'))
+                    f.flush()
+                    store.add(record['file_path'], unit_rows(embedding))
+                    inserted += 1
+        finally:
+            store.close()
+        self._load_delta()
+        return inserted
+
+    def _delta_bytes(self, rows: int) -> int:
+        """Size of the first `rows` delta records in documents.jsonl."""
+        size = 0
+        with open(self._path('documents.jsonl'), 'rb') as f:
+            f.seek(self.info['documents_bytes'])
+            for _ in range(rows):
+                size += len(f.readline())
+        return size
+
+    def search(self, query_vector: np.ndarray, k: int = DEFAULT_TOP_K,
+               nprobe: int = DEFAULT_NPROBE) -> List[Tuple[int, float]]:
+        """The k most similar documents as (document id, cosine similarity), best first."""
+        query = unit_rows(query_vector)
+        lists = top_k(self.centroids @ query, min(nprobe, len(self.centroids)))
+        ids, scores = [], []
+        for list_id in lists:
+            start, end = int(self.list_offsets[list_id]), int(self.list_offsets[list_id + 1])
+            for chunk_start in range(start, end, SCORE_CHUNK_ROWS):
+                chunk_end = min(end, chunk_start + SCORE_CHUNK_ROWS)
+                chunk_scores = np.asarray(self.vectors[chunk_start:chunk_end], dtype=np.float32) @ query
+                chunk_ids = np.asarray(self.ids[chunk_start:chunk_end])
+                if len(self.deleted):
+                    chunk_scores[np.isin(chunk_ids, self.deleted)] = -np.inf
+                best = top_k(chunk_scores, k)
+                ids.append(chunk_ids[best])
+                scores.append(chunk_scores[best])
+        if len(self.delta):
+            delta_scores = np.asarray(self.delta, dtype=np.float32) @ query
+            if len(self.deleted):
+                delta_scores[np.isin(np.arange(len(self.delta)) + self.count, self.deleted)] = -np.inf
+            best = top_k(delta_scores, k)
+            ids.append(best + self.count)
+            scores.append(delta_scores[best])
+        if not ids:
+            return []
+        ids, scores = np.concatenate(ids), np.concatenate(scores)
+        best = top_k(scores, k)
+        return [(int(ids[i]), float(scores[i])) for i in best if scores[i] > -np.inf]
+
+    def query(self, text: str, k: int = DEFAULT_TOP_K, nprobe: int = DEFAULT_NPROBE) -> List[Dict]:
+        """Searches for a text query; returns the documents with a 'score'."""
+        return [{**self.document(doc_id), 'score': round(score, 4)}
+                for doc_id, score in self.search(encode_query(text), k, nprobe)]
+
+    def needs_rebuild(self) -> bool:
+        changes = len(self.delta) + len(self.deleted)
+        return changes > REBUILD_DELTA_FRACTION * max(self.count, BRUTE_FORCE_MAX_DOCUMENTS)
+
+    def iter_documents(self) -> Iterator[Tuple[Dict, np.ndarray]]:
+        """Every indexed document that was not deleted, with its vector, in document id order (used to rebuild)."""
+        positions = np.empty(self.count, dtype=np.int64)
+        positions[np.asarray(self.ids)] = np.arange(self.count)
+        deleted = set(self.deleted.tolist())
+        with open(self._path('documents.jsonl'), 'r', encoding='utf-8') as f:
+            for doc_id in range(self.count + len(self.delta)):
+                record = json.loads(f.readline())
+                if doc_id in deleted:
+                    continue
+                if doc_id < self.count:
+                    yield record, np.asarray(self.vectors[positions[doc_id]], dtype=np.float32)
+                else:
+                    yield record, np.asarray(self.delta[doc_id - self.count], dtype=np.float32)
+
+
+def update_index(index_dir: str, documents: Iterable[Tuple[Dict, np.ndarray]],
+                 dtype: str = 'float32') -> SearchIndex:
+    """Brings the index up to date with the processed documents: new documents are inserted, documents
+    whose summary or embedding changed are replaced, and documents no longer among them are removed.
+    Builds the index if there is none and rebuilds it once the changes outgrow the built documents."""
+    if not os.path.exists(os.path.join(index_dir, 'index.json')):
+        return build_index(index_dir, documents, dtype=dtype)
+    index = SearchIndex(index_dir)
+    indexed, superseded = index.signatures()
+    seen = set()
+    replaced: List[int] = []
+    counts = {'new': 0, 'changed': 0}
+
+    def changed_documents() -> Iterator[Tuple[Dict, np.ndarray]]:
+        for record, embedding in documents:
+            file_path = record['file_path']
+            if file_path in seen:
+                continue
+            seen.add(file_path)
+            current = indexed.get(file_path)
+            if current is not None and current[1] == document_signature(record, embedding):
+                continue
+            if current is None:
+                counts['new'] += 1
+            else:
+                counts['changed'] += 1
+                replaced.append(current[0])
+            yield record, embedding
+
+    index.insert(changed_documents())
+    # Replaced entries are removed only once their new version is inserted
+    vanished = [doc_id for file_path, (doc_id, _) in indexed.items() if file_path not in seen]
+    index.remove(replaced + vanished + superseded)
+    print(f"Search index '{index_dir}': {counts['new']} documents inserted, {counts['changed']} replaced, "
+          f"{len(vanished)} removed.")
+    if index.needs_rebuild():
+        print(f"Rebuilding the search index ({len(index.delta)} inserted and {len(index.deleted)} deleted "
+              f"since the last build)...")
+        index = build_index(index_dir, index.iter_documents(), dtype=index.info['dtype'])
+    return index
+
+
+def print_results(results: List[Dict], elapsed_ms: float) -> None:
+    print(f"{len(results)} results in {elapsed_ms:.1f} ms")
+    for rank, result in enumerate(results, 1):
+        missing = '' if os.path.exists(result['file_path']) else ' (moved or deleted)'
+        print(f"{rank:>3}. [{result['score']:.3f}] {result['file_path']}{missing}")
+        if result.get('summary'):
+            print(f"       {result['summary'][:200]}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Search the processed documents by meaning.")
+    parser.add_argument('query', nargs='*', help="Query text; without one, queries are read from stdin.")
+    parser.add_argument('--index-dir', default=DEFAULT_INDEX_DIR, help="Index directory (default: %(default)s).")
+    parser.add_argument('--build', action='store_true', help="(Re)build the index from the processed documents.")
+    parser.add_argument('--update', action='store_true',
+                        help="Insert new and changed processed documents and remove the ones that are gone.")
+    parser.add_argument('--documents', default=None,
+                        help="processed_documents.json(l) to index (default: whichever exists).")
+    parser.add_argument('--embeddings', default=EMBEDDINGS_FILE,
+                        help="Embedding matrix of the documents (default: %(default)s).")
+    parser.add_argument('--lists', type=int, default=None,
+                        help=f"Inverted lists (default: 1 up to {BRUTE_FORCE_MAX_DOCUMENTS} documents, "
+                             f"then {IVF_LISTS_PER_SQRT}*sqrt(n)).")
+    parser.add_argument('--float16', action='store_true', help="Store the index vectors as float16.")
+    parser.add_argument('-k', '--top-k', type=int, default=DEFAULT_TOP_K,
+                        help="Results per query (default: %(default)s).")
+    parser.add_argument('--nprobe', type=int, default=DEFAULT_NPROBE,
+                        help="Lists searched per query; higher is more exact and slower (default: %(default)s).")
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON lines.")
+    args = parser.parse_args(argv)
+
+    documents_file = args.documents or default_documents_file()
+    dtype = 'float16' if args.float16 else 'float32'
+    if args.build or args.update:
+        if not os.path.exists(documents_file):
+            print(f"Error: '{documents_file}' not found. Run summarygenerator.py first.")
+            sys.exit(1)
+        start_time = time.time()
+        documents = iter_processed_documents(documents_file, args.embeddings)
+        if args.build:
+            index = build_index(args.index_dir, documents, args.lists, dtype)
+        else:
+            index = update_index(args.index_dir, documents, dtype)
+        print(f"Search index '{args.index_dir}': {len(index)} documents in {len(index.centroids)} lists "
+              f"({time.time() - start_time:.1f}s)")
+        if not args.query:
+            return
+    if not os.path.exists(os.path.join(args.index_dir, 'index.json')):
+        print(f"Error: no search index in '{args.index_dir}'. Build it with --build.")
+        sys.exit(1)
+    index = SearchIndex(args.index_dir)
+
+    def run_query(text: str) -> None:
+        start_time = time.perf_counter()
+        results = index.query(text, args.top_k, args.nprobe)
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        if args.json:
+            print(json.dumps({'query': text, 'elapsed_ms': round(elapsed_ms, 2), 'results': results},
+                             ensure_ascii=False))
+        else:
+            print_results(results, elapsed_ms)
+
+    if args.query:
+        run_query(' '.join(args.query))
+        return
+    print(f"{len(index)} documents indexed. Enter one query per line (Ctrl+D to quit).", file=sys.stderr)
+    for line in sys.stdin:
+        if line.strip():
+            run_query(line.strip())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,52 +1,43 @@
 import os
 import json
-from typing import List, Dict
-import pandas as pd
-from docling.document_converter import DocumentConverter
-from docling_core.types.doc import DoclingDocument
-from sentence_transformers import SentenceTransformer
+import argparse
+import hashlib
+import fnmatch
+import queue
+import threading
+import socketserver
+import importlib.util
+import sys
+import contextlib
+from typing import List, Dict, Optional, Set
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-from nltk.tokenize import sent_tokenize
-import nltk
 import warnings
-from torch.utils.data import dataloader
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from collections import defaultdict
 import uuid
 from dotenv import load_dotenv
 from pathlib import Path
+from documentstore import (JsonlWriter, EmbeddingStore, prepare_resume, load_embeddings, load_embedding_index,
+                           get_record_embedding, iter_jsonl, rewrite_jsonl, DEFAULT_CHECKPOINT_EVERY, EMBEDDINGS_FILE,
+                           EMBEDDINGS_INDEX_FILE)
+from duplicates import DuplicateIndex, find_near_duplicates, DEFAULT_NEAR_DUPLICATE_THRESHOLD
+from metrics import Metrics, peak_rss_bytes
+from searchindex import update_index, iter_processed_documents
+from workqueue import (WorkQueue, default_worker_id, parse_shard, shard_of, read_manifest, write_manifest,
+                       DEFAULT_LEASE_SECONDS, DEFAULT_CLAIM_BATCH)
+from isolation import (SupervisorPool, QuarantineList, BudgetExceeded, DEFAULT_FILE_TIMEOUT_SECONDS,
+                       DEFAULT_FILE_MEMORY_LIMIT_MB, DEFAULT_QUARANTINE_FILE)
+
+# Heavy dependencies (docling, sentence-transformers/torch, nltk, pandas) are imported on first use,
+# so importing this module and scanning are cheap.
 
 load_dotenv()
-BASE_PATH = Path(os.getenv("BASE_PATH"))
-
-# Disable the specific warning
-warnings.filterwarnings("ignore", 
-    message=".*'pin_memory' argument is set as true but no accelerator is found.*",
-    category=UserWarning,
-    module=dataloader.__name__
-)
-
-# Download NLTK data
-try:
-    nltk.data.find('tokenizers/punkt_tab')
-except LookupError:
-    print("Downloading NLTK punkt_tab resource...")
-    nltk.download('punkt_tab')
-
-# Check for OCR dependencies
-try:
-    import easyocr
-    ocr_easyocr_available = True
-except ImportError:
-    ocr_easyocr_available = False
-    print("Warning: easyocr not installed. Install with 'pip install docling[easyocr]' for OCR support.")
-try:
-    import pytesseract
-    ocr_pytesseract_available = True
-except ImportError:
-    ocr_pytesseract_available = False
-    print("Warning: pytesseract not installed. Install with 'pip install docling[tesseract]' and Tesseract binary for OCR support.")
+BASE_PATH = Path(os.getenv("BASE_PATH")) if os.getenv("BASE_PATH") else None
+
+# Check for OCR dependencies (without importing them)
+ocr_easyocr_available = importlib.util.find_spec('easyocr') is not None
+ocr_pytesseract_available = importlib.util.find_spec('pytesseract') is not None
 
 # Supported file extensions
 supported_extensions = {
@@ -59,149 +50,692 @@ supported_extensions = {
 # base_path = r'YourDirectoryToScan' #eg. C:\Users\Goku\Developments
 base_path = os.environ.get('BASE_PATH', r'C:\Users\support2\Developments')
 
+# File types OCR may be applied to
+ocr_extensions = {'.png', '.tiff', '.jpeg', '.jpg', '.gif', '.bmp', '.pdf'}
+
+# Text-layer detection: pages sampled per PDF, and printable characters per sampled page that
+# mark a PDF as born-digital (converted without OCR)
+TEXT_LAYER_SAMPLE_PAGES = 3
+TEXT_LAYER_MIN_CHARS_PER_PAGE = 50
+
+# Embedding model used for summaries (part of the cache key)
+EMBED_MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# Per-document budget for very large documents: pages converted per PDF (the first half of the
+# budget from the start, the rest in evenly spaced windows) and characters of text kept for the
+# summary and embedding (headings, the opening text and evenly spaced chunks)
+DEFAULT_MAX_PAGES = 40
+DEFAULT_MAX_CHARS = 20000
+PAGE_SAMPLE_WINDOWS = 4
+TEXT_SAMPLE_CHUNKS = 8
+HEADING_LABELS = {'title', 'section_header'}
+
+# Embedding batches: sentences per encoder batch, and batches buffered before encoding
+DEFAULT_EMBED_BATCH_SIZE = 256
+EMBED_FLUSH_BATCHES = 8
+MAX_TABLE_EMBED_LINES = 64
+
+# Excel extraction budget: rows read per sheet and cells read per workbook
+DEFAULT_EXCEL_MAX_ROWS = 200
+DEFAULT_EXCEL_MAX_CELLS = 20000
+
+# Directory walker: names or relative paths skipped while scanning
+DEFAULT_EXCLUDE_GLOBS = ['.git', 'node_modules']
+
+# Pipeline mode: bounded queue size, and seconds the embedding stage waits before flushing a partial batch
+DEFAULT_QUEUE_SIZE = 256
+EMBED_IDLE_FLUSH_SECONDS = 2.0
+
+# Incremental re-scan cache
+CACHE_VERSION = 2
+DEFAULT_CACHE_FILE = 'summary_cache.json'
+
+# KPI report with the per-stage metrics
+DEFAULT_KPI_FILE = 'summarygeneratorkpi.json'
+
+# Sharded runs: per-shard output directories, and how often an idle queue worker checks for
+# files released by expired leases
+DEFAULT_SHARDS_DIR = 'shards'
+QUEUE_POLL_SECONDS = 10
+
+# Command line options
+parser = argparse.ArgumentParser(description="Scan, summarize and embed documents under BASE_PATH.")
+parser.add_argument('--cache-file', default=os.environ.get('SUMMARY_CACHE_FILE', DEFAULT_CACHE_FILE),
+                    help="Path of the incremental re-scan cache (default: %(default)s).")
+parser.add_argument('--no-cache', action='store_true',
+                    help="Ignore the cache and reprocess every file.")
+parser.add_argument('--hash', action='store_true',
+                    help="Also compare file contents (SHA-256) when size or mtime changed.")
+parser.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                    help="Skip files and directories whose name or relative path matches GLOB "
+                         f"(repeatable; always excluded: {', '.join(DEFAULT_EXCLUDE_GLOBS)}).")
+parser.add_argument('--max-file-size', type=float, default=None, metavar='MB',
+                    help="Skip files larger than this many megabytes.")
+parser.add_argument('--pipeline', action='store_true',
+                    help="Run scan, extraction, embedding and writing as concurrent stages connected by "
+                         "bounded queues. Output is written in completion order.")
+parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                    help="Capacity of each pipeline queue (default: %(default)s).")
+parser.add_argument('--workers', type=int, default=int(os.environ.get('SUMMARY_WORKERS', 1)),
+                    help="Number of processes used for document conversion (default: %(default)s).")
+parser.add_argument('--output-format', choices=['json', 'jsonl'], default='json',
+                    help="'jsonl' streams one record per document as soon as it is done (default: %(default)s).")
+parser.add_argument('--checkpoint-every', type=int, default=DEFAULT_CHECKPOINT_EVERY,
+                    help="Streamed records written between fsync checkpoints (default: %(default)s).")
+parser.add_argument('--resume', action='store_true',
+                    help="Skip files already present in the streamed output (implies --output-format jsonl).")
+parser.add_argument('--embedding-format', choices=['npy', 'inline'], default='npy',
+                    help="'npy' writes embeddings to embeddings.npy and stores only the row id in the "
+                         "JSON records; 'inline' keeps the float lists in the records (default: %(default)s).")
+parser.add_argument('--float16', action='store_true',
+                    help="Store embeddings in the .npy matrix as float16 instead of float32.")
+parser.add_argument('--excel-max-rows', type=int, default=DEFAULT_EXCEL_MAX_ROWS,
+                    help="Rows read per Excel sheet (default: %(default)s).")
+parser.add_argument('--excel-max-cells', type=int, default=DEFAULT_EXCEL_MAX_CELLS,
+                    help="Cells read per Excel workbook (default: %(default)s).")
+parser.add_argument('--serve', action='store_true',
+                    help="Run as a warm worker: read JSON-lines requests on stdin and answer on stdout.")
+parser.add_argument('--serve-port', type=int, default=None,
+                    help="Run as a warm worker answering JSON-lines requests on a local TCP port.")
+parser.add_argument('--serve-host', default='127.0.0.1',
+                    help="Interface for --serve-port (default: %(default)s).")
+parser.add_argument('--max-pages', type=int, default=DEFAULT_MAX_PAGES,
+                    help="Pages converted per PDF; longer PDFs are sampled (default: %(default)s, 0 = no limit).")
+parser.add_argument('--max-chars', type=int, default=DEFAULT_MAX_CHARS,
+                    help="Characters of text kept per document for summary and embedding "
+                         "(default: %(default)s, 0 = no limit).")
+parser.add_argument('--ocr', choices=['auto', 'always', 'never'], default='auto',
+                    help="'auto' samples PDF pages and only OCRs files without a text layer (default: %(default)s).")
+parser.add_argument('--no-dedup', action='store_true',
+                    help="Process byte-identical files separately and do not tag near-duplicate versions.")
+parser.add_argument('--near-duplicate-threshold', type=float, default=DEFAULT_NEAR_DUPLICATE_THRESHOLD,
+                    help="Cosine similarity above which documents are tagged as versions of each other "
+                         "(default: %(default)s).")
+parser.add_argument('--embed-batch-size', type=int, default=DEFAULT_EMBED_BATCH_SIZE,
+                    help="Sentences per embedding batch (default: %(default)s).")
+parser.add_argument('--kpi-file', default=DEFAULT_KPI_FILE,
+                    help="Where to save the KPI report with the per-stage breakdown (default: %(default)s).")
+parser.add_argument('--trace', default=None, metavar='FILE',
+                    help="Write one JSON-lines record per timing span (file, stage, seconds, peak memory).")
+parser.add_argument('--metrics-file', default=None, metavar='FILE',
+                    help="Write the metrics in Prometheus text format, e.g. for a node_exporter textfile collector.")
+parser.add_argument('--search-index', default=None, metavar='DIR',
+                    help="Add the processed documents to the semantic search index in DIR (see searchindex.py).")
+parser.add_argument('--file-timeout', type=float, default=DEFAULT_FILE_TIMEOUT_SECONDS, metavar='SECONDS',
+                    help="Stop converting a file after this many seconds and quarantine it (0: no limit; "
+                         "default: %(default)s).")
+parser.add_argument('--file-memory-limit', type=float, default=DEFAULT_FILE_MEMORY_LIMIT_MB, metavar='MB',
+                    help="Stop converting a file once its conversion process uses this much memory and quarantine it "
+                         "(0: no limit; default: %(default)s).")
+parser.add_argument('--quarantine-file', default=DEFAULT_QUARANTINE_FILE,
+                    help="Files stopped by a limit or that crashed the converter; skipped until they change "
+                         "(default: %(default)s).")
+parser.add_argument('--retry-quarantined', action='store_true',
+                    help="Try the quarantined files again.")
+parser.add_argument('--no-isolation', action='store_true',
+                    help="Convert in this process (or a plain process pool), without time and memory limits.")
+parser.add_argument('--write-manifest', default=None, metavar='FILE',
+                    help="Only scan, and write the files to process to a work manifest (and to --queue if given).")
+parser.add_argument('--manifest', default=None, metavar='FILE',
+                    help="Process the files of a work manifest instead of scanning BASE_PATH.")
+parser.add_argument('--shard', default=None, metavar='I/N',
+                    help="Process only shard I of N (a hash partition of the files), writing to a shard directory.")
+parser.add_argument('--queue', default=None, metavar='DB',
+                    help="Claim files from a shared SQLite work queue (seeded with --write-manifest) until it is empty.")
+parser.add_argument('--worker-id', default=None,
+                    help="Name of this queue worker (default: hostname-pid).")
+parser.add_argument('--lease-seconds', type=float, default=DEFAULT_LEASE_SECONDS,
+                    help="Seconds before the files of a worker that stopped are given to another (default: %(default)s).")
+parser.add_argument('--claim-batch', type=int, default=DEFAULT_CLAIM_BATCH,
+                    help="Files claimed from the queue at a time (default: %(default)s).")
+parser.add_argument('--shard-dir', default=None, metavar='DIR',
+                    help=f"Output directory of this shard or worker (default: {DEFAULT_SHARDS_DIR}/<shard or worker>).")
+parser.add_argument('--merge-shards', nargs='+', default=None, metavar='DIR',
+                    help="Merge shard directories (or a directory of them) into the outputs and a combined KPI report.")
+
 # List to hold paths of supported documents
 supported_files: List[str] = []
 
-# KPI tracking variables
-processing_times: List[float] = []
-error_count: int = 0
-successful_count: int = 0
-ocr_eligible_files: List[str] = []
-ocr_processed_files: List[str] = []
+# Instrumentation: counters, timing spans per file and stage (convert, ocr, excel, encode, summarize,
+# document) and averages; the KPI report is computed from it
+metrics = Metrics('summarygenerator')
 file_types_processed: set = set()
-summary_lengths: List[int] = []
-cosine_similarities: List[float] = []
-output_files_success: List[str] = []
-
-# Step 1: Scan directory
-print("Scanning for documents supported by Docling...")
-for root, _, files in os.walk(base_path):
-    for file in files:
-        ext = os.path.splitext(file)[1].lower()
-        if ext in supported_extensions:
-            file_path = os.path.join(root, file)
-            supported_files.append(file_path)
-            file_types_processed.add(ext)
-            print(f"Found: {file_path}")
-            if ext in {'.png', '.tiff', '.jpeg', '.jpg', '.gif', '.bmp', '.pdf'}:
-                ocr_eligible_files.append(file_path)
-                print(f"  -> OCR may be applied for this file.")
-
-print(f"\nTotal supported documents found: {len(supported_files)}")
-
-if not supported_files:
-    print("No supported documents found. Exiting.")
-    exit()
-
-# Load embedding model
-embed_model = SentenceTransformer('all-MiniLM-L6-v2')
-
-# Initialize document converter
-converter = DocumentConverter()
-
-# Output lists
+
+# Embedding model and per-process document converters (loaded on first use) and extraction options
+embed_model = None
+converters: Dict[bool, object] = {}
+extraction_options: Dict = {}
+nltk_data_ready: bool = False
+
+# Output lists, or streaming writers when the JSONL output format is used
 output_data: List[Dict] = []
 llm_input_data: List[Dict] = []
+output_writers: Optional[tuple] = None
+embedding_store: Optional[EmbeddingStore] = None
 
-# Function to generate summary
-def generate_summary(text: str, doc_embedding: np.ndarray, max_sentences: int = 5, is_table: bool = False) -> str:
-    if not text.strip():
-        return "No content available for summary."
+# Supervised conversion processes (None with --no-isolation) and the files they had to stop
+conversion_pool: Optional[SupervisorPool] = None
+quarantine: Optional[QuarantineList] = None
+
+# Exact-duplicate detection (None with --no-dedup), duplicates written before their original, waiting
+# for it by original file_path, and the files written so far (including failed ones)
+duplicate_index: Optional[DuplicateIndex] = None
+waiting_duplicates: Dict[str, List[Dict]] = defaultdict(list)
+written_files: Set[str] = set()
+
+# Function to print a warning for each missing OCR dependency
+def warn_missing_ocr_dependencies() -> None:
+    if not ocr_easyocr_available:
+        print("Warning: easyocr not installed. Install with 'pip install docling[easyocr]' for OCR support.")
+    if not ocr_pytesseract_available:
+        print("Warning: pytesseract not installed. Install with 'pip install docling[tesseract]' and Tesseract binary for OCR support.")
+
+# Function to return the embedding model, loading it on first use
+def get_embed_model():
+    global embed_model
+    if embed_model is None:
+        from torch.utils.data import dataloader
+        from sentence_transformers import SentenceTransformer
+        # Disable the specific warning
+        warnings.filterwarnings("ignore",
+            message=".*'pin_memory' argument is set as true but no accelerator is found.*",
+            category=UserWarning,
+            module=dataloader.__name__
+        )
+        embed_model = SentenceTransformer(EMBED_MODEL_NAME)
+    return embed_model
+
+# Function to make sure the NLTK sentence tokenizer data is available, downloading it once
+def ensure_nltk_data() -> None:
+    global nltk_data_ready
+    if nltk_data_ready:
+        return
+    import nltk
     try:
-        if is_table:
-            # For tabular data, create a concise summary of headers and sample rows
-            lines = [line.strip() for line in text.split('\n') if line.strip()]
-            if not lines:
-                return "No meaningful text content extracted from table."
-            # Take headers and a few rows, focusing on text content
-            summary_lines = lines[:max_sentences]
-            summary = f"Table summary: {'; '.join(summary_lines)}..."
-            summary_lengths.append(len(summary.split()))
-            return summary
+        nltk.data.find('tokenizers/punkt_tab')
+    except LookupError:
+        print("Downloading NLTK punkt_tab resource...")
+        nltk.download('punkt_tab')
+    nltk_data_ready = True
+
+# Function to return this process's OCR-enabled or text-only document converter, creating it on first use
+def get_converter(ocr: bool = True):
+    if ocr not in converters:
+        from docling.document_converter import DocumentConverter
+        if ocr:
+            converters[ocr] = DocumentConverter()
         else:
-            # Sentence-based summary for non-tabular data
-            sentences = sent_tokenize(text)
-            if not sentences:
-                return "No sentences detected for summary."
-            sentence_embeddings = embed_model.encode(sentences)
-            similarities = cosine_similarity([doc_embedding], sentence_embeddings)[0]
-            cosine_similarities.extend(similarities.tolist())
-            top_indices = np.argsort(similarities)[-max_sentences:]
-            top_sentences = [sentences[i] for i in sorted(top_indices) if similarities[i] > 0.1]
-            summary = " ".join(top_sentences)
-            summary_lengths.append(len(summary.split()))
-            return summary if summary else "Unable to generate summary due to low similarity."
+            from docling.datamodel.base_models import InputFormat
+            from docling.datamodel.pipeline_options import PdfPipelineOptions
+            from docling.document_converter import PdfFormatOption
+            pipeline_options = PdfPipelineOptions()
+            pipeline_options.do_ocr = False
+            converters[ocr] = DocumentConverter(
+                format_options={InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)})
+    return converters[ocr]
+
+# Function to check whether a PDF already has a text layer by sampling a few evenly spaced pages.
+# Returns False (so OCR is used) when the PDF cannot be inspected.
+def pdf_has_text_layer(file_path: str, sample_pages: int = TEXT_LAYER_SAMPLE_PAGES,
+                       min_chars_per_page: int = TEXT_LAYER_MIN_CHARS_PER_PAGE) -> bool:
+    try:
+        import pypdfium2 as pdfium
+        pdf = pdfium.PdfDocument(file_path)
+    except Exception:
+        return False
+    try:
+        page_count = len(pdf)
+        if page_count == 0:
+            return False
+        indices = sorted({round(i * (page_count - 1) / max(1, sample_pages - 1)) for i in range(sample_pages)})
+        total_chars = 0
+        for index in indices:
+            page = pdf[index]
+            text_page = page.get_textpage()
+            total_chars += sum(1 for char in text_page.get_text_range() if not char.isspace())
+            text_page.close()
+            page.close()
+        return total_chars >= min_chars_per_page * len(indices)
+    except Exception:
+        return False
+    finally:
+        pdf.close()
+
+# Function to return the page count of a PDF, or None if it cannot be read
+def pdf_page_count(file_path: str) -> Optional[int]:
+    try:
+        import pypdfium2 as pdfium
+        pdf = pdfium.PdfDocument(file_path)
+    except Exception:
+        return None
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+# Function to choose the 1-based, inclusive page ranges converted for a PDF: everything if it fits the
+# budget, else the first half of the budget from the start plus evenly spaced windows over the rest
+def plan_page_ranges(page_count: Optional[int], max_pages: int) -> List[Optional[tuple]]:
+    if not page_count or not max_pages or page_count <= max_pages:
+        return [None]
+    head = max(1, max_pages // 2)
+    ranges: List[Optional[tuple]] = [(1, head)]
+    remaining = max_pages - head
+    windows = min(PAGE_SAMPLE_WINDOWS, remaining)
+    if windows == 0:
+        return ranges
+    window_size = remaining // windows
+    span = page_count - head
+    for i in range(windows):
+        start = head + 1 + (i * span) // windows
+        ranges.append((start, min(page_count, start + window_size - 1)))
+    return ranges
+
+# Function to keep at most max_chars of a document's text items, preserving their order: the
+# opening text, headings (up to a fifth of the budget) and evenly spaced chunks of the rest.
+# Items are (text, is_heading) pairs.
+def sample_text_items(items: List[tuple], max_chars: int) -> List[str]:
+    total_chars = sum(len(text) for text, _ in items)
+    if not max_chars or total_chars <= max_chars:
+        return [text for text, _ in items]
+    keep = set()
+
+    def take(start: int, budget: int, headings_only: bool = False) -> int:
+        used, index = 0, start
+        while index < len(items) and used < budget:
+            text, is_heading = items[index]
+            if (is_heading or not headings_only) and index not in keep:
+                keep.add(index)
+                used += len(text)
+            index += 1
+        return used
+
+    used = take(0, max_chars // 2)
+    head_end = max(keep) + 1 if keep else 0
+    used += take(head_end, max_chars // 5, headings_only=True)
+    chunk_budget = max(1, (max_chars - used) // TEXT_SAMPLE_CHUNKS)
+    rest = len(items) - head_end
+    for i in range(TEXT_SAMPLE_CHUNKS):
+        take(head_end + (i * rest) // TEXT_SAMPLE_CHUNKS, chunk_budget)
+    return [items[index][0] for index in sorted(keep)]
+
+# Function to convert a document, optionally restricted to a page range
+def convert_document(file_path: str, use_ocr: bool, page_range: Optional[tuple] = None):
+    if page_range is None:
+        return get_converter(ocr=use_ocr).convert(file_path)
+    return get_converter(ocr=use_ocr).convert(file_path, page_range=page_range)
+
+# Function to decide whether a file should go through the OCR-enabled converter.
+# Images have no text layer; PDFs are sampled unless the OCR mode forces a choice.
+def needs_ocr(file_path: str, ext: str, mode: str = 'auto') -> bool:
+    if ext not in ocr_extensions or mode == 'never':
+        return False
+    if not (ocr_easyocr_available or ocr_pytesseract_available):
+        return False
+    if mode == 'always' or ext != '.pdf':
+        return True
+    return not pdf_has_text_layer(file_path)
+
+# Function to compute a SHA-256 digest of a file's contents
+def hash_file(file_path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Function to build the cache fingerprint of a file (path is the cache key)
+def file_fingerprint(file_path: str) -> Dict:
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+# Function to hash the extraction options that shape a result (page and character budgets, Excel
+# budgets, OCR mode); a cache entry built with other options is a miss
+def options_hash(options: Dict) -> str:
+    effective = {'excel_max_rows': options.get('excel_max_rows', DEFAULT_EXCEL_MAX_ROWS),
+                 'excel_max_cells': options.get('excel_max_cells', DEFAULT_EXCEL_MAX_CELLS),
+                 'ocr': options.get('ocr', 'auto'),
+                 'max_pages': options.get('max_pages', DEFAULT_MAX_PAGES),
+                 'max_chars': options.get('max_chars', DEFAULT_MAX_CHARS)}
+    return hashlib.sha1(json.dumps(effective, sort_keys=True).encode('utf-8')).hexdigest()
+
+# Function to return the path of the matrix holding the cached embeddings
+def cache_embeddings_file(cache_file: str) -> str:
+    return f"{os.path.splitext(cache_file)[0]}.npy"
+
+# Function to load the re-scan cache, discarding it if the model or extensions changed
+def load_cache(cache_file: str) -> Dict[str, Dict]:
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        embeddings = np.load(cache_embeddings_file(cache_file)) if cache.get('embedding_count') else None
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read cache '{cache_file}', rebuilding it. Error: {str(e)}")
+        return {}
+    if (cache.get('version') != CACHE_VERSION
+            or cache.get('embed_model') != EMBED_MODEL_NAME
+            or cache.get('supported_extensions') != sorted(supported_extensions)):
+        print(f"Cache '{cache_file}' was built with a different model or extension set. Rebuilding it.")
+        return {}
+    if cache.get('embedding_count', 0) != (0 if embeddings is None else len(embeddings)):
+        print(f"Cache embeddings do not match '{cache_file}'. Rebuilding it.")
+        return {}
+    entries = cache.get('entries', {})
+    for entry in entries.values():
+        row = entry.pop('embedding_row', None)
+        entry['embedding'] = embeddings[row] if row is not None else None
+    return entries
+
+# Function to save the re-scan cache atomically; embeddings go to a .npy matrix next to it
+def save_cache(cache_file: str, entries: Dict[str, Dict]) -> None:
+    json_entries: Dict[str, Dict] = {}
+    vectors: List[np.ndarray] = []
+    for file_path, entry in entries.items():
+        json_entry = {key: value for key, value in entry.items() if key != 'embedding'}
+        if entry.get('embedding') is not None:
+            json_entry['embedding_row'] = len(vectors)
+            vectors.append(entry['embedding'])
+        json_entries[file_path] = json_entry
+    cache = {
+        'version': CACHE_VERSION,
+        'embed_model': EMBED_MODEL_NAME,
+        'supported_extensions': sorted(supported_extensions),
+        'embedding_count': len(vectors),
+        'entries': json_entries
+    }
+    tmp_file = f"{cache_file}.tmp"
+    embeddings_file = cache_embeddings_file(cache_file)
+    try:
+        if vectors:
+            with open(f"{embeddings_file}.tmp", 'wb') as f:
+                np.save(f, np.stack(vectors).astype(np.float32))
+            os.replace(f"{embeddings_file}.tmp", embeddings_file)
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(tmp_file, cache_file)
+        print(f"Cache saved to {cache_file} ({len(entries)} entries)")
     except Exception as e:
-        print(f"  -> Error generating summary: {str(e)}")
-        return "Summary generation failed."
+        print(f"Error saving cache {cache_file}: {str(e)}")
+
+# Function to return the cached entry for an unchanged file, or None if it must be reprocessed
+# (also when it was extracted with options other than those hashed in options_digest)
+def lookup_cache(entries: Dict[str, Dict], file_path: str, fingerprint: Dict, use_hash: bool,
+                 options_digest: str) -> Optional[Dict]:
+    entry = entries.get(file_path)
+    if entry is None or entry.get('options_hash') != options_digest:
+        return None
+    cached = entry.get('fingerprint', {})
+    if cached.get('size') == fingerprint['size'] and cached.get('mtime_ns') == fingerprint['mtime_ns']:
+        if 'sha256' in cached:
+            fingerprint['sha256'] = cached['sha256']
+        return entry
+    # Size or mtime changed: with hashing enabled, a touched but identical file is still a hit
+    if use_hash and cached.get('sha256') and cached.get('size') == fingerprint['size']:
+        fingerprint['sha256'] = hash_file(file_path)
+        if fingerprint['sha256'] == cached['sha256']:
+            return entry
+    return None
+
+# Function to split document text into the units that are embedded and scored for the summary
+def split_sentences(text: str, is_table: bool = False) -> List[str]:
+    if not text.strip():
+        return []
+    if is_table:
+        # For tabular data, each non-empty line (header or row) is one unit
+        lines = [line.strip() for line in text.split('\n') if line.strip()]
+        return lines[:MAX_TABLE_EMBED_LINES]
+    from nltk.tokenize import sent_tokenize
+    ensure_nltk_data()
+    return sent_tokenize(text) or [text.strip()]
+
+# Function to embed and summarize a batch of documents in a single encoder pass.
+# Sentences of all documents are encoded together in fixed-size batches; each document
+# embedding is the normalized mean of its sentence vectors, and sentences are ranked by
+# cosine similarity to it. Returns one (embedding, summary) pair per document.
+def embed_and_summarize(documents: List[Dict], batch_size: int, max_sentences: int = 5) -> List[tuple]:
+    return summarize_embedded(documents, embed_sentences(documents, batch_size), max_sentences)
+
+# Function to encode the sentences of all documents together, in document order.
+# Returns the unit-length sentence vectors, or None if no document has a sentence.
+def embed_sentences(documents: List[Dict], batch_size: int) -> Optional[np.ndarray]:
+    all_sentences = [sentence for doc in documents for sentence in doc['sentences']]
+    if not all_sentences:
+        return None
+    return get_embed_model().encode(all_sentences, batch_size=batch_size, convert_to_numpy=True,
+                                    normalize_embeddings=True, show_progress_bar=False)
+
+# Function to derive the document embeddings and summaries from the sentence vectors of embed_sentences
+def summarize_embedded(documents: List[Dict], sentence_embeddings: Optional[np.ndarray],
+                       max_sentences: int = 5) -> List[tuple]:
+    sentence_lists = [doc['sentences'] for doc in documents]
+    counts = np.array([len(sentences) for sentences in sentence_lists], dtype=np.int64)
+    if sentence_embeddings is None:
+        return [(None, "No content available for summary.") for _ in documents]
 
-# Function to extract text from Excel using pandas
-def extract_excel_text(file_path: str) -> str:
+    owners = np.repeat(np.arange(len(documents)), counts)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    # Document embeddings: mean of sentence vectors, re-normalized
+    has_sentences = counts > 0
+    doc_embeddings = np.zeros((len(documents), sentence_embeddings.shape[1]), dtype=sentence_embeddings.dtype)
+    doc_embeddings[has_sentences] = (np.add.reduceat(sentence_embeddings, offsets[:-1][has_sentences], axis=0)
+                                     / counts[has_sentences, None])
+    norms = np.linalg.norm(doc_embeddings, axis=1, keepdims=True)
+    doc_embeddings = np.divide(doc_embeddings, norms, out=np.zeros_like(doc_embeddings), where=norms > 0)
+
+    # Cosine similarity of every sentence to its own document (vectors are unit length)
+    similarities = np.einsum('ij,ij->i', sentence_embeddings, doc_embeddings[owners])
+
+    # Top-k per document: sort by (document, -similarity) and keep the first k of each group
+    order = np.lexsort((-similarities, owners))
+    rank = np.arange(len(order)) - offsets[owners[order]]
+    selected = np.sort(order[(rank < max_sentences) & (similarities[order] > 0.1)])
+    selected_bounds = np.searchsorted(selected, offsets)
+
+    results = []
+    for i, doc in enumerate(documents):
+        sentences = sentence_lists[i]
+        if not sentences:
+            results.append((None, "No content available for summary."))
+            continue
+        if doc['file_type'] == '.xlsx':
+            # For tabular data, create a concise summary of headers and sample rows
+            summary = f"Table summary: {'; '.join(sentences[:max_sentences])}..."
+        else:
+            metrics.record('cosine_similarity', float(similarities[offsets[i]:offsets[i + 1]].sum()), len(sentences))
+            top = selected[selected_bounds[i]:selected_bounds[i + 1]] - offsets[i]
+            summary = " ".join(sentences[j] for j in top)
+            if not summary:
+                summary = "Unable to generate summary due to low similarity."
+        metrics.record('summary_words', len(summary.split()))
+        results.append((doc_embeddings[i], summary))
+    return results
+
+# Function to extract text from Excel with a streaming read-only reader.
+# Only the first rows of each sheet are read (bounded by max_rows per sheet and max_cells per
+# workbook), since the summary and embedding only use the headers and a sample of rows.
+def extract_excel_text(file_path: str, max_rows: int = DEFAULT_EXCEL_MAX_ROWS,
+                       max_cells: int = DEFAULT_EXCEL_MAX_CELLS) -> str:
+    import pandas as pd
+    from openpyxl import load_workbook
+    try:
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+    except Exception as e:
+        print(f"  -> Error reading Excel file {file_path}: {str(e)}")
+        return ""
     try:
-        xl = pd.ExcelFile(file_path)
         all_text = []
-        for sheet_name in xl.sheet_names:
-            print(f"Processing sheet: {sheet_name} in {file_path}")
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
-            # Convert all cells to strings, handling NaN
-            df = df.fillna('').astype(str)
-            # Extract headers, ensuring all column names are strings (fixes the float issue)
-            headers = ", ".join(str(col) for col in df.columns if str(col).strip())  # Skip empty columns if desired
-            all_text.append(f"Sheet: {sheet_name}")
+        cells_left = max_cells
+        for sheet in workbook.worksheets:
+            if cells_left <= 0:
+                print(f"  -> Excel cell budget reached, skipping remaining sheets in {file_path}")
+                break
+            print(f"Processing sheet: {sheet.title} in {file_path}")
+            rows = []
+            for row in sheet.iter_rows(values_only=True):
+                rows.append(row)
+                cells_left -= len(row)
+                if len(rows) > max_rows or cells_left <= 0:
+                    break
+            all_text.append(f"Sheet: {sheet.title}")
+            if not rows:
+                continue
+
+            # First row holds the headers, skipping empty columns
+            headers = ", ".join(str(col).strip() for col in rows[0] if col is not None and str(col).strip())
             all_text.append(f"Headers: {headers}")
-            # Debug: Print column types to confirm
-            # print("Column name types:", [type(col) for col in df.columns])
-            # Extract cell values
-            for _, row in df.iterrows():
-                row_text = ", ".join(str(val) for val in row if val.strip())  # Use str(val) and skip empty
-                if row_text:
-                    all_text.append(row_text)
+            if len(rows) == 1:
+                continue
+
+            # Convert all cells to strings, then join the non-empty cells of each row column-wise
+            df = pd.DataFrame(rows[1:], dtype=object).fillna('').astype(str)
+            df = df.apply(lambda column: column.str.strip())
+            joined = df[0].str.cat([df[col] for col in df.columns[1:]], sep='\x1f')
+            joined = joined.str.strip('\x1f').str.replace('\x1f+', ', ', regex=True)
+            all_text.extend(joined[joined != ''].tolist())
         return "\n".join(all_text)
     except Exception as e:
-        print(f"  -> Error reading Excel file {file_path} with pandas: {str(e)}")
+        print(f"  -> Error reading Excel file {file_path}: {str(e)}")
         return ""
+    finally:
+        workbook.close()
+
+# Function to check a directory entry against the exclude globs, by name and by relative path
+def is_excluded(name: str, relative_path: str, exclude_globs: List[str]) -> bool:
+    relative_path = relative_path.replace(os.sep, '/')
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative_path, pattern) for pattern in exclude_globs)
+
+# Function to walk a directory tree with os.scandir and yield supported files as they are found.
+# Excluded directories are never descended into, and oversized files are never enqueued.
+def iter_supported_files(base_path: str, exclude_globs: List[str], max_file_size: Optional[int] = None):
+    stack = [base_path]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"Warning: Could not scan '{directory}': {str(e)}")
+            continue
+        subdirectories = []
+        for entry in entries:
+            if is_excluded(entry.name, os.path.relpath(entry.path, base_path), exclude_globs):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                    continue
+                if os.path.splitext(entry.name)[1].lower() not in supported_extensions:
+                    continue
+                if max_file_size is not None and entry.stat().st_size > max_file_size:
+                    print(f"Skipping (larger than size limit): {entry.path}")
+                    continue
+            except OSError as e:
+                print(f"Warning: Could not read '{entry.path}': {str(e)}")
+                continue
+            yield entry.path
+        stack.extend(reversed(subdirectories))
+
+# Function to record a scanned file in the scan results and KPI counters
+def register_scanned_file(file_path: str) -> None:
+    ext = os.path.splitext(file_path)[1].lower()
+    supported_files.append(file_path)
+    file_types_processed.add(ext)
+    print(f"Found: {file_path}")
+    if ext in ocr_extensions:
+        metrics.count('ocr_eligible_files')
+        print(f"  -> OCR may be applied for this file.")
+
+# Function to scan the base directory for supported documents
+# (only the files of shard (I, N) if a shard is given)
+def scan_directory(base_path: str, exclude_globs: List[str], max_file_size: Optional[int] = None,
+                   shard: Optional[tuple] = None) -> None:
+    print("Scanning for documents supported by Docling...")
+    for file_path in iter_supported_files(base_path, exclude_globs, max_file_size):
+        if shard is None or shard_of(file_path, shard[1]) == shard[0]:
+            register_scanned_file(file_path)
+    print(f"\nTotal supported documents found: {len(supported_files)}")
+
+# Function to take the files to process from a work manifest instead of scanning
+def load_manifest(manifest_file: str, shard: Optional[tuple] = None) -> None:
+    print(f"Reading the work manifest {manifest_file}...")
+    for record in read_manifest(manifest_file, shard):
+        register_scanned_file(record['file_path'])
+    print(f"\nTotal documents in this shard: {len(supported_files)}")
+
+# Function to initialize a conversion process with its own DocumentConverter and options
+def init_extraction_worker(options: Dict) -> None:
+    global extraction_options
+    extraction_options = options
+    get_converter(ocr=False)
+
+# Function to create an empty extraction result, or a failed one when an error is given
+def new_extraction_result(file_path: str, error: Optional[str] = None) -> Dict:
+    return {'file_path': file_path, 'file_type': os.path.splitext(file_path)[1].lower(), 'text': "", 'metadata': {},
+            'ocr_applied': False, 'ocr_skipped': False, 'stage_times': {}, 'extract_time': 0.0,
+            'peak_rss_bytes': None, 'error': error}
 
-# Process documents
-print("\nProcessing supported documents...")
-for file_path in supported_files:
+# Function to read the title, author and creation date of a converted document, without dumping
+# the whole document model
+def document_metadata(doc) -> Dict[str, str]:
+    metadata = getattr(doc, 'metadata', None)
+    if metadata is None:
+        return {}
+    fields = {}
+    for key in ('title', 'author', 'creation_date'):
+        value = metadata.get(key) if isinstance(metadata, dict) else getattr(metadata, key, None)
+        if value is not None:
+            fields[key] = str(value)
+    return fields
+
+# Function to extract text and metadata from one document.
+# Runs in a worker process, so errors and timings are returned instead of raised or recorded:
+# 'stage_times' holds the seconds spent in 'excel', 'convert' or 'ocr' (conversion with OCR).
+def extract_document(file_path: str) -> Dict:
     start_time = time.time()
+    ext = os.path.splitext(file_path)[1].lower()
+    result = new_extraction_result(file_path)
     print(f"Processing: {file_path}")
     try:
-        ext = os.path.splitext(file_path)[1].lower()
-        doc_dict: Dict = {'file_path': file_path, 'file_type': ext, 'summary': "", 'embedding': []}
-        llm_dict: Dict = {'file_path': file_path, 'file_type': ext, 'summary': ""}
-
         all_text: List[str] = []
 
         if ext == '.xlsx':
-            # Always use pandas for .xlsx files to ensure reliable text extraction
-            print(f"  -> Using pandas to extract content from {file_path}")
-            excel_text = extract_excel_text(file_path)
+            # Always use the streaming Excel reader for .xlsx files to ensure reliable text extraction
+            print(f"  -> Using the Excel reader to extract content from {file_path}")
+            excel_start = time.time()
+            excel_text = extract_excel_text(file_path,
+                                            extraction_options.get('excel_max_rows', DEFAULT_EXCEL_MAX_ROWS),
+                                            extraction_options.get('excel_max_cells', DEFAULT_EXCEL_MAX_CELLS))
+            result['stage_times']['excel'] = time.time() - excel_start
             if excel_text:
                 all_text.append(excel_text)
         else:
-            # Use docling for other formats
-            conv_res = converter.convert(file_path)
-            if file_path in ocr_eligible_files and (ocr_easyocr_available or ocr_pytesseract_available):
-                ocr_processed_files.append(file_path)
-            if conv_res.document is not None:
-                doc: DoclingDocument = conv_res.document
+            # Use docling for other formats, routing files without a text layer to the OCR converter
+            use_ocr = needs_ocr(file_path, ext, extraction_options.get('ocr', 'auto'))
+            result['ocr_skipped'] = ext in ocr_extensions and not use_ocr
+            max_pages = extraction_options.get('max_pages', DEFAULT_MAX_PAGES)
+            page_ranges = plan_page_ranges(pdf_page_count(file_path), max_pages) if ext == '.pdf' else [None]
+            if page_ranges[0] is not None:
+                print(f"  -> Large PDF, converting pages {', '.join(f'{a}-{b}' for a, b in page_ranges)}")
+            convert_start = time.time()
+            documents = [convert_document(file_path, use_ocr, page_range).document for page_range in page_ranges]
+            documents = [doc for doc in documents if doc is not None]
+            result['stage_times']['ocr' if use_ocr else 'convert'] = time.time() - convert_start
+            result['ocr_applied'] = use_ocr
 
+            items: List[tuple] = []
+            for doc in documents:
                 # Extract metadata
-                metadata = doc.model_dump().get('metadata', {})
-                if isinstance(metadata, dict):
-                    if 'title' in metadata:
-                        doc_dict['title'] = str(metadata['title'])
-                        llm_dict['title'] = str(metadata['title'])
-                    if 'author' in metadata:
-                        doc_dict['author'] = str(metadata['author'])
-                        llm_dict['author'] = str(metadata['author'])
-                    if 'creation_date' in metadata:
-                        doc_dict['creation_date'] = str(metadata['creation_date'])
-                        llm_dict['creation_date'] = str(metadata['creation_date'])
-
-                # Extract text items
-                all_text.extend(item.text for item in doc.texts if item.text)
+                for key, value in document_metadata(doc).items():
+                    result['metadata'].setdefault(key, value)
+
+                # Extract text items, marking headings
+                for item in doc.texts:
+                    if item.text:
+                        label = getattr(item, 'label', '')
+                        items.append((item.text, str(getattr(label, 'value', label)) in HEADING_LABELS))
 
                 # Extract table content (only text)
                 for table in doc.tables:
@@ -209,88 +743,961 @@ for file_path in supported_files:
                         for cell in row:
                             cell_text = getattr(cell, 'text', str(cell)) if not isinstance(cell, str) else cell
                             if cell_text:
-                                all_text.append(cell_text)
+                                items.append((cell_text, False))
+
+            # Keep the per-document text within budget so summary and embedding cost stays bounded
+            all_text.extend(sample_text_items(items, extraction_options.get('max_chars', DEFAULT_MAX_CHARS)))
 
         # Join all text
-        full_text = "\n".join([t for t in all_text if t]).strip()
-
-        # Generate embedding and summary
-        if full_text:
-            doc_embedding = embed_model.encode(full_text)
-            doc_dict['embedding'] = doc_embedding.tolist()
-            summary = generate_summary(full_text, doc_embedding, is_table=(ext == '.xlsx'))
-            doc_dict['summary'] = summary
-            llm_dict['summary'] = summary
-        else:
-            doc_dict['summary'] = "No content available for summary."
-            llm_dict['summary'] = "No content available for summary."
+        result['text'] = "\n".join([t for t in all_text if t]).strip()
+    except Exception as e:
+        result['error'] = str(e)
+    result['extract_time'] = time.time() - start_time
+    result['peak_rss_bytes'] = peak_rss_bytes()
+    return result
+
+# Function to extract a document in a supervised conversion process. A file that runs out of time or
+# memory, or crashes the process, is quarantined and returned as a failed extraction.
+def extract_supervised(file_path: str) -> Dict:
+    start_time = time.time()
+    try:
+        return conversion_pool.run(file_path)
+    except BudgetExceeded as e:
+        print(f"Stopped converting {file_path}: {str(e)}")
+        if quarantine is not None:
+            quarantine.add(file_path, e.kind, str(e))
+        result = new_extraction_result(file_path, f"quarantined: {str(e)}")
+        result['quarantined'] = e.kind
+    except Exception as e:
+        result = new_extraction_result(file_path, str(e))
+    result['extract_time'] = time.time() - start_time
+    return result
 
+# Function to yield extraction results in input order, converting in worker processes if requested
+# (the supervised conversion processes, unless --no-isolation is used)
+def iter_extracted_documents(files: List[str], workers: int, options: Dict):
+    if conversion_pool is not None:
+        with ThreadPoolExecutor(max_workers=conversion_pool.size) as executor:
+            yield from executor.map(extract_supervised, files)
+        return
+    if workers <= 1:
+        init_extraction_worker(options)
+        for file_path in files:
+            yield extract_document(file_path)
+        return
+    print(f"Converting documents with {workers} worker processes...")
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_extraction_worker,
+                             initargs=(options,)) as executor:
+        # map() returns results in submission order as soon as each is available
+        yield from executor.map(extract_document, files)
+
+# Function to build the output records for an extracted document (the embedding is stored by emit_records)
+def build_document_records(extracted: Dict, summary: str):
+    file_path, ext = extracted['file_path'], extracted['file_type']
+    doc_dict: Dict = {'file_path': file_path, 'file_type': ext, 'summary': summary}
+    llm_dict: Dict = {'file_path': file_path, 'file_type': ext, 'summary': summary}
+    doc_dict.update(extracted['metadata'])
+    llm_dict.update(extracted['metadata'])
+    return doc_dict, llm_dict
+
+# Function to hand one document's records to the output (in-memory lists or streamed files).
+# The embedding is stored as a row of the embedding matrix, or inline as a float list.
+def emit_records(doc_dict: Dict, llm_dict: Dict, doc_embedding: Optional[np.ndarray]) -> None:
+    if embedding_store is not None:
+        row = embedding_store.add(doc_dict['file_path'], doc_embedding) if doc_embedding is not None else None
+        doc_dict = {**doc_dict, 'embedding_row': row}
+    else:
+        doc_dict = {**doc_dict, 'embedding': doc_embedding.tolist() if doc_embedding is not None else []}
+    if output_writers is None:
         output_data.append(doc_dict)
         llm_input_data.append(llm_dict)
-        successful_count += 1
+    else:
+        doc_writer, llm_writer = output_writers
+        llm_writer.write(llm_dict)
+        doc_writer.write(doc_dict)
+
+# Function to find version groups: documents whose embeddings are near-duplicates (copies and versions
+# of one document). LSH keeps this sub-quadratic on large collections. Returns {file_path: group number}.
+def find_version_groups(records, embeddings: Optional[np.ndarray], threshold: float) -> Dict[str, int]:
+    paths: List[str] = []
+    vectors: List[np.ndarray] = []
+    for record in records:
+        vector = get_record_embedding(record, embeddings)
+        if vector is not None:
+            paths.append(record['file_path'])
+            vectors.append(vector)
+    if len(vectors) < 2:
+        return {}
+    labels = find_near_duplicates(np.asarray(vectors, dtype=np.float32), threshold)
+    numbers: Dict[int, int] = {}
+    return {path: numbers.setdefault(int(label), len(numbers) + 1)
+            for path, label in zip(paths, labels) if label >= 0}
+
+# Function to set a record's 'version_group' tag, dropping a stale one from an earlier run
+def tag_version_group(record: Dict, version_groups: Dict[str, int]) -> Dict:
+    record = {key: value for key, value in record.items() if key != 'version_group'}
+    if record['file_path'] in version_groups:
+        record['version_group'] = version_groups[record['file_path']]
+    return record
+
+# Function to tag the version groups of all written documents, in the in-memory outputs or by
+# rewriting the streamed files (whose writers must be closed)
+def tag_version_groups(output_file: str, llm_output_file: str, threshold: float) -> None:
+    global output_data, llm_input_data
+    embeddings = load_embeddings(embedding_store.filepath) \
+        if embedding_store is not None and embedding_store.rows else None
+    version_groups = find_version_groups(output_data if output_writers is None else iter_jsonl(output_file),
+                                         embeddings, threshold)
+    metrics.set('version_groups', len(set(version_groups.values())))
+    if output_writers is None:
+        output_data = [tag_version_group(record, version_groups) for record in output_data]
+        llm_input_data = [tag_version_group(record, version_groups) for record in llm_input_data]
+    else:
+        rewrite_jsonl(output_file, lambda record: tag_version_group(record, version_groups))
+        rewrite_jsonl(llm_output_file, lambda record: tag_version_group(record, version_groups))
+
+# Function to decide how a scanned file is handled. Returns a batch entry whose status is
+# 'error' (unreadable), 'resumed' (already in the streamed output), 'quarantined' (stopped by a limit in an
+# earlier run), 'cached', 'duplicate' (same content as an earlier file, whose results it reuses) or
+# 'pending' (to extract).
+# Counters are only updated when the entry is written, so this can run on the scan thread.
+def prepare_entry(file_path: str, cache_entries: Dict[str, Dict], resumed_records: Dict[str, Dict],
+                  use_hash: bool, options_digest: str) -> Dict:
+    entry: Dict = {'file_path': file_path, 'options_hash': options_digest}
+    try:
+        entry['fingerprint'] = file_fingerprint(file_path)
+    except OSError as e:
+        entry.update(status='error', error=str(e))
+        return entry
+    if file_path in resumed_records:
+        entry.update(status='resumed', cached=resumed_records[file_path])
+        return entry
+    quarantined = quarantine.get(file_path, entry['fingerprint']) if quarantine is not None else None
+    if quarantined is not None:
+        entry.update(status='quarantined', error=quarantined['reason'])
+        return entry
+    # Every file is registered, so a cached file can still be the original of a later copy
+    original = duplicate_index.check(file_path) if duplicate_index is not None else None
+    if original is not None:
+        entry['duplicate_of'] = original
+    cached_entry = lookup_cache(cache_entries, file_path, entry['fingerprint'], use_hash, options_digest)
+    if cached_entry is not None:
+        print(f"Unchanged, using cached result: {file_path}")
+        entry.update(status='cached', cached=cached_entry)
+    elif original is not None:
+        print(f"Duplicate of {original}, reusing its result: {file_path}")
+        entry['status'] = 'duplicate'
+    else:
+        entry['status'] = 'pending'
+    return entry
+
+# Function to write a duplicate's records from its original's results (new_cache_entries holds the
+# results of every file written so far), tagged with 'duplicate_of'
+def emit_duplicate(entry: Dict, new_cache_entries: Dict[str, Dict]) -> bool:
+    file_path, original = entry['file_path'], entry['duplicate_of']
+    source = new_cache_entries.get(original)
+    if source is None:
+        print(f"Error processing {file_path}: its original {original} could not be processed")
+        metrics.count('documents_failed')
+        return False
+    ext = os.path.splitext(file_path)[1].lower()
+    document = {**source['document'], 'file_path': file_path, 'file_type': ext}
+    llm_input = {**source['llm_input'], 'file_path': file_path, 'file_type': ext}
+    emit_records({**document, 'duplicate_of': original}, {**llm_input, 'duplicate_of': original}, source['embedding'])
+    new_cache_entries[file_path] = {'fingerprint': entry['fingerprint'], 'options_hash': entry['options_hash'],
+                                    'document': document, 'llm_input': llm_input, 'embedding': source['embedding']}
+    metrics.count('duplicates_reused')
+    metrics.count('documents_processed')
+    return True
+
+# Function to write the duplicates that were waiting for a file, once that file is written (or failed)
+def release_duplicates(file_path: str, new_cache_entries: Dict[str, Dict]) -> None:
+    for waiting in waiting_duplicates.pop(file_path, []):
+        emit_duplicate(waiting, new_cache_entries)
+
+# Function to fail the duplicates still waiting at the end of a run, whose original was never written
+# (e.g. a queue worker's copy of a file another worker claimed)
+def fail_waiting_duplicates() -> None:
+    for original, entries in waiting_duplicates.items():
+        for entry in entries:
+            print(f"Error processing {entry['file_path']}: its original {original} was not processed in this run")
+            metrics.count('documents_failed')
+    waiting_duplicates.clear()
+
+# Function to split an extracted document into sentences ahead of the embedding stage
+def attach_sentences(extracted: Dict) -> Dict:
+    extracted['sentences'] = [] if extracted['error'] is not None else \
+        split_sentences(extracted['text'], is_table=(extracted['file_type'] == '.xlsx'))
+    return extracted
+
+# Function to embed the extracted documents of a buffered batch.
+# Returns one (embedding, summary) pair or exception per document, and the embedding time per document.
+def embed_batch(batch: List[Dict], batch_size: int):
+    documents = [entry['extracted'] for entry in batch
+                 if 'extracted' in entry and entry['extracted']['error'] is None]
+    start_time = time.time()
+    try:
+        with metrics.span('encode', items=len(documents)):
+            sentence_embeddings = embed_sentences(documents, batch_size)
+        with metrics.span('summarize', items=len(documents)):
+            embedded = summarize_embedded(documents, sentence_embeddings)
+    except Exception as e:
+        # Fall back to one document at a time so a single bad document only fails itself
+        print(f"  -> Batched embedding failed, retrying documents individually: {str(e)}")
+        embedded = []
+        for doc in documents:
+            try:
+                embedded.append(embed_and_summarize([doc], batch_size)[0])
+            except Exception as doc_error:
+                embedded.append(doc_error)
+    embed_time_per_doc = (time.time() - start_time) / len(documents) if documents else 0.0
+    return embedded, embed_time_per_doc
+
+# Function to write the records of an embedded batch in order and update the KPI counters
+def write_batch(batch: List[Dict], embedded: List, embed_time_per_doc: float, use_hash: bool,
+                new_cache_entries: Dict[str, Dict]) -> None:
+    results = iter(embedded)
+    for entry in batch:
+        if entry['status'] == 'duplicate':
+            # In pipeline mode a duplicate can overtake its original, which is still being converted;
+            # the copies of an original that was written and failed fail right away
+            if entry['duplicate_of'] in written_files:
+                emit_duplicate(entry, new_cache_entries)
+            else:
+                waiting_duplicates[entry['duplicate_of']].append(entry)
+            continue
+        write_entry(entry, results, embed_time_per_doc, use_hash, new_cache_entries)
+        written_files.add(entry['file_path'])
+        release_duplicates(entry['file_path'], new_cache_entries)
+
+# Function to record the timing spans of an extracted document: its extraction stages (measured in the
+# worker) and the whole document, including its share of the batch embedding time
+def observe_document(entry: Dict, extracted: Dict, embed_time_per_doc: float = 0.0) -> None:
+    file_path = entry['file_path']
+    size = entry.get('fingerprint', {}).get('size')
+    for stage, seconds in extracted.get('stage_times', {}).items():
+        metrics.observe(stage, seconds, file_path, size, rss=extracted.get('peak_rss_bytes'))
+    metrics.observe('document', extracted['extract_time'] + embed_time_per_doc, file_path, size,
+                    rss=extracted.get('peak_rss_bytes'), error='true' if extracted['error'] is not None else None)
+
+# Function to write the records of one batch entry that is not a duplicate
+def write_entry(entry: Dict, results, embed_time_per_doc: float, use_hash: bool,
+                new_cache_entries: Dict[str, Dict]) -> None:
+    file_path, status = entry['file_path'], entry['status']
+    if status == 'error':
+        print(f"Error processing {file_path}: {entry['error']}")
+        metrics.count('documents_failed')
+        return
+    if status == 'quarantined':
+        print(f"Skipping quarantined file {file_path}: {entry['error']}")
+        metrics.count('quarantined_files_skipped')
+        return
+    if status in ('cached', 'resumed'):
+        cached_entry = entry['cached']
+        if status == 'cached':
+            tag = {'duplicate_of': entry['duplicate_of']} if 'duplicate_of' in entry else {}
+            emit_records({**cached_entry['document'], **tag}, {**cached_entry['llm_input'], **tag},
+                         cached_entry['embedding'])
+            metrics.count('cache_hits')
+        else:
+            metrics.count('documents_resumed')
+        new_cache_entries[file_path] = {**cached_entry, 'fingerprint': entry['fingerprint'],
+                                        'options_hash': entry['options_hash']}
+        metrics.count('documents_processed')
+        return
+
+    extracted = entry['extracted']
+    if extracted['error'] is not None:
+        print(f"Error processing {file_path}: {extracted['error']}")
+        metrics.count('documents_failed')
+        if extracted.get('quarantined'):
+            metrics.count('files_quarantined')
+        observe_document(entry, extracted)
+        return
+    if extracted['ocr_applied']:
+        metrics.count('ocr_files')
+    elif extracted.get('ocr_skipped'):
+        metrics.count('ocr_skipped_files')
+    result = next(results)
+    observe_document(entry, extracted, embed_time_per_doc)
+    try:
+        if isinstance(result, Exception):
+            raise result
+        doc_embedding, summary = result
+        doc_dict, llm_dict = build_document_records(extracted, summary)
+        emit_records(doc_dict, llm_dict, doc_embedding)
+        fingerprint = entry['fingerprint']
+        if use_hash and 'sha256' not in fingerprint:
+            fingerprint['sha256'] = hash_file(file_path)
+        new_cache_entries[file_path] = {'fingerprint': fingerprint, 'options_hash': entry['options_hash'],
+                                        'document': doc_dict, 'llm_input': llm_dict, 'embedding': doc_embedding}
+        metrics.count('documents_processed')
     except Exception as e:
         print(f"Error processing {file_path}: {str(e)}")
-        error_count += 1
+        metrics.count('documents_failed')
+
+# Function to process the scanned files in scan order, so the output is deterministic.
+# Extracted documents are buffered until enough sentences are collected for a large embedding pass.
+def process_sequentially(args, options: Dict, files: List[str], cache_entries: Dict[str, Dict],
+                         resumed_records: Dict[str, Dict], new_cache_entries: Dict[str, Dict]) -> None:
+    options_digest = options_hash(options)
+    entries = [prepare_entry(file_path, cache_entries, resumed_records, args.hash, options_digest)
+               for file_path in files]
+    pending_files = [entry['file_path'] for entry in entries if entry['status'] == 'pending']
+    extracted_documents = iter_extracted_documents(pending_files, args.workers, options)
+    flush_threshold = args.embed_batch_size * EMBED_FLUSH_BATCHES
+    batch: List[Dict] = []
+    batch_sentences = 0
+    for entry in entries:
+        if entry['status'] == 'pending':
+            entry['extracted'] = attach_sentences(next(extracted_documents))
+            batch_sentences += len(entry['extracted']['sentences'])
+        batch.append(entry)
+        if batch_sentences >= flush_threshold:
+            write_batch(batch, *embed_batch(batch, args.embed_batch_size), args.hash, new_cache_entries)
+            batch, batch_sentences = [], 0
+    write_batch(batch, *embed_batch(batch, args.embed_batch_size), args.hash, new_cache_entries)
+
+# Function to process files claimed from a shared work queue until it is empty. The leases are renewed
+# while a batch is processed; an idle worker keeps polling while other workers hold leases, so the
+# files of a worker that died are processed once its leases expire.
+def process_queue(args, options: Dict, worker_id: str, cache_entries: Dict[str, Dict],
+                  resumed_records: Dict[str, Dict], new_cache_entries: Dict[str, Dict]) -> None:
+    work_queue = WorkQueue(args.queue, args.lease_seconds)
+    print(f"Worker {worker_id} claiming files from {args.queue}...")
+    try:
+        while True:
+            batch = work_queue.claim(worker_id, args.claim_batch)
+            if not batch:
+                if not work_queue.counts()['leased']:
+                    break
+                time.sleep(min(QUEUE_POLL_SECONDS, args.lease_seconds))
+                continue
+            for file_path in batch:
+                register_scanned_file(file_path)
+            with work_queue.keep_leases(worker_id):
+                process_sequentially(args, options, batch, cache_entries, resumed_records, new_cache_entries)
+            # The batch's records must be on disk before its files are marked done
+            if embedding_store is not None:
+                embedding_store.checkpoint()
+            for writer in output_writers:
+                writer.checkpoint()
+            work_queue.finish(worker_id, [file_path for file_path in batch if file_path in new_cache_entries],
+                              {file_path: f"processing failed on {worker_id}" for file_path in batch
+                               if file_path not in new_cache_entries})
     finally:
-        processing_times.append(time.time() - start_time)
-
-# Save output
-output_file = 'processed_documents.json'
-try:
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(output_data, f, ensure_ascii=False, indent=4)
-    print(f"\nOutput saved to {output_file}")
-    output_files_success.append(output_file)
-except Exception as e:
-    print(f"Error saving {output_file}: {str(e)}")
-
-llm_output_file = 'llm_input.json'
-try:
-    with open(llm_output_file, 'w', encoding='utf-8') as f:
-        json.dump(llm_input_data, f, ensure_ascii=False, indent=4)
-    print(f"Output saved to {llm_output_file}")
-    output_files_success.append(llm_output_file)
-except Exception as e:
-    print(f"Error saving {llm_output_file}: {str(e)}")
-
-# Calculate KPIs
-kpi_report = {
-    "document_processing_success_rate": (successful_count / len(supported_files) * 100) if supported_files else 0.0,
-    "processing_time_per_document_seconds": (sum(processing_times) / len(processing_times)) if processing_times else 0.0,
-    "summary_quality_score": (sum(summary_lengths) / len(summary_lengths)) if summary_lengths else 0.0,  # Proxy: avg words in summary
-    "embedding_quality_cosine_similarity": (sum(cosine_similarities) / len(cosine_similarities)) if cosine_similarities else 0.0,
-    "file_type_coverage": (len(file_types_processed) / len(supported_extensions) * 100) if supported_extensions else 0.0,
-    "error_rate": (error_count / len(supported_files) * 100) if supported_files else 0.0,
-    "ocr_utilization_rate": (len(ocr_processed_files) / len(ocr_eligible_files) * 100) if ocr_eligible_files else 0.0,
-    "output_file_integrity": (len(output_files_success) / 2 * 100)  # Expect 2 output files
-}
+        work_queue.release(worker_id)
+    metrics.count('leases_reclaimed', work_queue.reclaimed)
+    counts = work_queue.counts()
+    print(f"Queue {args.queue}: {counts['done']} done, {counts['failed']} failed")
+    for file_path, error in work_queue.failures().items():
+        print(f"  Failed: {file_path} ({error})")
+
+# Function to expand the --merge-shards arguments into shard directories: each argument is a shard
+# directory or a directory of them
+def find_shard_dirs(paths: List[str]) -> List[str]:
+    shard_dirs = []
+    for path in paths:
+        if os.path.exists(os.path.join(path, 'processed_documents.jsonl')):
+            shard_dirs.append(path)
+        elif os.path.isdir(path):
+            shard_dirs.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                              if os.path.exists(os.path.join(path, name, 'processed_documents.jsonl')))
+    return shard_dirs
+
+# Function to return the embedding size of sharded outputs, or None if no shard has an embedding matrix
+def shard_embedding_dim(shard_dirs: List[str]) -> Optional[int]:
+    for shard_dir in shard_dirs:
+        embeddings_file = os.path.join(shard_dir, EMBEDDINGS_FILE)
+        if os.path.exists(embeddings_file):
+            return load_embeddings(embeddings_file).shape[1]
+    return None
+
+# Function to merge the outputs of sharded runs into this run's outputs: their records (renumbering the
+# embedding rows), caches and metrics. A file processed by two workers (after its lease expired) is
+# kept once. Returns the number of files the shards were given.
+def merge_shards(shard_dirs: List[str], new_cache_entries: Dict[str, Dict]) -> int:
+    files_total = 0
+    merged_paths: set = set()
+    for shard_dir in shard_dirs:
+        embeddings_file = os.path.join(shard_dir, EMBEDDINGS_FILE)
+        embeddings = load_embeddings(embeddings_file) if os.path.exists(embeddings_file) else None
+        llm_records = {record['file_path']: record for record in iter_jsonl(os.path.join(shard_dir, 'llm_input.jsonl'))}
+        merged = dropped = 0
+        for record in iter_jsonl(os.path.join(shard_dir, 'processed_documents.jsonl')):
+            file_path = record['file_path']
+            if file_path not in llm_records:
+                continue
+            if file_path in merged_paths:
+                dropped += 1
+                continue
+            merged_paths.add(file_path)
+            doc_embedding = get_record_embedding(record, embeddings)
+            emit_records({key: value for key, value in record.items()
+                          if key not in ('embedding', 'embedding_row', 'version_group')},
+                         {key: value for key, value in llm_records[file_path].items() if key != 'version_group'},
+                         None if doc_embedding is None else np.array(doc_embedding))
+            merged += 1
+        for file_path, entry in load_cache(os.path.join(shard_dir, DEFAULT_CACHE_FILE)).items():
+            new_cache_entries.setdefault(file_path, entry)
+        quarantine.merge_file(os.path.join(shard_dir, DEFAULT_QUARANTINE_FILE))
+
+        # The shard's KPI report carries its metrics; the output files are counted again by this run
+        try:
+            with open(os.path.join(shard_dir, DEFAULT_KPI_FILE), 'r', encoding='utf-8') as f:
+                shard_kpi = json.load(f)
+            shard_metrics = shard_kpi.get('metrics', {})
+            shard_counters = {name: value for name, value in shard_metrics.get('counters', {}).items()
+                              if name != 'output_files_saved'}
+            metrics.merge({**shard_metrics, 'counters': shard_counters})
+            files_total += shard_kpi.get('documents_total', 0)
+            file_types_processed.update(shard_kpi.get('file_types_found', []))
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read the KPI report of shard {shard_dir}: {str(e)}")
+        # Files processed twice were counted by both shards
+        metrics.count('documents_processed', -dropped)
+        metrics.count('shard_duplicates_dropped', dropped)
+        files_total -= dropped
+        print(f"Merged {merged} documents from {shard_dir}"
+              + (f" ({dropped} already merged from another shard)" if dropped else ""))
+    return files_total
+
+class StageCounters:
+    """Counters of one pipeline stage: items handled, time spent working and time blocked on its queues."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items: int = 0, busy_seconds: float = 0.0, wait_seconds: float = 0.0) -> None:
+        with self._lock:
+            self.items += items
+            self.busy_seconds += busy_seconds
+            self.wait_seconds += wait_seconds
+
+# Marker passed down the pipeline queues when a producer is finished
+PIPELINE_DONE = object()
+
+# Function to put an item on a bounded queue, counting the time blocked by backpressure
+def timed_put(q: queue.Queue, item, counters: StageCounters) -> None:
+    start_time = time.time()
+    q.put(item)
+    counters.add(wait_seconds=time.time() - start_time)
+
+# Function to take an item from a queue, counting the time spent waiting for input
+def timed_get(q: queue.Queue, counters: StageCounters, timeout: Optional[float] = None):
+    start_time = time.time()
+    try:
+        return q.get(timeout=timeout)
+    finally:
+        counters.add(wait_seconds=time.time() - start_time)
+
+# Function to run scan -> extract -> embed -> write as concurrent stages connected by bounded queues.
+# Extraction uses one thread per worker (each driving a worker process when workers > 1); embedding
+# and writing each run on a single thread, so the KPI counters have a single writer.
+def run_pipeline(args, options: Dict, cache_entries: Dict[str, Dict], resumed_records: Dict[str, Dict],
+                 new_cache_entries: Dict[str, Dict], exclude_globs: List[str],
+                 max_file_size: Optional[int]) -> Dict[str, StageCounters]:
+    stats = {name: StageCounters(name) for name in ('scan', 'extract', 'embed', 'write')}
+    path_queue: queue.Queue = queue.Queue(maxsize=args.queue_size)
+    extract_queue: queue.Queue = queue.Queue(maxsize=args.queue_size)
+    write_queue: queue.Queue = queue.Queue(maxsize=2)
+    extract_threads = max(1, args.workers)
+    flush_threshold = args.embed_batch_size * EMBED_FLUSH_BATCHES
+    options_digest = options_hash(options)
+    executor = None
+    if conversion_pool is None and args.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=init_extraction_worker,
+                                       initargs=(options,))
+    elif conversion_pool is None:
+        init_extraction_worker(options)
+
+    def scan_stage():
+        try:
+            print("Scanning for documents supported by Docling...")
+            for file_path in iter_supported_files(base_path, exclude_globs, max_file_size):
+                start_time = time.time()
+                register_scanned_file(file_path)
+                entry = prepare_entry(file_path, cache_entries, resumed_records, args.hash, options_digest)
+                stats['scan'].add(items=1, busy_seconds=time.time() - start_time)
+                timed_put(path_queue, entry, stats['scan'])
+        finally:
+            for _ in range(extract_threads):
+                path_queue.put(PIPELINE_DONE)
 
-# Save KPI report
-# kpi_output_file = 'summarygeneratorkpi.json'
-# try:
-#     with open(kpi_output_file, 'w', encoding='utf-8') as f:
-#         json.dump(kpi_report, f, ensure_ascii=False, indent=4)
-#     print(f"\nKPI report saved to {kpi_output_file}")
-# except Exception as e:
-#     print(f"Error saving {kpi_output_file}: {str(e)}")
+    def extract_stage():
+        try:
+            while True:
+                entry = timed_get(path_queue, stats['extract'])
+                if entry is PIPELINE_DONE:
+                    break
+                if entry['status'] == 'pending':
+                    start_time = time.time()
+                    file_path = entry['file_path']
+                    try:
+                        if conversion_pool is not None:
+                            extracted = extract_supervised(file_path)
+                        elif executor is not None:
+                            extracted = executor.submit(extract_document, file_path).result()
+                        else:
+                            extracted = extract_document(file_path)
+                    except Exception as e:
+                        extracted = new_extraction_result(file_path, str(e))
+                        extracted['extract_time'] = time.time() - start_time
+                    entry['extracted'] = attach_sentences(extracted)
+                    stats['extract'].add(items=1, busy_seconds=time.time() - start_time)
+                timed_put(extract_queue, entry, stats['extract'])
+        finally:
+            extract_queue.put(PIPELINE_DONE)
 
-# Print KPI report
-print("\n=== KPI Report ===")
-print(f"Document Processing Success Rate: {kpi_report['document_processing_success_rate']:.2f}%")
-print(f"Average Processing Time per Document: {kpi_report['processing_time_per_document_seconds']:.2f} seconds")
-print(f"Summary Quality Score (Avg Words): {kpi_report['summary_quality_score']:.2f}")
-#print(f"Embedding Quality (Avg Cosine Similarity): {kpi_report['embedding_quality_cosine_similarity']:.2f}")
-#print(f"File Type Coverage: {kpi_report['file_type_coverage']:.2f}%")
-print(f"Error Rate: {kpi_report['error_rate']:.2f}%")
-print(f"OCR Utilization Rate: {kpi_report['ocr_utilization_rate']:.2f}%")
-print(f"Output File Integrity: {kpi_report['output_file_integrity']:.2f}%")
-print("=================\n")
+    def embed_stage():
+        batch: List[Dict] = []
+        batch_sentences = 0
+        finished = 0
 
-print("Processing complete.")
+        def flush():
+            start_time = time.time()
+            embedded = embed_batch(batch, args.embed_batch_size)
+            stats['embed'].add(items=len(batch), busy_seconds=time.time() - start_time)
+            timed_put(write_queue, (list(batch), embedded), stats['embed'])
 
+        try:
+            while finished < extract_threads:
+                try:
+                    entry = timed_get(extract_queue, stats['embed'], timeout=EMBED_IDLE_FLUSH_SECONDS)
+                except queue.Empty:
+                    entry = None
+                if entry is PIPELINE_DONE:
+                    finished += 1
+                    continue
+                if entry is not None:
+                    batch.append(entry)
+                    batch_sentences += len(entry.get('extracted', {}).get('sentences', []))
+                # Flush a full batch, or a partial one when extraction is not keeping up
+                if batch and (batch_sentences >= flush_threshold or entry is None):
+                    flush()
+                    batch, batch_sentences = [], 0
+            if batch:
+                flush()
+        finally:
+            write_queue.put(PIPELINE_DONE)
 
+    def write_stage():
+        while True:
+            item = timed_get(write_queue, stats['write'])
+            if item is PIPELINE_DONE:
+                break
+            batch, (embedded, embed_time_per_doc) = item
+            start_time = time.time()
+            write_batch(batch, embedded, embed_time_per_doc, args.hash, new_cache_entries)
+            stats['write'].add(items=len(batch), busy_seconds=time.time() - start_time)
 
+    threads = [threading.Thread(target=scan_stage, name='scan')]
+    threads += [threading.Thread(target=extract_stage, name=f'extract-{i}') for i in range(extract_threads)]
+    threads += [threading.Thread(target=embed_stage, name='embed'), threading.Thread(target=write_stage, name='write')]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print(f"\nTotal supported documents found: {len(supported_files)}")
+    metrics.observe('scan', stats['scan'].busy_seconds, items=stats['scan'].items)
+    for counters in stats.values():
+        metrics.set(f"pipeline_{counters.name}_busy_seconds", counters.busy_seconds)
+        metrics.set(f"pipeline_{counters.name}_wait_seconds", counters.wait_seconds)
+    return stats
+
+# --- Library API ---
+
+# Function to summarize files in-process and return their records without writing any output.
+# Each record looks like a processed_documents entry with 'embedding' as a numpy array
+# (None without content), or carries an 'error'. Models are loaded on first use.
+def summarize_files(file_paths: List[str], options: Optional[Dict] = None,
+                    batch_size: int = DEFAULT_EMBED_BATCH_SIZE) -> List[Dict]:
+    global extraction_options
+    if options is not None:
+        extraction_options = options
+    extracted = [attach_sentences(extract_document(file_path)) for file_path in file_paths]
+    documents = [doc for doc in extracted if doc['error'] is None]
+    embedded = iter(embed_and_summarize(documents, batch_size) if documents else [])
+    records = []
+    for doc in extracted:
+        if doc['error'] is not None:
+            records.append({'file_path': doc['file_path'], 'file_type': doc['file_type'], 'error': doc['error']})
+            continue
+        doc_embedding, summary = next(embedded)
+        doc_dict, _ = build_document_records(doc, summary)
+        doc_dict['embedding'] = doc_embedding
+        records.append(doc_dict)
+    return records
+
+# Function to summarize a single file (see summarize_files)
+def summarize_file(file_path: str, options: Optional[Dict] = None) -> Dict:
+    return summarize_files([file_path], options)[0]
+
+# --- Warm worker mode ---
+
+# Requests share one model and converter, so they are handled one at a time
+worker_request_lock = threading.Lock()
+
+# Function to answer one worker request: {"id": ..., "file_path": ...} or {"id": ..., "file_paths": [...]}
+def handle_worker_request(request: Dict) -> Dict:
+    start_time = time.time()
+    file_paths = request.get('file_paths') or [request['file_path']]
+    with worker_request_lock, contextlib.redirect_stdout(sys.stderr):
+        records = summarize_files(file_paths)
+    for record in records:
+        if record.get('embedding') is not None:
+            record['embedding'] = record['embedding'].tolist()
+    return {'id': request.get('id'), 'results': records, 'elapsed_ms': round((time.time() - start_time) * 1000, 2)}
+
+# Function to answer JSON-lines requests from an iterable of lines, writing one response line each
+def serve_lines(lines, write) -> None:
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        request: Dict = {}
+        try:
+            request = json.loads(line)
+            response = handle_worker_request(request)
+        except Exception as e:
+            response = {'id': request.get('id') if isinstance(request, dict) else None, 'error': str(e)}
+        write(json.dumps(response, ensure_ascii=False) + '\n')
+
+class WorkerRequestHandler(socketserver.StreamRequestHandler):
+    """Serves JSON-lines summarization requests on one TCP connection."""
+
+    def handle(self):
+        def write(text: str) -> None:
+            self.wfile.write(text.encode('utf-8'))
+            self.wfile.flush()
+        serve_lines(self.rfile, write)
+
+# Function to run the warm worker: models are loaded once, then requests are answered until EOF/Ctrl+C
+def serve(args, options: Dict) -> None:
+    global extraction_options
+    extraction_options = options
+    with contextlib.redirect_stdout(sys.stderr):
+        print("Loading models for worker mode...")
+        warn_missing_ocr_dependencies()
+        get_embed_model()
+        get_converter(ocr=False)
+        ensure_nltk_data()
+    if args.serve_port is not None:
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        with socketserver.ThreadingTCPServer((args.serve_host, args.serve_port), WorkerRequestHandler) as server:
+            server.daemon_threads = True
+            print(f"Worker ready on {args.serve_host}:{args.serve_port}", file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+        return
+    print("Worker ready, reading requests from stdin", file=sys.stderr)
+
+    def write(text: str) -> None:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+    serve_lines(sys.stdin, write)
+
+def main():
+    global output_writers, embedding_store, duplicate_index, conversion_pool, quarantine
+    args = parser.parse_args()
+    try:
+        shard = parse_shard(args.shard) if args.shard else None
+    except ValueError as e:
+        parser.error(str(e))
+    if shard is not None and args.queue and not args.write_manifest:
+        parser.error("--shard and --queue are alternative ways to split the work; use one of them.")
+    worker_id = args.worker_id or default_worker_id()
+
+    # Shard and queue workers write streamed outputs, their cache and their KPI report to their own
+    # directory, for --merge-shards to combine
+    sharded = not args.write_manifest and not args.merge_shards and (shard is not None or args.queue is not None)
+    output_dir = ''
+    if sharded:
+        output_dir = args.shard_dir or os.path.join(
+            DEFAULT_SHARDS_DIR, f"shard-{shard[0]}-of-{shard[1]}" if shard is not None else worker_id)
+        os.makedirs(output_dir, exist_ok=True)
+        args.output_format, args.embedding_format = 'jsonl', 'npy'
+        if args.pipeline:
+            print("Note: --pipeline scans BASE_PATH itself, so shard and queue workers process sequentially.")
+            args.pipeline = False
+        print(f"Writing this worker's outputs to {output_dir}")
+    if args.resume:
+        args.output_format = 'jsonl'
+    output_file = os.path.join(output_dir, 'processed_documents.json')
+    llm_output_file = os.path.join(output_dir, 'llm_input.json')
+    if args.output_format == 'jsonl':
+        output_file += 'l'
+        llm_output_file += 'l'
+    embeddings_file = os.path.join(output_dir, EMBEDDINGS_FILE)
+    kpi_file = os.path.join(output_dir, DEFAULT_KPI_FILE) if sharded else args.kpi_file
+    cache_save_file = os.path.join(output_dir, DEFAULT_CACHE_FILE) if sharded else args.cache_file
+    exclude_globs = DEFAULT_EXCLUDE_GLOBS + args.exclude
+    max_file_size = int(args.max_file_size * 1024 * 1024) if args.max_file_size is not None else None
+
+    options = {'excel_max_rows': args.excel_max_rows, 'excel_max_cells': args.excel_max_cells, 'ocr': args.ocr,
+               'max_pages': args.max_pages, 'max_chars': args.max_chars}
+    if args.serve or args.serve_port is not None:
+        serve(args, options)
+        return
+    warn_missing_ocr_dependencies()
+    if args.trace:
+        metrics.open_trace(args.trace)
+
+    # Sharded runs, step 1: scan once and write the work manifest (and queue)
+    if args.write_manifest:
+        scan_directory(base_path, exclude_globs, max_file_size)
+        write_manifest(args.write_manifest, supported_files)
+        print(f"Work manifest saved to {args.write_manifest}")
+        if args.queue:
+            added = WorkQueue(args.queue, args.lease_seconds).add(read_manifest(args.write_manifest))
+            print(f"Queued {added} new files in {args.queue}")
+        return
+    shard_dirs = find_shard_dirs(args.merge_shards) if args.merge_shards else []
+    if args.merge_shards and not shard_dirs:
+        print("No shard outputs found to merge. Exiting.")
+        return
+
+    # Step 1: Scan directory (in pipeline mode scanning runs concurrently with processing, queue workers
+    # claim their files as they go, and a merge takes the shards' files)
+    if not args.pipeline and not args.queue and not args.merge_shards:
+        scan_start = time.time()
+        if args.manifest:
+            load_manifest(args.manifest, shard)
+        else:
+            scan_directory(base_path, exclude_globs, max_file_size, shard)
+        metrics.observe('scan', time.time() - scan_start, items=len(supported_files))
+        if not supported_files:
+            print("No supported documents found. Exiting.")
+            return
+
+    # Load embedding model (a merge only combines stored embeddings)
+    if not args.merge_shards:
+        get_embed_model()
+        if not args.no_dedup:
+            duplicate_index = DuplicateIndex(hash_file)
+
+    # Load the re-scan cache (a merge combines the caches of the shards instead)
+    cache_entries: Dict[str, Dict] = {} if args.no_cache or args.merge_shards else load_cache(args.cache_file)
+    new_cache_entries: Dict[str, Dict] = {}
+
+    # Resume: documents already in both streamed outputs are kept and carried into the cache
+    resumed_records: Dict[str, Dict] = {}
+    if args.resume:
+        stored_embeddings = None
+        stored_index: List[str] = []
+        embeddings_index_file = os.path.join(output_dir, EMBEDDINGS_INDEX_FILE)
+        if os.path.exists(embeddings_file) and os.path.exists(embeddings_index_file):
+            stored_embeddings = load_embeddings(embeddings_file)
+            stored_index = load_embedding_index(embeddings_index_file)[:len(stored_embeddings)]
+        # Records whose embedding row is missing or belongs to another file (e.g. overwritten by another run) are redone
+        resumed = prepare_resume([output_file, llm_output_file],
+                                 is_complete=lambda record: record.get('embedding_row') is None
+                                 or (record['embedding_row'] < len(stored_index)
+                                     and stored_index[record['embedding_row']] == record['file_path']))
+        llm_records = {record['file_path']: record for record in resumed[llm_output_file]}
+        for record in resumed[output_file]:
+            doc_embedding = get_record_embedding(record, stored_embeddings)
+            document = {key: value for key, value in record.items() if key not in ('embedding', 'embedding_row')}
+            resumed_records[record['file_path']] = {
+                'document': document, 'llm_input': llm_records[record['file_path']],
+                'embedding': None if doc_embedding is None else np.array(doc_embedding)}
+        del stored_embeddings
+        print(f"Resuming: {len(resumed_records)} documents already in {output_file}")
+    if args.embedding_format == 'npy':
+        dim = shard_embedding_dim(shard_dirs) if shard_dirs else None
+        embedding_store = EmbeddingStore(embeddings_file, dim=dim or get_embed_model().get_sentence_embedding_dimension(),
+                                         dtype='float16' if args.float16 else 'float32',
+                                         append=args.resume, checkpoint_every=args.checkpoint_every)
+    if args.output_format == 'jsonl':
+        output_writers = (JsonlWriter(output_file, append=args.resume, checkpoint_every=args.checkpoint_every),
+                          JsonlWriter(llm_output_file, append=args.resume, checkpoint_every=args.checkpoint_every))
+
+    # Files stopped by a limit in earlier runs are skipped until they change (a worker saves its list to
+    # its own directory, which the merge combines)
+    quarantine = QuarantineList(args.quarantine_file,
+                                os.path.join(output_dir, DEFAULT_QUARANTINE_FILE) if sharded else args.quarantine_file)
+    if args.retry_quarantined:
+        quarantine.clear()
+    # Conversion runs in supervised processes, which stop a file at its time or memory limit
+    if not args.no_isolation and not args.merge_shards:
+        conversion_pool = SupervisorPool(args.workers, extract_document, initializer=init_extraction_worker,
+                                         initargs=(options,), timeout=args.file_timeout or None,
+                                         memory_limit_bytes=int(args.file_memory_limit * 1024 ** 2) or None)
+
+    # Process documents
+    print("\nProcessing supported documents...")
+    stage_stats: Dict[str, StageCounters] = {}
+    files_total = None
+    try:
+        if args.merge_shards:
+            files_total = merge_shards(shard_dirs, new_cache_entries)
+            if args.queue:
+                counts = WorkQueue(args.queue, args.lease_seconds).counts()
+                if counts['pending'] or counts['leased']:
+                    print(f"Warning: {counts['pending']} files are still queued and {counts['leased']} being "
+                          f"processed in {args.queue}; this merge does not include them.")
+        elif args.queue:
+            process_queue(args, options, worker_id, cache_entries, resumed_records, new_cache_entries)
+        elif args.pipeline:
+            stage_stats = run_pipeline(args, options, cache_entries, resumed_records, new_cache_entries,
+                                       exclude_globs, max_file_size)
+        else:
+            process_sequentially(args, options, supported_files, cache_entries, resumed_records, new_cache_entries)
+    finally:
+        if conversion_pool is not None:
+            metrics.set('conversion_process_restarts', conversion_pool.restarts)
+            conversion_pool.close()
+    fail_waiting_duplicates()
+    try:
+        quarantine.save()
+    except OSError as e:
+        print(f"Error saving {quarantine.save_filepath}: {str(e)}")
+
+    # Save the cache; files that were deleted since the last run are pruned here (a worker saves only
+    # its own files, which the merge combines)
+    if not args.no_cache:
+        pruned = len(set(cache_entries) - set(supported_files))
+        if pruned and not sharded:
+            print(f"\nPruned {pruned} deleted files from the cache.")
+        save_cache(cache_save_file, new_cache_entries)
+
+    # Save output
+    if embedding_store is not None:
+        try:
+            embedding_store.close()
+            print(f"\nEmbeddings saved to {embedding_store.filepath} ({embedding_store.rows} rows, {embedding_store.dtype})")
+        except Exception as e:
+            print(f"Error saving {embedding_store.filepath}: {str(e)}")
+    if output_writers is not None:
+        for writer in output_writers:
+            try:
+                writer.close()
+                print(f"Output saved to {writer.filepath} ({writer.records_written} records written this run)")
+                metrics.count('output_files_saved')
+            except Exception as e:
+                print(f"Error saving {writer.filepath}: {str(e)}")
+
+    # Tag copies and versions of the same document so the organizer can keep them together
+    # (across all shards, when they are merged)
+    if not args.no_dedup and not sharded:
+        try:
+            tag_version_groups(output_file, llm_output_file, args.near_duplicate_threshold)
+        except Exception as e:
+            print(f"Error tagging near-duplicate documents: {str(e)}")
+
+    if output_writers is None:
+        try:
+            with open(output_file, 'w', encoding='utf-8') as f:
+                json.dump(output_data, f, ensure_ascii=False, indent=4)
+            print(f"\nOutput saved to {output_file}")
+            metrics.count('output_files_saved')
+        except Exception as e:
+            print(f"Error saving {output_file}: {str(e)}")
+
+        try:
+            with open(llm_output_file, 'w', encoding='utf-8') as f:
+                json.dump(llm_input_data, f, ensure_ascii=False, indent=4)
+            print(f"Output saved to {llm_output_file}")
+            metrics.count('output_files_saved')
+        except Exception as e:
+            print(f"Error saving {llm_output_file}: {str(e)}")
+
+    # Make the new documents searchable (once the shards are merged)
+    if args.search_index and not sharded:
+        try:
+            search_index = update_index(args.search_index, iter_processed_documents(output_file),
+                                        dtype='float16' if args.float16 else 'float32')
+            print(f"Search index '{args.search_index}' holds {len(search_index)} documents")
+        except Exception as e:
+            print(f"Error updating the search index {args.search_index}: {str(e)}")
+
+    # Calculate KPIs (over the files of all shards, when they are merged)
+    if files_total is None:
+        files_total = len(supported_files)
+    successful_count = metrics.counter('documents_processed')
+    ocr_eligible_count = metrics.counter('ocr_eligible_files')
+    kpi_report = {
+        "document_processing_success_rate": (successful_count / files_total * 100) if files_total else 0.0,
+        "processing_time_per_document_seconds": metrics.total('document').to_dict()['mean_seconds'],
+        "summary_quality_score": metrics.average('summary_words'),  # Proxy: avg words in summary
+        "embedding_quality_cosine_similarity": metrics.average('cosine_similarity'),
+        "file_type_coverage": (len(file_types_processed) / len(supported_extensions) * 100) if supported_extensions else 0.0,
+        "error_rate": (metrics.counter('documents_failed') / files_total * 100) if files_total else 0.0,
+        "ocr_utilization_rate": (metrics.counter('ocr_files') / ocr_eligible_count * 100) if ocr_eligible_count else 0.0,
+        "ocr_files_processed": metrics.counter('ocr_files'),
+        "ocr_files_skipped_text_layer": metrics.counter('ocr_skipped_files'),
+        "ocr_time_seconds": metrics.total('ocr').total_seconds,
+        "output_file_integrity": (metrics.counter('output_files_saved') / 2 * 100),  # Expect 2 output files
+        "cache_hit_rate": (metrics.counter('cache_hits') / files_total * 100) if files_total else 0.0,
+        "duplicate_files_reused": metrics.counter('duplicates_reused'),
+        "files_quarantined": metrics.counter('files_quarantined'),
+        "quarantined_files_skipped": metrics.counter('quarantined_files_skipped'),
+        "version_groups": metrics.gauge('version_groups')
+    }
+
+    # Save KPI report, with the per-stage breakdown by file type and size
+    try:
+        with open(kpi_file, 'w', encoding='utf-8') as f:
+            json.dump({**kpi_report, 'documents_total': files_total, 'file_types_found': sorted(file_types_processed),
+                       'metrics': metrics.to_dict()}, f, ensure_ascii=False, indent=4)
+        print(f"\nKPI report saved to {kpi_file}")
+    except Exception as e:
+        print(f"Error saving {kpi_file}: {str(e)}")
 
+    # Export the metrics for monitoring
+    if args.metrics_file:
+        for name, value in kpi_report.items():
+            metrics.set(f"kpi_{name}", value)
+        try:
+            metrics.write_prometheus(args.metrics_file)
+            print(f"Metrics saved to {args.metrics_file}")
+        except Exception as e:
+            print(f"Error saving {args.metrics_file}: {str(e)}")
+    metrics.close()
+    if args.trace:
+        print(f"Trace saved to {args.trace}")
 
+    # Print KPI report
+    print("\n=== KPI Report ===")
+    print(f"Document Processing Success Rate: {kpi_report['document_processing_success_rate']:.2f}%")
+    print(f"Average Processing Time per Document: {kpi_report['processing_time_per_document_seconds']:.2f} seconds")
+    print(f"Summary Quality Score (Avg Words): {kpi_report['summary_quality_score']:.2f}")
+    #print(f"Embedding Quality (Avg Cosine Similarity): {kpi_report['embedding_quality_cosine_similarity']:.2f}")
+    #print(f"File Type Coverage: {kpi_report['file_type_coverage']:.2f}%")
+    print(f"Error Rate: {kpi_report['error_rate']:.2f}%")
+    print(f"Cache Hit Rate: {kpi_report['cache_hit_rate']:.2f}%")
+    print(f"Duplicates: {kpi_report['duplicate_files_reused']:.0f} byte-identical files reused an earlier result, "
+          f"{kpi_report['version_groups']:.0f} version groups tagged")
+    if args.resume:
+        print(f"Resumed Documents: {metrics.counter('documents_resumed'):.0f}")
+    print(f"Quarantined Files: {kpi_report['files_quarantined']:.0f} stopped by a limit this run, "
+          f"{kpi_report['quarantined_files_skipped']:.0f} skipped (listed in {quarantine.save_filepath})")
+    if args.merge_shards:
+        print(f"Shards Merged: {len(shard_dirs)} ({metrics.counter('shard_duplicates_dropped'):.0f} files processed "
+              f"by two workers kept once, {metrics.counter('leases_reclaimed'):.0f} expired leases reclaimed)")
+    for counters in stage_stats.values():
+        print(f"Pipeline stage '{counters.name}': {counters.items} items, {counters.busy_seconds:.2f}s busy, "
+              f"{counters.wait_seconds:.2f}s waiting")
+    metrics.print_stage_report()
+    print(f"OCR Utilization Rate: {kpi_report['ocr_utilization_rate']:.2f}% "
+          f"({kpi_report['ocr_files_processed']:.0f} files OCR'd, {kpi_report['ocr_files_skipped_text_layer']:.0f} "
+          f"skipped with a text layer, {kpi_report['ocr_time_seconds']:.2f} seconds in OCR)")
+    print(f"Output File Integrity: {kpi_report['output_file_integrity']:.2f}%")
+    print("=================\n")
 
+    print("Processing complete.")
 
+# --- Main Execution ---
+if __name__ == "__main__":
+    main()
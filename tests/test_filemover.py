@@ -0,0 +1,88 @@
+import os
+import sys
+import errno
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filemover import FileMover, move_file, copy_then_remove
+
+
+class SameBasenameMovesTest(unittest.TestCase):
+    """Sources sharing a basename that the plan sends into one folder must all survive the move."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_sources(self, count: int):
+        sources = []
+        for i in range(count):
+            directory = os.path.join(self.root, 'src', f'dir{i}')
+            os.makedirs(directory)
+            path = os.path.join(directory, 'report.pdf')
+            with open(path, 'w') as f:
+                f.write(f'report {i}')
+            sources.append(path)
+        return sources
+
+    def test_parallel_moves_into_one_folder_keep_every_file(self):
+        sources = self.make_sources(200)
+        moves = [(src, os.path.join(self.root, 'dst', f'folder{i // 2}', 'report.pdf'))
+                 for i, src in enumerate(sources)]
+        mover = FileMover(os.path.join(self.root, 'journal.jsonl'), workers=8)
+        result = mover.run(sorted({os.path.dirname(dst) for _, dst in moves}), moves)
+
+        self.assertEqual(result.failures, [])
+        self.assertEqual(result.moved, 200)
+        self.assertEqual(len(result.renamed), 100)
+        contents = set()
+        for directory, _, files in os.walk(os.path.join(self.root, 'dst')):
+            for name in files:
+                with open(os.path.join(directory, name)) as f:
+                    contents.add(f.read())
+        self.assertEqual(contents, {f'report {i}' for i in range(200)})
+
+        rollback = FileMover(os.path.join(self.root, 'journal.jsonl')).rollback()
+        self.assertEqual(rollback.failures, [])
+        self.assertTrue(all(os.path.exists(src) for src in sources))
+
+    def test_move_never_overwrites(self):
+        src, other = self.make_sources(2)
+        for move in (move_file, copy_then_remove):
+            with self.assertRaises(FileExistsError):
+                move(src, other)
+            with open(other) as f:
+                self.assertEqual(f.read(), 'report 1')
+            self.assertTrue(os.path.exists(src))
+            self.assertFalse(os.path.exists(f"{other}.partial"))
+
+    def test_failed_copy_leaves_nothing_behind(self):
+        (src,) = self.make_sources(1)
+        dst = os.path.join(self.root, 'dst', 'folder', 'report.pdf')
+
+        def cross_device(*args):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        def disk_full(*args):
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        journal = os.path.join(self.root, 'journal.jsonl')
+        with mock.patch('filemover.os.link', cross_device), mock.patch.object(shutil, 'copyfileobj', disk_full):
+            result = FileMover(journal).run([os.path.dirname(dst)], [(src, dst)])
+
+        self.assertEqual(len(result.failures), 1)
+        self.assertEqual(os.listdir(os.path.dirname(dst)), [])
+        self.assertTrue(os.path.exists(src))
+        FileMover(journal).rollback()
+        self.assertFalse(os.path.exists(os.path.dirname(dst)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fileorganizer
+from fileorganizer import (colocate_version_groups, destination_names, execute_file_organization, render_file_tree,
+                           assign_document_ids, create_file_path_map, get_clustered_organization_plan, offline_response)
+from llmclient import LLMClient, StubBackend
+
+
+class SameBasenameOrganizationTest(unittest.TestCase):
+    """Documents with the same name planned into one folder keep distinct names, in the preview and on disk."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.path_map = {}
+        for doc_id in ('1', '2', '3'):
+            directory = os.path.join(self.root, 'src', doc_id)
+            os.makedirs(directory)
+            self.path_map[doc_id] = os.path.join(directory, 'report.pdf')
+            with open(self.path_map[doc_id], 'w') as f:
+                f.write(f'report {doc_id}')
+        self.destination = os.path.join(self.root, 'organized')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_names_are_unique_per_folder(self):
+        plan = {'Reports': ['1', '2'], 'Other': ['3']}
+        self.assertEqual(destination_names(plan, self.path_map),
+                         {'1': 'report.pdf', '2': 'report (1).pdf', '3': 'report.pdf'})
+
+    def test_colocated_copies_keep_distinct_names(self):
+        documents = [{'id': doc_id, 'file_path': path, 'version_group': 0} for doc_id, path in self.path_map.items()]
+        plan, changed = colocate_version_groups({'Reports': ['1', '2'], 'Other': ['4']}, documents)
+        self.assertEqual(changed, 1)
+        self.assertEqual(sorted(destination_names(plan, self.path_map).values()),
+                         ['report (1).pdf', 'report (2).pdf', 'report.pdf'])
+
+    def test_moves_use_the_previewed_names(self):
+        plan = {'Reports': ['1', '2', '3']}
+        os.makedirs(os.path.join(self.destination, 'Reports'))
+        with open(os.path.join(self.destination, 'Reports', 'report.pdf'), 'w') as f:
+            f.write('already there')
+        original_root = fileorganizer.DESTINATION_ROOT
+        fileorganizer.DESTINATION_ROOT = self.destination
+        try:
+            tree = render_file_tree(plan, self.path_map)
+        finally:
+            fileorganizer.DESTINATION_ROOT = original_root
+        execute_file_organization(plan, self.path_map, self.destination,
+                                  journal_path=os.path.join(self.root, 'journal.jsonl'))
+
+        on_disk = sorted(os.listdir(os.path.join(self.destination, 'Reports')))
+        self.assertEqual(on_disk, ['report (1).pdf', 'report (2).pdf', 'report (3).pdf', 'report.pdf'])
+        for name in on_disk[:3]:
+            self.assertIn(name, tree)
+        with open(os.path.join(self.destination, 'Reports', 'report.pdf')) as f:
+            self.assertEqual(f.read(), 'already there')
+
+
+class ClusteredPlanCompletionTest(unittest.TestCase):
+    """Files a clustered plan leaves out are placed by a follow-up request, as in single-request planning."""
+
+    def setUp(self):
+        self.documents = assign_document_ids([{'file_path': f'/docs/{folder}/file{i}.{ext}', 'summary': f'file {i}'}
+                                              for folder, ext in (('a', 'pdf'), ('b', 'docx'))
+                                              for i in range(3)])
+        self.clusters = [self.documents[:3], self.documents[3:]]
+        self.path_map = create_file_path_map(self.documents)
+        self.original_client = fileorganizer.client
+
+    def tearDown(self):
+        fileorganizer.client = self.original_client
+
+    def plan_with(self, respond):
+        fileorganizer.client = LLMClient(StubBackend(respond), concurrency=1, max_retries=0)
+        plan, _, _ = get_clustered_organization_plan(self.clusters, "analysis", self.path_map)
+        return plan
+
+    def test_left_out_file_is_placed(self):
+        left_out = self.documents[0]['id']
+
+        def respond(prompt):
+            response = offline_response(prompt)
+            if 'one group of related documents' in prompt:
+                plan = json.loads(response)
+                plan = {directory: [doc_id for doc_id in ids if doc_id != left_out] for directory, ids in plan.items()}
+                return json.dumps(plan)
+            return response
+
+        plan = self.plan_with(respond)
+        planned = [doc_id for ids in plan.values() for doc_id in ids]
+        self.assertEqual(sorted(planned), sorted(self.path_map))
+        self.assertIn(left_out, plan['PDF_Files'])
+
+    def test_files_of_a_failed_cluster_are_placed(self):
+        def respond(prompt):
+            if 'one group of related documents' in prompt and '.docx' in prompt:
+                raise ValueError("malformed request")
+            return offline_response(prompt)
+
+        plan = self.plan_with(respond)
+        planned = [doc_id for ids in plan.values() for doc_id in ids]
+        self.assertEqual(sorted(planned), sorted(self.path_map))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llmclient import LLMClient, ResponseCache, StubBackend
+
+
+class LLMClientTest(unittest.TestCase):
+    """The request layer against the local stub backend: retries, timeouts, caching and broken streams."""
+
+    def client(self, backend, **options):
+        # No backoff, so retries do not slow the tests down
+        return LLMClient(backend, concurrency=1, backoff_base=0.0, **options)
+
+    def test_retryable_status_is_retried(self):
+        backend = StubBackend(lambda prompt: 'ok', fail_every=2, fail_code=503)
+        client = self.client(backend, max_retries=3)
+        self.assertEqual(client.generate('first'), 'ok')
+        self.assertEqual(client.generate('second'), 'ok')
+        self.assertEqual((backend.calls, client.retries), (3, 1))
+
+    def test_gives_up_after_max_retries(self):
+        backend = StubBackend(lambda prompt: 'ok', fail_every=1, fail_code=429)
+        client = self.client(backend, max_retries=2)
+        with self.assertRaises(RuntimeError) as raised:
+            client.generate('prompt')
+        self.assertEqual(raised.exception.code, 429)
+        self.assertEqual((backend.calls, client.retries), (3, 2))
+
+    def test_timeout_is_retried_then_raised(self):
+        backend = StubBackend(lambda prompt: 'ok', latency=0.2)
+        client = self.client(backend, timeout=0.01, max_retries=1)
+        with self.assertRaises(TimeoutError):
+            client.generate('prompt')
+        self.assertEqual((backend.calls, client.retries), (2, 1))
+
+    def test_cache_hit_skips_the_backend(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            backend = StubBackend(lambda prompt: f'answer to {prompt}')
+            client = self.client(backend, cache=ResponseCache(cache_dir))
+            self.assertEqual(client.generate('prompt'), 'answer to prompt')
+            self.assertEqual(client.generate('prompt'), 'answer to prompt')
+            self.assertEqual((backend.calls, client.cache_hits), (1, 1))
+            self.assertEqual(client.usage.totals()['cached_calls'], 1)
+
+    def test_broken_stream_returns_the_partial_text(self):
+        backend = StubBackend(lambda prompt: 'x' * 200, cut_stream_after=100)
+        client = self.client(backend, max_retries=3)
+        chunks = []
+        text = client.generate('prompt', on_text=chunks.append)
+        self.assertEqual(text, 'x' * 100)
+        self.assertEqual(''.join(chunks), text)
+        # Text was already delivered, so the stream is not retried
+        self.assertEqual((backend.calls, client.retries, client.interrupted_streams), (1, 0, 1))
+
+    def test_token_count_is_retried_then_estimated(self):
+        class FlakyCounter(StubBackend):
+            def __init__(self, failures):
+                super().__init__(lambda prompt: 'ok')
+                self.failures = failures
+                self.count_calls = 0
+
+            def count_tokens(self, prompt):
+                self.count_calls += 1
+                if self.count_calls <= self.failures:
+                    error = RuntimeError("Simulated error 429")
+                    error.code = 429
+                    raise error
+                return 42
+
+        prompt = 'x' * 400
+        backend = FlakyCounter(failures=1)
+        client = self.client(backend, max_retries=2, max_prompt_tokens=150)
+        self.assertEqual(client.check_budget(prompt), 42)
+        self.assertEqual(backend.count_calls, 2)
+
+        backend = FlakyCounter(failures=10)
+        client = self.client(backend, max_retries=2, max_prompt_tokens=150)
+        self.assertEqual(client.check_budget(prompt), 100)
+        self.assertEqual(backend.count_calls, 3)
+        self.assertEqual(client.generate(prompt), 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
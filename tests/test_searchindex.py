@@ -0,0 +1,62 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from searchindex import SearchIndex, build_index, update_index
+
+
+def documents(vectors, summaries=None):
+    return [({'file_path': f'/docs/{name}.pdf', 'file_type': '.pdf',
+              'summary': (summaries or {}).get(name, f'about {name}')}, vector)
+            for name, vector in vectors.items()]
+
+
+class UpdateIndexTest(unittest.TestCase):
+    """--update keeps the index in step with the processed documents."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index_dir = os.path.join(self.tmp.name, 'index')
+        self.vectors = {name: vector for name, vector in zip('abcd', np.eye(4, dtype=np.float32))}
+        build_index(self.index_dir, documents(self.vectors))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def best_match(self, index, vector):
+        doc_id, _ = index.search(vector, k=1)[0]
+        return index.document(doc_id)
+
+    def test_unchanged_documents_are_kept(self):
+        index = update_index(self.index_dir, documents(self.vectors))
+        self.assertEqual(len(index), 4)
+        self.assertEqual(len(index.delta), 0)
+
+    def test_changed_documents_are_replaced(self):
+        changed = dict(self.vectors, a=np.array([0, 0, 0, 1], dtype=np.float32))
+        index = update_index(self.index_dir, documents(changed, {'a': 'revised'}))
+        self.assertEqual(len(index), 4)
+        result = self.best_match(index, np.array([1, 0, 0, 0], dtype=np.float32))
+        self.assertNotEqual(result['file_path'], '/docs/a.pdf')
+        results = [index.document(doc_id) for doc_id, _ in index.search(changed['a'], k=4)]
+        self.assertEqual([r['summary'] for r in results if r['file_path'] == '/docs/a.pdf'], ['revised'])
+
+    def test_vanished_documents_are_removed(self):
+        remaining = {name: vector for name, vector in self.vectors.items() if name != 'b'}
+        index = update_index(self.index_dir, documents(remaining))
+        self.assertEqual(len(index), 3)
+        found = {index.document(doc_id)['file_path'] for doc_id, _ in index.search(self.vectors['b'], k=10)}
+        self.assertNotIn('/docs/b.pdf', found)
+        self.assertEqual(len(found), 3)
+        # A rebuild leaves the removed document out
+        rebuilt = build_index(self.index_dir, list(SearchIndex(self.index_dir).iter_documents()))
+        self.assertEqual((rebuilt.count, len(rebuilt.deleted)), (3, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
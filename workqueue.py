@@ -0,0 +1,195 @@
+import os
+import time
+import socket
+import sqlite3
+import hashlib
+import threading
+import contextlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from documentstore import JsonlWriter, iter_jsonl
+
+# Work distribution for sharded summarization. A scan writes a manifest (one {"file_path", "size"}
+# record per line); workers either take a fixed hash partition of it (--shard I/N) or claim batches
+# from a WorkQueue, an SQLite database on storage every worker can reach.
+
+# Seconds a claimed batch stays leased to its worker; a worker renews its leases while it runs,
+# so a lease only expires when its worker died or lost access to the queue
+DEFAULT_LEASE_SECONDS = 300
+# A file is marked failed once its lease expired this many times (e.g. it crashes every worker)
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_CLAIM_BATCH = 16
+# Seconds to wait for a lock held by another worker
+SQLITE_TIMEOUT_SECONDS = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_path TEXT PRIMARY KEY,
+    size INTEGER,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS files_status ON files (status, lease_expires);
+"""
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    """Parses a shard given as "I/N" (1-based), e.g. "2/8"."""
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{text}', expected I/N such as 2/8.")
+    if not 1 <= index <= count:
+        raise ValueError(f"Invalid shard '{text}': I must be between 1 and N.")
+    return index, count
+
+
+def shard_of(file_path: str, shard_count: int) -> int:
+    """The 1-based shard of a file: a stable hash of its path, the same on every host."""
+    digest = hashlib.sha1(file_path.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count + 1
+
+
+def write_manifest(filepath: str, file_paths: Iterable[str]) -> int:
+    """Writes the scanned files with their sizes to a manifest; returns the number of files."""
+    writer = JsonlWriter(filepath, checkpoint_every=10000)
+    try:
+        for file_path in file_paths:
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                size = None
+            writer.write({'file_path': file_path, 'size': size})
+    finally:
+        writer.close()
+    return writer.records_written
+
+
+def read_manifest(filepath: str, shard: Optional[Tuple[int, int]] = None) -> Iterator[Dict]:
+    """Yields the manifest records, only those of shard (I, N) if given."""
+    for record in iter_jsonl(filepath):
+        if shard is None or shard_of(record['file_path'], shard[1]) == shard[0]:
+            yield record
+
+
+class WorkQueue:
+    """A file-based queue of files to process, shared by workers on one or more hosts.
+
+    Workers claim batches under a lease; the files of a worker that stops renewing its leases
+    (because it died) are handed to the next worker that claims. Each operation uses its own short
+    transaction, so the database can live on a shared mount. SQLite's locking needs a filesystem
+    with working POSIX locks (most NFSv4 and SMB mounts; not every NFSv3 setup).
+    """
+
+    def __init__(self, filepath: str, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.filepath = filepath
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.reclaimed = 0
+        connection = sqlite3.connect(filepath, timeout=SQLITE_TIMEOUT_SECONDS)
+        try:
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """A connection inside one write transaction, committed on success."""
+        connection = sqlite3.connect(self.filepath, timeout=SQLITE_TIMEOUT_SECONDS, isolation_level=None)
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+    def add(self, records: Iterable[Dict]) -> int:
+        """Queues manifest records; files already queued keep their state. Returns the number added."""
+        with self._connect() as connection:
+            before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO files (file_path, size) VALUES (?, ?)",
+                                   ((record['file_path'], record.get('size')) for record in records))
+            return connection.total_changes - before
+
+    def claim(self, worker: str, limit: int = DEFAULT_CLAIM_BATCH) -> List[str]:
+        """Leases up to `limit` files to a worker: pending files first, then files whose lease expired."""
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("UPDATE files SET status = 'failed', error = 'lease expired ' || attempts || ' times' "
+                               "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                               (now, self.max_attempts))
+            rows = connection.execute("SELECT file_path, status FROM files "
+                                      "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                                      "ORDER BY status = 'leased', rowid LIMIT ?", (now, limit)).fetchall()
+            connection.executemany("UPDATE files SET status = 'leased', worker = ?, lease_expires = ?, "
+                                   "attempts = attempts + 1 WHERE file_path = ?",
+                                   ((worker, now + self.lease_seconds, file_path) for file_path, _ in rows))
+        reclaimed = sum(1 for _, status in rows if status == 'leased')
+        if reclaimed:
+            print(f"Reclaimed {reclaimed} files from expired leases")
+            self.reclaimed += reclaimed
+        return [file_path for file_path, _ in rows]
+
+    def renew(self, worker: str) -> int:
+        """Extends the leases of a worker's files; returns how many it still holds."""
+        with self._connect() as connection:
+            return connection.execute("UPDATE files SET lease_expires = ? WHERE status = 'leased' AND worker = ?",
+                                      (time.time() + self.lease_seconds, worker)).rowcount
+
+    def finish(self, worker: str, done: Iterable[str], failed: Dict[str, str]) -> None:
+        """Marks a worker's files done or failed. Files it lost to another worker are left alone."""
+        with self._connect() as connection:
+            connection.executemany("UPDATE files SET status = 'done', lease_expires = NULL, error = NULL "
+                                   "WHERE file_path = ? AND worker = ?", ((path, worker) for path in done))
+            connection.executemany("UPDATE files SET status = 'failed', lease_expires = NULL, error = ? "
+                                   "WHERE file_path = ? AND worker = ?",
+                                   ((error, path, worker) for path, error in failed.items()))
+
+    def release(self, worker: str) -> int:
+        """Returns a worker's unfinished files to the queue (on a clean shutdown)."""
+        with self._connect() as connection:
+            return connection.execute("UPDATE files SET status = 'pending', worker = NULL, lease_expires = NULL, "
+                                      "attempts = attempts - 1 WHERE status = 'leased' AND worker = ?",
+                                      (worker,)).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        """Number of files per status: pending, leased, done and failed."""
+        with self._connect() as connection:
+            counts = dict(connection.execute("SELECT status, COUNT(*) FROM files GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in ('pending', 'leased', 'done', 'failed')}
+
+    def failures(self) -> Dict[str, str]:
+        """The failed files of the queue, with the reason each failed."""
+        with self._connect() as connection:
+            return dict(connection.execute("SELECT file_path, error FROM files WHERE status = 'failed'").fetchall())
+
+    @contextlib.contextmanager
+    def keep_leases(self, worker: str) -> Iterator[None]:
+        """Renews the worker's leases in the background while the enclosed block runs."""
+        stop = threading.Event()
+
+        def renew_loop():
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    self.renew(worker)
+                except sqlite3.Error as e:
+                    print(f"Warning: Could not renew the leases of {worker}: {str(e)}")
+
+        thread = threading.Thread(target=renew_loop, name='lease-renewal', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()